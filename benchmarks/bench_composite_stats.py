@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to compute the composite stats of a stat group with
+the python and the numpy composite stats engines.
+Usage: bench_composite_stats.py [num_nodes] [num_inputs]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from isi_composite_stats import (  # noqa: E402
+    COMPOSITE_OPERATIONS,
+    NodeStatArraysLayout,
+    NumpyCompositeStatComputer,
+)
+from isi_data_insights_daemon import (  # noqa: E402
+    ClusterCompositeStatComputer,
+    DerivedStatGraph,
+    DerivedStatInput,
+)
+from isi_stats_client import StatRecord  # noqa: E402
+
+NUM_CYCLES = 20
+
+
+def build_graph(num_inputs, layout):
+    computers = []
+    for input_index in range(num_inputs):
+        input_stat = DerivedStatInput("node.bench.stat%d" % input_index)
+        composites = [
+            (op_name, "cluster.%s.%s" % (input_stat.name, op_name))
+            for op_name in sorted(COMPOSITE_OPERATIONS)
+        ]
+        if layout is not None:
+            computers.append(
+                NumpyCompositeStatComputer(input_stat, composites, layout)
+            )
+            continue
+        for op_name, out_stat_name in composites:
+            computers.append(
+                ClusterCompositeStatComputer(
+                    input_stat, out_stat_name, COMPOSITE_OPERATIONS[op_name]
+                )
+            )
+    return DerivedStatGraph(computers)
+
+
+def run_cycle(graph, stats):
+    context = graph.begin_process("bench", {})
+    for stat in stats:
+        context.select_stat(stat)
+    results = []
+    for computer, state in context.computer_states():
+        results.extend(computer.compute_derived_stats(state))
+    context.end_process()
+    return results
+
+
+def time_cycles(graph, stats):
+    run_cycle(graph, stats)
+    start_time = time.time()
+    for _ in range(NUM_CYCLES):
+        results = run_cycle(graph, stats)
+    return (time.time() - start_time) / NUM_CYCLES, results
+
+
+def main():
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 144
+    num_inputs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    stats = [
+        StatRecord(
+            "node.bench.stat%d" % input_index, devid, 1500000000, devid * 7.5, None
+        )
+        for input_index in range(num_inputs)
+        for devid in range(1, num_nodes + 1)
+    ]
+    python_secs, python_results = time_cycles(build_graph(num_inputs, None), stats)
+    numpy_secs, numpy_results = time_cycles(
+        build_graph(num_inputs, NodeStatArraysLayout()), stats
+    )
+    for python_stat, numpy_stat in zip(python_results, numpy_results):
+        value_diff = abs(python_stat.value - numpy_stat.value)
+        if python_stat.time != numpy_stat.time or value_diff > 1e-6 * abs(
+            python_stat.value
+        ):
+            print(
+                "ERROR: the engines computed different values for %s: %s != %s."
+                % (python_stat.key, python_stat.value, numpy_stat.value),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    print(
+        "%d nodes, %d inputs, %d composite stats."
+        % (num_nodes, num_inputs, len(numpy_results))
+    )
+    print("python engine: %8.2f ms/cycle" % (python_secs * 1000.0))
+    print("numpy engine:  %8.2f ms/cycle" % (numpy_secs * 1000.0))
+    print("speedup:       %8.1fx" % (python_secs / numpy_secs))
+
+
+if __name__ == "__main__":
+    main()
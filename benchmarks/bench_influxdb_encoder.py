@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to turn a cycle of stats into the body of InfluxDB
+write requests by building a JSON point per stat and serializing it with the
+influxdb package, which is what the influxdb_plugin used to do, and with the
+influxdb_plugin's line protocol encoder.
+Usage: bench_influxdb_encoder.py [num_points]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from influxdb.line_protocol import make_lines  # noqa: E402
+
+import influxdb_plugin  # noqa: E402
+from isi_stats_client import StatRecord  # noqa: E402
+
+NUM_CYCLES = 5
+NUM_NODES = 144
+# every DICT_STAT_INTERVAL-th stat has a dict value
+DICT_STAT_INTERVAL = 20
+# number of points per write of the old influxdb_plugin
+LEGACY_POINTS_PER_WRITE = 100
+
+
+def legacy_points_from_stat(cluster, stat):
+    """
+    The JSON points that the influxdb_plugin used to build for a stat.
+    """
+    tags = {"cluster": cluster}
+    if stat.devid != 0:
+        tags["node"] = stat.devid
+    fields = []
+    if isinstance(stat.value, dict):
+        point_tags = tags.copy()
+        influxdb_plugin._process_stat_dict(stat.value, fields, point_tags)
+    else:
+        point_tags = tags.copy()
+        influxdb_plugin._add_field(fields, "value", stat.value, type(stat.value))
+    return [
+        {
+            "measurement": stat.key,
+            "tags": point_tags,
+            "time": stat.time * 1000000000,
+            "fields": dict(fields),
+        }
+    ]
+
+
+def legacy_cycle(stats):
+    points = []
+    bodies = []
+    for stat in stats:
+        points.extend(legacy_points_from_stat("bench", stat))
+        if len(points) >= LEGACY_POINTS_PER_WRITE:
+            bodies.append(make_lines({"points": points}).encode("utf-8"))
+            points = []
+    if points:
+        bodies.append(make_lines({"points": points}).encode("utf-8"))
+    return bodies
+
+
+def encoder_cycle(stats):
+    bodies = []
+    line_buffer = influxdb_plugin.LineBuffer()
+    for stat in stats:
+        influxdb_plugin._encode_stat(line_buffer, "bench", stat)
+        if len(line_buffer.measurements) >= influxdb_plugin.DEFAULT_BATCH_POINTS:
+            bodies.append(line_buffer.take()[0])
+    if line_buffer.measurements:
+        bodies.append(line_buffer.take()[0])
+    return bodies
+
+
+def time_cycles(cycle_func, stats):
+    cycle_func(stats)
+    start_time = time.time()
+    for _ in range(NUM_CYCLES):
+        bodies = cycle_func(stats)
+    return (time.time() - start_time) / NUM_CYCLES, bodies
+
+
+def normalize(bodies, time_divisor):
+    """
+    :returns: the sorted lines of the bodies with their timestamps in seconds.
+    """
+    lines = []
+    for body in bodies:
+        for line in body.decode("utf-8").splitlines():
+            series_and_fields, timestamp = line.rsplit(" ", 1)
+            lines.append("%s %d" % (series_and_fields, int(timestamp) // time_divisor))
+    return sorted(lines)
+
+
+def main():
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stats = []
+    for index in range(num_points):
+        key = "node.bench.stat%d" % (index // NUM_NODES)
+        devid = index % NUM_NODES + 1
+        if index % DICT_STAT_INTERVAL == 0:
+            value = {"op_name": "read", "op_count": index, "time_avg": index * 0.25}
+        elif index % 2 == 0:
+            value = index
+        else:
+            value = index * 1.5
+        stats.append(StatRecord(key, devid, 1500000000, value, None))
+
+    legacy_secs, legacy_bodies = time_cycles(legacy_cycle, stats)
+    encoder_secs, encoder_bodies = time_cycles(encoder_cycle, stats)
+    if normalize(legacy_bodies, 1000000000) != normalize(encoder_bodies, 1):
+        print("ERROR: the encoders encoded different points.", file=sys.stderr)
+        sys.exit(1)
+    num_bytes = sum(len(body) for body in encoder_bodies)
+    compress_start_time = time.time()
+    num_compressed_bytes = 0
+    for body in encoder_bodies:
+        compressor = zlib.compressobj(
+            influxdb_plugin.DEFAULT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+        num_compressed_bytes += len(compressor.compress(body) + compressor.flush())
+    compress_secs = time.time() - compress_start_time
+    print("%d points, %d bytes of line protocol." % (num_points, num_bytes))
+    print(
+        "%d writes of %d points before, %d writes of %d points now, "
+        "%d bytes gzipped in %.2f ms."
+        % (
+            len(legacy_bodies),
+            LEGACY_POINTS_PER_WRITE,
+            len(encoder_bodies),
+            influxdb_plugin.DEFAULT_BATCH_POINTS,
+            num_compressed_bytes,
+            compress_secs * 1000.0,
+        )
+    )
+    print(
+        "json + influxdb package: %8.2f ms/cycle %10.0f points/s"
+        % (legacy_secs * 1000.0, num_points / legacy_secs)
+    )
+    print(
+        "line protocol encoder:   %8.2f ms/cycle %10.0f points/s"
+        % (encoder_secs * 1000.0, num_points / encoder_secs)
+    )
+    print("speedup:                 %8.1fx" % (legacy_secs / encoder_secs))
+
+
+if __name__ == "__main__":
+    main()
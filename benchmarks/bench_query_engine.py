@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to turn a statistics/current response into stats
+that are ready to be processed with the sdk query engine (swagger model
+deserialization followed by decoding the stringified values) and with the
+json query engine (parse_stat_records).
+Usage: bench_query_engine.py [recorded_payload.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import isi_sdk_8_0  # noqa: E402
+from isi_stat_decoder import StatValueDecoder  # noqa: E402
+from isi_stats_client import parse_stat_records  # noqa: E402
+from payloads import load_payload  # noqa: E402
+
+NUM_CYCLES = 5
+
+
+class RecordedResponse(object):
+    """
+    Stands in for the RESTResponse that the ApiClient deserializes.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+def prep_stats(decoder, stats):
+    for stat in stats:
+        stat.value = decoder.decode(stat.key, stat.value)
+    return stats
+
+
+def time_cycles(func):
+    # the first cycle is where the decoder learns the shape of each key
+    func()
+    start_time = time.time()
+    for _ in range(NUM_CYCLES):
+        result = func()
+    return (time.time() - start_time) / NUM_CYCLES, result
+
+
+def main():
+    payload = load_payload(sys.argv[1] if len(sys.argv) > 1 else None)
+    response = RecordedResponse(payload)
+    payload_bytes = payload.encode("utf-8")
+    api_client = isi_sdk_8_0.ApiClient()
+
+    sdk_decoder = StatValueDecoder()
+    sdk_secs, sdk_stats = time_cycles(
+        lambda: prep_stats(
+            sdk_decoder, api_client.deserialize(response, "StatisticsCurrent").stats
+        )
+    )
+    json_decoder = StatValueDecoder()
+    json_secs, json_stats = time_cycles(
+        lambda: prep_stats(json_decoder, parse_stat_records(payload_bytes))
+    )
+
+    sdk_values = [(s.key, s.devid, s.time, s.value, s.error) for s in sdk_stats]
+    json_values = [(s.key, s.devid, s.time, s.value, s.error) for s in json_stats]
+    if sdk_values != json_values:
+        print("ERROR: the engines returned different stats.", file=sys.stderr)
+        sys.exit(1)
+    print("%d stats, %d bytes." % (len(json_stats), len(payload_bytes)))
+    print("sdk engine:   %8.2f ms/cycle" % (sdk_secs * 1000.0))
+    print("json engine:  %8.2f ms/cycle" % (json_secs * 1000.0))
+    print("speedup:      %8.1fx" % (sdk_secs / json_secs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to decode the stat values of a statistics/current
+payload with literal_eval (the old _prep_stat) and with StatValueDecoder.
+Usage: bench_stat_decoder.py [recorded_payload.json]
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from isi_stat_decoder import StatValueDecoder, _literal_decode  # noqa: E402
+from payloads import load_payload  # noqa: E402
+
+NUM_CYCLES = 5
+
+
+def main():
+    payload = load_payload(sys.argv[1] if len(sys.argv) > 1 else None)
+    # the Isilon SDK hands each stat value to the daemon as str(value)
+    stats = [(stat["key"], str(stat["value"])) for stat in json.loads(payload)["stats"]]
+    print("%d stats, %d bytes of values." % (len(stats), sum(len(v) for _, v in stats)))
+
+    start_time = time.time()
+    for _ in range(NUM_CYCLES):
+        expected = [_literal_decode(value) for _, value in stats]
+    literal_secs = (time.time() - start_time) / NUM_CYCLES
+
+    decoder = StatValueDecoder()
+    # the first cycle is where the decoder learns the shape of each key
+    start_time = time.time()
+    decoded = [decoder.decode(key, value) for key, value in stats]
+    learn_secs = time.time() - start_time
+    start_time = time.time()
+    for _ in range(NUM_CYCLES):
+        decoded = [decoder.decode(key, value) for key, value in stats]
+    decoder_secs = (time.time() - start_time) / NUM_CYCLES
+
+    if decoded != expected:
+        print("ERROR: decoded values differ from literal_eval.", file=sys.stderr)
+        sys.exit(1)
+    print("literal_eval:     %8.2f ms/cycle" % (literal_secs * 1000.0))
+    print("decoder (learn):  %8.2f ms/cycle" % (learn_secs * 1000.0))
+    print("decoder:          %8.2f ms/cycle" % (decoder_secs * 1000.0))
+    print("speedup:          %8.1fx" % (literal_secs / decoder_secs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Build synthetic statistics/current payloads shaped like the ones returned by
+the PAPI for the stats in the example config file, or load a recorded one.
+A recorded payload is the JSON body of a /platform/1/statistics/current
+response saved to a file.
+"""
+import json
+import random
+
+PROTOSTATS_OPS = (
+    "read",
+    "write",
+    "lookup",
+    "getattr",
+    "setattr",
+    "create",
+    "remove",
+    "rename",
+    "readdir",
+    "access",
+    "commit",
+    "fsinfo",
+    "fsstat",
+    "link",
+    "mkdir",
+    "rmdir",
+)
+CACHE_FIELDS = (
+    "l1_data_read_hit",
+    "l1_data_read_miss",
+    "l1_data_read_start",
+    "l1_data_prefetch_hit",
+    "l1_data_prefetch_miss",
+    "l1_data_prefetch_start",
+    "l1_meta_read_hit",
+    "l1_meta_read_miss",
+    "l1_meta_read_start",
+    "l2_data_read_hit",
+    "l2_data_read_miss",
+    "l2_data_read_start",
+    "l2_data_prefetch_hit",
+    "l2_data_prefetch_miss",
+    "l2_data_prefetch_start",
+    "l2_meta_read_hit",
+    "l2_meta_read_miss",
+    "l2_meta_read_start",
+    "l3_data_read_hit",
+    "l3_data_read_miss",
+    "l3_data_read_start",
+    "l3_meta_read_hit",
+    "l3_meta_read_miss",
+    "l3_meta_read_start",
+)
+SCALAR_KEYS = (
+    "node.load.1min",
+    "node.load.5min",
+    "node.load.15min",
+    "node.memory.used",
+    "node.memory.free",
+    "node.open.files",
+    "node.disk.busy.avg",
+    "node.disk.iosched.latency.avg",
+    "node.ifs.ops.in",
+    "node.ifs.ops.out",
+    "node.net.ext.bytes.in.rate",
+    "node.net.ext.bytes.out.rate",
+)
+PROTOSTATS_KEYS = (
+    "node.protostats.nfs",
+    "node.protostats.smb2",
+    "node.protostats.nfs4",
+    "node.protostats.hdfs",
+)
+
+
+def _protostats_value(rand):
+    return [
+        {
+            "class_name": "namespace_read",
+            "in_avg": rand.random() * 1000.0,
+            "in_max": rand.random() * 1000.0,
+            "in_min": 0.0,
+            "in_standard_dev": rand.random() * 100.0,
+            "op_count": rand.randint(0, 10 ** 9),
+            "op_id": op_id,
+            "op_name": op_name,
+            "op_rate": rand.random() * 10000.0,
+            "out_avg": rand.random() * 1000.0,
+            "out_max": rand.random() * 1000.0,
+            "out_min": 0.0,
+            "out_standard_dev": rand.random() * 100.0,
+            "time_avg": rand.random() * 5000.0,
+            "time_max": rand.random() * 50000.0,
+            "time_min": rand.random(),
+            "time_standard_dev": rand.random() * 500.0,
+        }
+        for op_id, op_name in enumerate(PROTOSTATS_OPS)
+    ]
+
+
+def synthetic_payload(num_nodes=150, seed=0):
+    """
+    Build the JSON body of a statistics/current query of SCALAR_KEYS,
+    node.ifs.cache and PROTOSTATS_KEYS on a cluster with num_nodes nodes.
+    """
+    rand = random.Random(seed)
+    timestamp = 1500000000
+    stats = []
+    for devid in range(1, num_nodes + 1):
+        for key in SCALAR_KEYS:
+            value = rand.random() * 100.0 if rand.random() < 0.5 else rand.randint(0, 10 ** 6)
+            stats.append(_stat(key, devid, timestamp, value))
+        stats.append(
+            _stat(
+                "node.ifs.cache",
+                devid,
+                timestamp,
+                {field: rand.randint(0, 10 ** 12) for field in CACHE_FIELDS},
+            )
+        )
+        for key in PROTOSTATS_KEYS:
+            stats.append(_stat(key, devid, timestamp, _protostats_value(rand)))
+    return json.dumps({"stats": stats})
+
+
+def _stat(key, devid, timestamp, value):
+    return {
+        "key": key,
+        "devid": devid,
+        "time": timestamp,
+        "value": value,
+        "error": None,
+        "error_code": None,
+    }
+
+
+def load_payload(path=None, num_nodes=150):
+    """
+    Load a recorded payload from path or build a synthetic one if path is None.
+    """
+    if path is None:
+        return synthetic_payload(num_nodes)
+    with open(path, "r") as payload_fp:
+        return payload_fp.read()
@@ -1,3 +1,4 @@
+from __future__ import division
 from __future__ import print_function
 from builtins import input
 from builtins import str
@@ -8,36 +9,219 @@ from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBServerError, InfluxDBClientError
 from ast import literal_eval
 
+import gevent
+import gevent.queue
 import getpass
 import logging
+import math
+import os
+import re
 import requests.exceptions
 import sys
+import time
+import zlib
 
+from isi_write_spool import DEFAULT_SPOOL_MAX_AGE, DEFAULT_SPOOL_MAX_BYTES, WriteSpool
+
+
+class LineBuffer(object):
+    """
+    The line protocol of the points that haven't been queued to be written
+    yet, in a bytearray that is reused for each batch of points.
+    """
+
+    __slots__ = ("lines", "measurements")
 
-class StatsProcessorState(object):
     def __init__(self):
-        self.influxdb_points = None
-        self.points_written = None
-        self.reset()
+        self.lines = bytearray()
+        # the measurement of each point, for the error messages
+        self.measurements = []
 
-    def reset(self):
-        self.influxdb_points = []
+    def append(self, line, measurement):
+        self.lines += line
+        self.measurements.append(measurement)
+
+    def take(self):
+        """
+        Empty the buffer.
+        :returns: a tuple of the lines and the list of their measurements.
+        """
+        lines = bytes(self.lines)
+        del self.lines[:]
+        measurements = self.measurements
+        self.measurements = []
+        return lines, measurements
+
+
+class BatchStats(object):
+    """
+    Counters of the batches of points that were written, see get_batch_stats.
+    """
+
+    def __init__(self):
+        self.batches_written = 0
         self.points_written = 0
+        self.bytes_written = 0
+        self.compressed_bytes_written = 0
+        self.failed_batches = 0
+        self.spooled_batches = 0
+        self.bisected_batches = 0
+        self.quarantined_points = 0
+        # fields that were skipped because their type conflicted with the
+        # registered type of the field and couldn't be converted to it
+        self.conflicting_fields = 0
+        self.replayed_batches = 0
+        self.replayed_points = 0
+        self.write_secs = 0.0
+        self.max_write_secs = 0.0
+        # reason -> number of batches that were sealed for that reason
+        self.sealed_batches = {
+            SEALED_BY_POINTS: 0,
+            SEALED_BY_BYTES: 0,
+            SEALED_BY_LINGER: 0,
+            SEALED_BY_STOP: 0,
+        }
 
 
-# influxdb_plugin state
-g_state = StatsProcessorState()
+class StatsProcessorState(object):
+    def __init__(self):
+        # the batch that the points of all clusters are added to until it is
+        # sealed and queued to be written
+        self.open_batch = LineBuffer()
+        # time at which the first point was added to the open batch
+        self.open_batch_time = None
+        # sealed batches that are waiting to be written by the writers
+        self.write_queue = None
+        self.writers = None
+        # the batch that each writer is writing, or None, so that the batches
+        # of the writers that are killed by stop can be spooled.
+        self.writer_batches = None
+        self.linger_flusher = None
+        self.replayer = None
+        # WriteSpool of the batches that failed to be written, or None
+        self.spool = None
+        self.stopping = False
+        self.points_written = 0
+        self.batch_stats = BatchStats()
+        # query params of the write requests
+        self.write_params = None
+        # (cluster, devid, stat key) of a stat with a single value or
+        # (measurement, tags...) of the points of other stats -> the escaped
+        # measurement and tags of the series, followed by a space.
+        self.series_cache = {}
+        # field name -> escaped field name followed by "="
+        self.field_key_cache = {}
+        # measurement -> dict of field name -> the FIELD_TYPE_* of the field,
+        # which is the type of its first value, or the type that InfluxDB
+        # reported in a field type conflict.
+        self.field_types = {}
+        # the batching settings, see start
+        self.batch_points = DEFAULT_BATCH_POINTS
+        self.batch_bytes = DEFAULT_BATCH_BYTES
+        self.batch_linger = DEFAULT_BATCH_LINGER
+        self.gzip_level = DEFAULT_GZIP_LEVEL
+        self.max_parallel_writes = DEFAULT_MAX_PARALLEL_WRITES
+        self.spool_dir = DEFAULT_SPOOL_DIR
+        self.spool_max_bytes = DEFAULT_SPOOL_MAX_BYTES
+        self.spool_max_age = DEFAULT_SPOOL_MAX_AGE
+        self.replay_rate = DEFAULT_REPLAY_RATE
+        self.quarantine_file = ""
+
 
 # InfluxDBClient interface
 g_client = None
 LOG = logging.getLogger(__name__)
 
-# Number of points to queue up before writing it to the database.
-MAX_POINTS_PER_WRITE = 100
+# A batch of points is sealed and queued to be written once it has
+# batch_points points or batch_bytes bytes of line protocol, or
+# batch_linger seconds after its first point was added, whichever comes
+# first. The batches are coalesced across clusters.
+DEFAULT_BATCH_POINTS = 5000
+DEFAULT_BATCH_BYTES = 1048576
+DEFAULT_BATCH_LINGER = 1.0
+# zlib level (1-9) of the gzip compression of the request bodies, 0 to not
+# compress them.
+DEFAULT_GZIP_LEVEL = 1
+# Max number of batches that are written at once.
+DEFAULT_MAX_PARALLEL_WRITES = 4
+# The batches that fail to be written because the InfluxDB is down or
+# overloaded are spooled to spool_dir, unless it is empty, and replayed at up
+# to replay_rate points per second once it has recovered.
+DEFAULT_SPOOL_DIR = "./isi_data_insights_d_spool"
+DEFAULT_REPLAY_RATE = 20000
+# Number of seconds between checks for spooled batches, and the min and max
+# number of seconds to wait after a replay failed.
+REPLAY_POLL_INTERVAL = 5
+MIN_REPLAY_BACKOFF = 1
+MAX_REPLAY_BACKOFF = 60
+# The errors of the writes that might succeed later, e.g. because InfluxDB is
+# down, overloaded or unreachable, whose batches are spooled and replayed.
+RETRYABLE_WRITE_ERRORS = (
+    InfluxDBServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+# The batches that InfluxDB rejects with one of these status codes, e.g.
+# because of a field type conflict, are bisected to find the points that it
+# rejects, which are quarantined, i.e. counted and optionally appended to the
+# quarantine_file, while the rest of the points are written.
+BISECT_STATUS_CODES = (400, 413)
+# Max number of requests that are sent to bisect a batch, after which the
+# parts of the batch that are still rejected are quarantined as a whole.
+MAX_BISECT_REQUESTS = 64
+# the number of points that InfluxDB dropped, at the end of its errors, which
+# is ignored when the errors of two parts of a batch are compared.
+DROPPED_POINTS_RE = re.compile(r"\s*dropped=\d+")
+# Max size of the quarantine_file, beyond which no more points are appended.
+MAX_QUARANTINE_FILE_BYTES = 64 * 1024 * 1024
+FIELD_TYPE_FLOAT = "float"
+FIELD_TYPE_INTEGER = "integer"
+FIELD_TYPE_STRING = "string"
+FIELD_TYPE_BOOLEAN = "boolean"
+# e.g. partial write: field type conflict: input field "value" on measurement
+# "node.x" is type string, already exists as type float dropped=1, in which
+# the quotes might be escaped because the error is JSON encoded.
+FIELD_TYPE_CONFLICT_RE = re.compile(
+    r'input field \\*"(.+?)\\*" on measurement \\*"(.+?)\\*" is type (\w+), '
+    r"already exists as type (\w+)"
+)
+# Names of the optional name=value stats processor args of the settings above.
+BATCH_POINTS_ARG = "batch_points"
+BATCH_BYTES_ARG = "batch_bytes"
+BATCH_LINGER_ARG = "batch_linger"
+GZIP_LEVEL_ARG = "gzip_level"
+MAX_PARALLEL_WRITES_ARG = "max_parallel_writes"
+SPOOL_DIR_ARG = "spool_dir"
+SPOOL_MAX_BYTES_ARG = "spool_max_bytes"
+SPOOL_MAX_AGE_ARG = "spool_max_age"
+REPLAY_RATE_ARG = "replay_rate"
+QUARANTINE_FILE_ARG = "quarantine_file"
+# Reasons for sealing a batch.
+SEALED_BY_POINTS = "points"
+SEALED_BY_BYTES = "bytes"
+SEALED_BY_LINGER = "linger"
+SEALED_BY_STOP = "stop"
+# Max number of batches of points that are waiting to be written, beyond
+# which processing blocks until the writers catch up.
+MAX_QUEUED_WRITES = 100
+# Max number of seconds that stop() waits for the queued points to be written.
+STOP_TIMEOUT = 30
+# How often, in seconds, the batch stats are logged, see get_batch_stats.
+BATCH_STATS_LOG_INTERVAL = 300
+# Max number of series whose escaped measurement and tags are cached.
+MAX_CACHED_SERIES = 100000
+# The timestamps of the stats are in seconds.
+WRITE_PRECISION = "s"
+WRITE_HEADERS = {"Content-Type": "application/octet-stream", "Accept": "text/plain"}
+GZIP_WRITE_HEADERS = dict(WRITE_HEADERS, **{"Content-Encoding": "gzip"})
 # separator used to concatenate stat keys with sub-keys derived from stats
 # whose value is a dict or list.
 SUB_KEY_SEPARATOR = "."
 
+# influxdb_plugin state
+g_state = StatsProcessorState()
+
 
 def start(argv):
     """
@@ -45,7 +229,13 @@ def start(argv):
     port of the InfluxDB and the name of the database to use. If the database
     does not exist then it will be created. If the fourth arg is "auth" then it
     will prompt the user for the InfluxDB's username and password.
+    The batching of the writes and the spool can be configured with optional
+    name=value args anywhere in argv, e.g. batch_points=5000
+    batch_bytes=1048576 batch_linger=1.0 gzip_level=1 max_parallel_writes=4
+    spool_dir=./isi_data_insights_d_spool spool_max_bytes=1073741824
+    spool_max_age=604800 replay_rate=20000 quarantine_file=./quarantine.txt.
     """
+    argv = _parse_batch_args(argv)
     influxdb_host = argv[0]
     influxdb_port = int(argv[1])
     influxdb_name = argv[2]
@@ -105,6 +295,71 @@ def start(argv):
     if create_database is True:
         LOG.info("Creating database: %s.", influxdb_name)
         g_client.create_database(influxdb_name)
+    g_state.write_params = {"db": influxdb_name, "precision": WRITE_PRECISION}
+    if g_state.quarantine_file:
+        g_state.quarantine_file = os.path.abspath(g_state.quarantine_file)
+    if g_state.spool_dir:
+        spool_dir = os.path.abspath(g_state.spool_dir)
+        try:
+            g_state.spool = WriteSpool(
+                spool_dir, g_state.spool_max_bytes, g_state.spool_max_age
+            )
+        except (IOError, OSError) as exc:
+            print(
+                "Failed to open the InfluxDB spool directory %s.\nERROR: %s"
+                % (spool_dir, str(exc)),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    LOG.info(
+        "Writing batches of up to %d points or %d bytes, after at most %s "
+        "seconds, with up to %d writes in parallel, gzip_level=%d.",
+        g_state.batch_points,
+        g_state.batch_bytes,
+        str(g_state.batch_linger),
+        g_state.max_parallel_writes,
+        g_state.gzip_level,
+    )
+
+
+def _parse_batch_args(argv):
+    """
+    Parse the name=value args of the batching and spool settings into
+    g_state.
+    :returns: the rest of the args.
+    """
+    batch_args = {
+        BATCH_POINTS_ARG: ("batch_points", int, 1),
+        BATCH_BYTES_ARG: ("batch_bytes", int, 1),
+        BATCH_LINGER_ARG: ("batch_linger", float, 0.01),
+        GZIP_LEVEL_ARG: ("gzip_level", int, 0),
+        MAX_PARALLEL_WRITES_ARG: ("max_parallel_writes", int, 1),
+        SPOOL_DIR_ARG: ("spool_dir", str, ""),
+        SPOOL_MAX_BYTES_ARG: ("spool_max_bytes", int, 1),
+        SPOOL_MAX_AGE_ARG: ("spool_max_age", int, 1),
+        REPLAY_RATE_ARG: ("replay_rate", float, 1.0),
+        QUARANTINE_FILE_ARG: ("quarantine_file", str, ""),
+    }
+    other_args = []
+    for arg in argv:
+        arg_name, _, arg_value = arg.partition("=")
+        if arg_name not in batch_args:
+            other_args.append(arg)
+            continue
+        attr_name, arg_type, min_value = batch_args[arg_name]
+        try:
+            value = arg_type(arg_value)
+            if value < min_value or (arg_name == GZIP_LEVEL_ARG and value > 9):
+                raise ValueError("%s is out of range." % arg_value)
+        except ValueError as exc:
+            print(
+                "Invalid InfluxDB stats processor arg %s.\nERROR: %s"
+                % (arg, str(exc)),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        setattr(g_state, attr_name, value)
+    return other_args
 
 
 def begin_process(cluster):
@@ -113,37 +368,170 @@ def begin_process(cluster):
 
 def process_stat(cluster, stat):
     """
-    Convert Isilon stat query result to InfluxDB point and send to the
-    InfluxDB service. Organize the measurements by cluster and node via tags.
+    Encode the Isilon stat query result as InfluxDB line protocol and send it
+    to the InfluxDB service. Organize the measurements by cluster and node via
+    tags.
     """
-    # Process stat(s) and then write points if list is large enough.
-    tags = {"cluster": cluster}
-    if stat.devid != 0:
-        tags["node"] = stat.devid
-
-    influxdb_points = _influxdb_points_from_stat(stat.time, tags, stat.key, stat.value)
-    if influxdb_points == []:
-        return
-    for influxdb_point in influxdb_points:
-        if len(influxdb_point["fields"]) > 0:
-            g_state.influxdb_points.append(influxdb_point)
-            num_points = len(g_state.influxdb_points)
-            if num_points > MAX_POINTS_PER_WRITE:
-                g_state.points_written += _write_points(
-                    g_state.influxdb_points, num_points
-                )
-                g_state.influxdb_points = []
+    line_buffer = g_state.open_batch
+    if not line_buffer.measurements:
+        g_state.open_batch_time = time.time()
+    _encode_stat(line_buffer, cluster, stat)
+    # queue the batch if it is large enough.
+    if len(line_buffer.measurements) >= g_state.batch_points:
+        _seal_batch(SEALED_BY_POINTS)
+    elif len(line_buffer.lines) >= g_state.batch_bytes:
+        _seal_batch(SEALED_BY_BYTES)
 
 
 def end_process(cluster):
-    # send left over points to influxdb
-    num_points = len(g_state.influxdb_points)
-    if num_points > 0:
-        g_state.points_written += _write_points(g_state.influxdb_points, num_points)
+    # the left over points are written with the next batch, or once the
+    # batch has lingered for batch_linger seconds.
+    if g_state.open_batch.measurements and g_state.linger_flusher is None:
+        _start_writers()
     LOG.debug(
-        "Done processing %s stats, wrote %d points.", cluster, g_state.points_written
+        "Done processing %s stats, wrote %d points so far.",
+        cluster,
+        g_state.points_written,
     )
-    g_state.reset()
+
+
+def get_batch_stats():
+    """
+    :returns: a dict of the counters of the batches of points that were
+    written, and the number of batches that are waiting to be written.
+    """
+    batch_stats = dict(vars(g_state.batch_stats))
+    batch_stats["sealed_batches"] = dict(batch_stats["sealed_batches"])
+    batch_stats["queued_batches"] = (
+        g_state.write_queue.qsize() if g_state.write_queue is not None else 0
+    )
+    batch_stats["open_batch_points"] = len(g_state.open_batch.measurements)
+    if g_state.spool is not None:
+        batch_stats["spool_bytes"] = g_state.spool.num_bytes()
+        batch_stats["spool_dropped_bytes"] = g_state.spool.dropped_bytes
+    return batch_stats
+
+
+def stop():
+    """
+    Write the points that are still queued, waiting at most STOP_TIMEOUT
+    seconds.
+    """
+    g_state.stopping = True
+    if g_state.open_batch.measurements:
+        _seal_batch(SEALED_BY_STOP)
+    if g_state.writers is None:
+        if g_state.spool is not None:
+            g_state.spool.close()
+        return
+    LOG.info(
+        "Writing %d queued batches of points to InfluxDB.", g_state.write_queue.qsize()
+    )
+    with gevent.Timeout(STOP_TIMEOUT, False):
+        for _ in g_state.writers:
+            g_state.write_queue.put(None)
+        gevent.joinall(g_state.writers)
+    # the batches that the writers that didn't finish are still writing
+    unwritten_batches = [
+        batch
+        for writer, batch in zip(g_state.writers, g_state.writer_batches)
+        if batch is not None and not writer.ready()
+    ]
+    num_unwritten = g_state.write_queue.qsize() + len(unwritten_batches)
+    if num_unwritten > 0 or any(not writer.ready() for writer in g_state.writers):
+        LOG.warning(
+            "Timed out writing points to InfluxDB after %d seconds, "
+            "%d batches of points were not written.",
+            STOP_TIMEOUT,
+            num_unwritten,
+        )
+    greenlets = g_state.writers + [g_state.linger_flusher, g_state.replayer]
+    gevent.killall([greenlet for greenlet in greenlets if greenlet is not None])
+    g_state.writers = None
+    g_state.writer_batches = None
+    g_state.linger_flusher = None
+    g_state.replayer = None
+    if g_state.spool is not None:
+        # the batches that weren't written are replayed after the restart,
+        # including the ones that the killed writers were writing, some of
+        # whose points might be written twice, which just overwrites them with
+        # the same values.
+        while not g_state.write_queue.empty():
+            batch = g_state.write_queue.get()
+            if batch is not None:
+                unwritten_batches.append(batch)
+        for batch in unwritten_batches:
+            _spool_points(batch[0], len(batch[1]))
+        g_state.spool.close()
+    LOG.info("Wrote %d points, batch stats: %s", g_state.points_written, get_batch_stats())
+
+
+def _start_writers():
+    # the writers are started on first use rather than in start() because
+    # the process is daemonized after start() is called.
+    g_state.write_queue = gevent.queue.Queue(MAX_QUEUED_WRITES)
+    g_state.writer_batches = [None] * g_state.max_parallel_writes
+    g_state.writers = [
+        gevent.spawn(_writer_loop, writer_index)
+        for writer_index in range(g_state.max_parallel_writes)
+    ]
+    g_state.linger_flusher = gevent.spawn(_linger_loop)
+    if g_state.spool is not None:
+        g_state.replayer = gevent.spawn(_replay_loop)
+
+
+def _seal_batch(reason):
+    """
+    Queue the open batch to be written by the writers, blocking if the queue
+    is full.
+    """
+    if g_state.writers is None:
+        _start_writers()
+    g_state.batch_stats.sealed_batches[reason] += 1
+    batch = g_state.open_batch.take()
+    if g_state.write_queue.full():
+        LOG.debug("InfluxDB write queue is full, waiting for the writers.")
+    g_state.write_queue.put(batch)
+
+
+def _linger_loop():
+    """
+    Seal the open batch once it has lingered for batch_linger seconds, and log
+    the batch stats every BATCH_STATS_LOG_INTERVAL seconds.
+    """
+    next_stats_log_time = time.time() + BATCH_STATS_LOG_INTERVAL
+    while not g_state.stopping:
+        if time.time() >= next_stats_log_time:
+            LOG.info("InfluxDB batch stats: %s", get_batch_stats())
+            next_stats_log_time = time.time() + BATCH_STATS_LOG_INTERVAL
+        linger_secs = g_state.batch_linger
+        if g_state.open_batch.measurements:
+            linger_secs -= time.time() - g_state.open_batch_time
+            if linger_secs <= 0:
+                _seal_batch(SEALED_BY_LINGER)
+                continue
+        gevent.sleep(linger_secs)
+
+
+def _writer_loop(writer_index):
+    while True:
+        batch = g_state.write_queue.get()
+        if batch is None:
+            return
+        g_state.writer_batches[writer_index] = batch
+        try:
+            # _write_points yields to the other writers, so add its result after.
+            points_written = _write_points(*batch)
+            g_state.points_written += points_written
+        except Exception as exc:
+            # keep the writer alive, otherwise processing blocks once the
+            # queue is full.
+            LOG.error(
+                "Unexpected error writing points: %s\nError: %s",
+                " ".join(batch[1]),
+                str(exc),
+            )
+        g_state.writer_batches[writer_index] = None
 
 
 def _add_field(fields, field_name, field_value, field_value_type):
@@ -205,109 +593,471 @@ def _process_stat_list(stat_value, fields, tags, prefix=""):
                 _add_field(fields, item_name, list_value, value_type)
 
 
-def _influxdb_points_from_stat(stat_time, tags, stat_key, stat_value):
+def _escape_key(key):
+    """
+    Escape a measurement, tag key, tag value or field key the same way as the
+    influxdb package does.
+    """
+    return (
+        key.replace("\\", "\\\\")
+        .replace(" ", "\\ ")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace("\n", "\\n")
+    )
+
+
+def _encode_series(measurement, tags):
+    """
+    Encode the measurement and the tags, sorted by key as InfluxDB prefers.
+    """
+    series = [_escape_key(measurement)]
+    for tag_key in sorted(tags.keys()):
+        tag_value = _escape_key(str(tags[tag_key]))
+        if tag_key and tag_value:
+            series.append(_escape_key(tag_key) + "=" + tag_value)
+    return (",".join(series) + " ").encode("utf-8")
+
+
+def _get_series(series_key, measurement, tags):
+    try:
+        return g_state.series_cache[series_key]
+    except KeyError:
+        pass
+    if len(g_state.series_cache) >= MAX_CACHED_SERIES:
+        g_state.series_cache.clear()
+    encoded_series = g_state.series_cache[series_key] = _encode_series(
+        measurement, tags
+    )
+    return encoded_series
+
+
+def _encode_field_value(field_value):
     """
-    Create InfluxDB points/measurements from the stat query result.
+    :returns: the encoded field value or None if the field has no valid value.
     """
-    points = []
-    fields = []
+    field_value_type = type(field_value)
+    if field_value_type == float:
+        # InfluxDB doesn't accept NaN or infinite values
+        if math.isnan(field_value) or math.isinf(field_value):
+            return None
+        return repr(field_value).encode("utf-8")
+    if field_value_type == int:
+        # see _add_field
+        return repr(float(field_value)).encode("utf-8")
+    if field_value_type == bool:
+        return b"true" if field_value else b"false"
+    if field_value is None or field_value == "":
+        return None
+    if isinstance(field_value, string_types):
+        return (
+            '"%s"'
+            % field_value.replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        ).encode("utf-8")
+    try:
+        return _encode_field_value(float(field_value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _field_type(encoded_value):
+    first_char = encoded_value[:1]
+    if first_char == b'"':
+        return FIELD_TYPE_STRING
+    if first_char == b"t" or first_char == b"f":
+        return FIELD_TYPE_BOOLEAN
+    if encoded_value[-1:] == b"i":
+        return FIELD_TYPE_INTEGER
+    return FIELD_TYPE_FLOAT
+
+
+def _check_field_type(measurement, field_name, field_value, encoded_value):
+    """
+    Register the type of the field on first use and convert the later values
+    of the field to that type, because InfluxDB rejects a point whose field
+    has a different type than the existing values of the field.
+    :returns: the encoded value with the registered type, or None if it
+    can't be converted to the registered type.
+    """
+    try:
+        measurement_types = g_state.field_types[measurement]
+    except KeyError:
+        if len(g_state.field_types) >= MAX_CACHED_SERIES:
+            g_state.field_types.clear()
+        measurement_types = g_state.field_types[measurement] = {}
+    field_type = _field_type(encoded_value)
+    registered_type = measurement_types.setdefault(field_name, field_type)
+    if registered_type == field_type:
+        return encoded_value
+    encoded_value = _convert_field_value(field_value, registered_type)
+    if encoded_value is None:
+        g_state.batch_stats.conflicting_fields += 1
+        LOG.debug(
+            "Skipping field %s of %s, %r can't be converted to %s.",
+            field_name,
+            measurement,
+            field_value,
+            registered_type,
+        )
+    return encoded_value
+
+
+def _convert_field_value(field_value, field_type):
+    try:
+        if field_type == FIELD_TYPE_FLOAT:
+            return _encode_field_value(float(field_value))
+        if field_type == FIELD_TYPE_INTEGER:
+            number = float(field_value)
+            if number.is_integer():
+                return b"%di" % int(number)
+        elif field_type == FIELD_TYPE_STRING:
+            return _encode_field_value(str(field_value))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return None
+
+
+def _encode_stat(line_buffer, cluster, stat):
+    """
+    Encode the InfluxDB points/measurements of the stat query result.
+    """
+    stat_value = stat.value
     stat_value_type = type(stat_value)
     if stat_value_type == list:
-        for stat in stat_value:
-            (fields, point_tags) = _influxdb_point_from_stat(
-                stat_time, tags, stat_key, stat
-            )
-            points.append(
-                _build_influxdb_point(stat_time, point_tags, stat_key, fields)
-            )
+        for list_value in stat_value:
+            point_tags = _stat_tags(cluster, stat)
+            fields = []
+            list_value_type = type(list_value)
+            if list_value_type == dict:
+                _process_stat_dict(list_value, fields, point_tags)
+            elif list_value_type == list:
+                _process_stat_list(list_value, fields, point_tags)
+            else:
+                fields.append(("value", list_value))
+            _encode_point(line_buffer, stat.key, point_tags, fields, stat.time)
     elif stat_value_type == dict:
-        point_tags = tags.copy()
+        point_tags = _stat_tags(cluster, stat)
+        fields = []
         _process_stat_dict(stat_value, fields, point_tags)
-        points.append(_build_influxdb_point(stat_time, point_tags, stat_key, fields))
+        _encode_point(line_buffer, stat.key, point_tags, fields, stat.time)
     else:
-        if stat_value == "":
-            return None  # InfluxDB does not like empty string stats
-        _add_field(fields, "value", stat_value, stat_value_type)
-        points.append(_build_influxdb_point(stat_time, tags.copy(), stat_key, fields))
-    return points
+        # fast path for the stats with a single value
+        encoded_value = _encode_field_value(stat_value)
+        if encoded_value is None:
+            return
+        encoded_value = _check_field_type(stat.key, "value", stat_value, encoded_value)
+        if encoded_value is None:
+            return
+        series_key = (cluster, stat.devid, stat.key)
+        try:
+            encoded_series = g_state.series_cache[series_key]
+        except KeyError:
+            encoded_series = _get_series(
+                series_key, stat.key, _stat_tags(cluster, stat)
+            )
+        line_buffer.append(
+            b"%svalue=%s %d\n" % (encoded_series, encoded_value, int(stat.time)),
+            stat.key,
+        )
+
+
+def _stat_tags(cluster, stat):
+    tags = {"cluster": cluster}
+    if stat.devid != 0:
+        tags["node"] = stat.devid
+    return tags
+
+
+def _encode_point(line_buffer, measurement, tags, fields, stat_time):
+    encoded_fields = []
+    for field_name, field_value in sorted(fields):
+        encoded_value = _encode_field_value(field_value)
+        if encoded_value is None:
+            continue
+        encoded_value = _check_field_type(
+            measurement, field_name, field_value, encoded_value
+        )
+        if encoded_value is None:
+            continue
+        try:
+            encoded_key = g_state.field_key_cache[field_name]
+        except KeyError:
+            if len(g_state.field_key_cache) >= MAX_CACHED_SERIES:
+                g_state.field_key_cache.clear()
+            encoded_key = g_state.field_key_cache[field_name] = (
+                _escape_key(field_name) + "="
+            ).encode("utf-8")
+        encoded_fields.append(encoded_key + encoded_value)
+    if not encoded_fields:
+        return
+    series_key = (measurement,) + tuple(sorted(tags.items()))
+    line_buffer.append(
+        b"%s%s %d\n"
+        % (
+            _get_series(series_key, measurement, tags),
+            b",".join(encoded_fields),
+            int(stat_time),
+        ),
+        measurement,
+    )
 
 
-def _influxdb_point_from_stat(stat_time, tags, stat_key, stat_value):
+def _post_points(lines):
     """
-    Create InfluxDB points/measurements from the stat query result.
+    POST the line protocol of the points to the /write endpoint, over the
+    InfluxDBClient's pooled connections, compressed with gzip unless the
+    gzip_level is 0.
+    :returns: the number of bytes that were sent.
     """
-    point_tags = tags.copy()
-    fields = []
-    stat_value_type = type(stat_value)
-    if stat_value_type == dict:
-        _process_stat_dict(stat_value, fields, point_tags)
-    elif stat_value_type == list:
-        _process_stat_list(stat_value, fields, point_tags)
+    if g_state.gzip_level > 0:
+        # wbits of 16 + MAX_WBITS selects the gzip format
+        compressor = zlib.compressobj(g_state.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(lines) + compressor.flush()
+        headers = GZIP_WRITE_HEADERS
     else:
-        if stat_value == "":
-            return None  # InfluxDB does not like empty string stats
-        _add_field(fields, "value", stat_value, stat_value_type)
-    return (fields, point_tags)
+        data = lines
+        headers = WRITE_HEADERS
+    g_client.request(
+        url="write",
+        method="POST",
+        params=g_state.write_params,
+        data=data,
+        expected_response_code=204,
+        headers=headers,
+    )
+    return len(data)
 
 
-def _build_influxdb_point(unix_ts_secs, tags, measurement, fields):
+def _write_points(lines, measurements):
     """
-    Build the json for an InfluxDB data point.
+    Write the points, or spool them if the InfluxDB is down or overloaded.
+    :returns: the number of points written.
     """
-    timestamp_ns = unix_ts_secs * 1000000000  # convert to nanoseconds
-    point_json = {
-        "measurement": measurement,
-        "tags": tags,
-        "time": timestamp_ns,
-        "fields": {},
-    }
+    LOG.debug("Writing points %d", len(measurements))
+    batch_stats = g_state.batch_stats
+    start_time = time.time()
+    try:
+        compressed_bytes = _post_points(lines)
+        write_secs = time.time() - start_time
+        batch_stats.batches_written += 1
+        batch_stats.points_written += len(measurements)
+        batch_stats.bytes_written += len(lines)
+        batch_stats.compressed_bytes_written += compressed_bytes
+        batch_stats.write_secs += write_secs
+        if write_secs > batch_stats.max_write_secs:
+            batch_stats.max_write_secs = write_secs
+        return len(measurements)
+    except RETRYABLE_WRITE_ERRORS as retry_exc:
+        LOG.error(
+            "%s: %s\nFailed to write points: %s",
+            type(retry_exc).__name__,
+            str(retry_exc),
+            " ".join(measurements),
+        )
+        _spool_points(lines, len(measurements))
+    except InfluxDBClientError as client_exc:
+        if client_exc.code in BISECT_STATUS_CODES:
+            points_written = _write_bisected_points(lines, client_exc)
+            # the batch only counts as written if none of its points were
+            # quarantined, dropped or spooled.
+            if points_written == len(measurements):
+                batch_stats.batches_written += 1
+            else:
+                batch_stats.failed_batches += 1
+            return points_written
+        LOG.error(
+            "InfluxDBClientError writing points: %s\n" "Error: %s",
+            " ".join(measurements),
+            str(client_exc),
+        )
+    batch_stats.failed_batches += 1
+    return 0
 
-    for field_name, field_value in fields:
-        point_json["fields"][field_name] = field_value
 
-    return point_json
+def _write_bisected_points(lines, client_exc):
+    """
+    Bisect the lines of a batch that InfluxDB rejected, until the points that
+    it rejects are isolated and quarantined, and write the rest of them. A
+    part of the batch whose halves are both rejected for the same reason,
+    e.g. because all of its points are beyond the retention policy, isn't
+    bisected any further and is quarantined as a whole, and so are the
+    rejected parts that are left after MAX_BISECT_REQUESTS requests.
+    :param InfluxDBClientError client_exc: the error of the whole batch.
+    :returns: the number of points written.
+    """
+    g_state.batch_stats.bisected_batches += 1
+    _register_conflicting_field_type(client_exc)
+    points_written = 0
+    num_quarantined = 0
+    num_requests = 0
+    batch_lines = lines.splitlines(True)
+    # list of (lines, error) of the parts of the batch that were rejected
+    rejected_parts = [(batch_lines, client_exc)]
+    while rejected_parts:
+        part_lines, part_exc = rejected_parts.pop()
+        if len(part_lines) == 1 or num_requests >= MAX_BISECT_REQUESTS:
+            _quarantine_points(part_lines, part_exc)
+            num_quarantined += len(part_lines)
+            continue
+        middle = len(part_lines) // 2
+        rejected_halves = []
+        for half_lines in (part_lines[middle:], part_lines[:middle]):
+            num_requests += 1
+            try:
+                _post_points(b"".join(half_lines))
+                points_written += len(half_lines)
+                g_state.batch_stats.points_written += len(half_lines)
+            except InfluxDBClientError as half_exc:
+                if half_exc.code in BISECT_STATUS_CODES:
+                    _register_conflicting_field_type(half_exc)
+                    rejected_halves.append((half_lines, half_exc))
+                else:
+                    LOG.error(
+                        "InfluxDBClientError writing %d points: %s",
+                        len(half_lines),
+                        str(half_exc),
+                    )
+            except RETRYABLE_WRITE_ERRORS as exc:
+                LOG.error("Failed to write %d points: %s", len(half_lines), str(exc))
+                _spool_points(b"".join(half_lines), len(half_lines))
+        if len(rejected_halves) == 2 and _rejection_reason(
+            rejected_halves[0][1]
+        ) == _rejection_reason(rejected_halves[1][1]):
+            _quarantine_points(part_lines, rejected_halves[0][1])
+            num_quarantined += len(part_lines)
+        else:
+            rejected_parts.extend(rejected_halves)
+    if num_quarantined > 0:
+        LOG.error(
+            "InfluxDB rejected %d of %d points of a batch, quarantined them "
+            "after %d requests.\nError: %s",
+            num_quarantined,
+            len(batch_lines),
+            num_requests + 1,
+            str(client_exc),
+        )
+    return points_written
 
 
-def _get_point_names(points):
-    names = ""
-    for point in points:
-        names += point["measurement"]
-        names += " "
-    return names
+def _rejection_reason(client_exc):
+    return DROPPED_POINTS_RE.sub("", str(client_exc))
 
 
-def _write_points(points, num_points):
+def _register_conflicting_field_type(client_exc):
     """
-    Write the points to the InfluxDB in groups that are MAX_POINTS_PER_WRITE in
-    size.
+    Register the existing type of the field of a field type conflict, so that
+    the later values of the field are converted to that type.
     """
-    LOG.debug("Writing points %d", num_points)
-    write_index = 0
-    points_written = 0
-    while write_index < num_points:
-        max_write_index = write_index + MAX_POINTS_PER_WRITE
-        write_points = points[write_index:max_write_index]
-        try:
-            g_client.write_points(write_points)
-            points_written += len(write_points)
-        except InfluxDBServerError as svr_exc:
-            LOG.error(
-                "InfluxDBServerError: %s\nFailed to write points: %s",
-                str(svr_exc),
-                _get_point_names(write_points),
-            )
-        except InfluxDBClientError as client_exc:
-            LOG.error(
-                "InfluxDBClientError writing points: %s\n" "Error: %s",
-                _get_point_names(write_points),
-                str(client_exc),
-            )
-        except requests.exceptions.ConnectionError as req_exc:
-            LOG.error(
-                "ConnectionError exception caught writing points: %s\n" "Error: %s",
-                _get_point_names(write_points),
-                str(req_exc),
+    match = FIELD_TYPE_CONFLICT_RE.search(str(client_exc))
+    if match is None:
+        return
+    field_name, measurement, _, existing_type = match.groups()
+    measurement_types = g_state.field_types.setdefault(measurement, {})
+    if measurement_types.get(field_name) == existing_type:
+        return
+    LOG.warning(
+        "Field %s of %s already exists as type %s in InfluxDB, converting its "
+        "values to %s.",
+        field_name,
+        measurement,
+        existing_type,
+        existing_type,
+    )
+    measurement_types[field_name] = existing_type
+
+
+def _quarantine_points(lines, client_exc):
+    g_state.batch_stats.quarantined_points += len(lines)
+    LOG.debug(
+        "InfluxDB rejected %d points: %s\nError: %s",
+        len(lines),
+        b"".join(lines).decode("utf-8", "replace"),
+        str(client_exc),
+    )
+    if not g_state.quarantine_file:
+        return
+    try:
+        if (
+            os.path.exists(g_state.quarantine_file)
+            and os.path.getsize(g_state.quarantine_file) >= MAX_QUARANTINE_FILE_BYTES
+        ):
+            return
+        with open(g_state.quarantine_file, "ab") as quarantine_fp:
+            # the error is a comment, which the influx CLI's -import skips
+            quarantine_fp.write(
+                ("# %d %s\n" % (int(time.time()), str(client_exc).replace("\n", " ")))
+                .encode("utf-8")
             )
-        write_index += MAX_POINTS_PER_WRITE
+            quarantine_fp.writelines(lines)
+    except (IOError, OSError) as exc:
+        LOG.error(
+            "Failed to write to quarantine file %s: %s",
+            g_state.quarantine_file,
+            str(exc),
+        )
 
-    return points_written
+
+def _spool_points(lines, num_points):
+    if g_state.spool is None:
+        return
+    try:
+        g_state.spool.append(lines, num_points)
+    except (IOError, OSError) as exc:
+        LOG.error(
+            "Failed to spool %d points to %s: %s",
+            num_points,
+            g_state.spool.directory,
+            str(exc),
+        )
+        return
+    g_state.batch_stats.spooled_batches += 1
+    LOG.info("Spooled %d points to replay later.", num_points)
+
+
+def _replay_loop():
+    """
+    Replay the spooled batches oldest first, at up to replay_rate points per
+    second and only while the live batches are keeping up, so that the
+    InfluxDB isn't overwhelmed when it recovers.
+    """
+    backoff = MIN_REPLAY_BACKOFF
+    while not g_state.stopping:
+        if g_state.write_queue.qsize() > 0:
+            gevent.sleep(MIN_REPLAY_BACKOFF)
+            continue
+        record = g_state.spool.peek()
+        if record is None:
+            gevent.sleep(REPLAY_POLL_INTERVAL)
+            continue
+        position, lines, num_points = record
+        try:
+            _post_points(lines)
+        except RETRYABLE_WRITE_ERRORS as exc:
+            LOG.debug("Failed to replay spooled points, retrying: %s", str(exc))
+            gevent.sleep(backoff)
+            backoff = min(backoff * 2, MAX_REPLAY_BACKOFF)
+            continue
+        except InfluxDBClientError as client_exc:
+            if client_exc.code in BISECT_STATUS_CODES:
+                num_points = _write_bisected_points(lines, client_exc)
+                g_state.batch_stats.replayed_batches += 1
+                g_state.batch_stats.replayed_points += num_points
+                g_state.points_written += num_points
+            else:
+                LOG.error(
+                    "InfluxDBClientError replaying %d spooled points, dropping "
+                    "them.\nError: %s",
+                    num_points,
+                    str(client_exc),
+                )
+        else:
+            g_state.batch_stats.replayed_batches += 1
+            g_state.batch_stats.replayed_points += num_points
+            g_state.points_written += num_points
+        backoff = MIN_REPLAY_BACKOFF
+        g_state.spool.commit(position)
+        if g_state.spool.is_empty():
+            LOG.info("Replayed all spooled points.")
+        gevent.sleep(num_points / g_state.replay_rate)
@@ -0,0 +1,327 @@
+"""
+Operations of the cluster composite stats, i.e. the stats that combine the
+values of a node.* stat across all of the nodes of a cluster, and an optional
+NumPy engine that computes all of the composite stats of a stat group in one
+vectorized pass.
+"""
+from __future__ import division
+from builtins import object
+import logging
+import math
+import warnings
+
+from past.utils import old_div
+
+from isi_data_insights_daemon import ClusterCompositeStatComputer, DerivedStatComputer
+from isi_stats_client import DERIVED_STAT_ERROR_CODE, StatRecord
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+LOG = logging.getLogger(__name__)
+
+COMPOSITE_ENGINE_PYTHON = "python"
+COMPOSITE_ENGINE_NUMPY = "numpy"
+COMPOSITE_ENGINES = (COMPOSITE_ENGINE_PYTHON, COMPOSITE_ENGINE_NUMPY)
+# initial number of node slots of the NodeStatArrays, which grows as needed.
+DEFAULT_NODE_SLOTS = 64
+
+
+def avg(stat_values):
+    # XXX investigate if plain '/' is OK here
+    return old_div(sum(stat_values), len(stat_values))
+
+
+def percentile(stat_values, percent):
+    """
+    Linearly interpolated percentile, which is also what NumPy computes by
+    default.
+    """
+    sorted_values = sorted(stat_values)
+    rank = (len(sorted_values) - 1) * percent / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (
+        rank - lower
+    )
+
+
+def median(stat_values):
+    return percentile(stat_values, 50)
+
+
+def p95(stat_values):
+    return percentile(stat_values, 95)
+
+
+def p99(stat_values):
+    return percentile(stat_values, 99)
+
+
+def stddev(stat_values):
+    # population standard deviation, like numpy.std
+    mean = sum(stat_values) / len(stat_values)
+    return math.sqrt(
+        sum((value - mean) * (value - mean) for value in stat_values)
+        / len(stat_values)
+    )
+
+
+def count_nonzero(stat_values):
+    return sum(1 for value in stat_values if value)
+
+
+# operations used by ClusterCompositeStatComputer
+COMPOSITE_OPERATIONS = {
+    "avg": avg,
+    "max": max,
+    "min": min,
+    "sum": sum,
+    "median": median,
+    "p95": p95,
+    "p99": p99,
+    "stddev": stddev,
+    "count_nonzero": count_nonzero,
+}
+
+# the operations that return the same type as the values, i.e. an int if all
+# of the values are ints. The other ones always return a float, except for
+# count_nonzero, which always returns an int. The numpy engine computes these
+# operations and count_nonzero of the inputs whose values are all ints with
+# Python, because the float64 arrays can't represent ints above 2**53 exactly,
+# e.g. byte counters, let alone their sum across the nodes.
+_TYPE_PRESERVING_OPERATIONS = ("avg", "max", "min", "sum")
+_EXACT_INT_OPERATIONS = _TYPE_PRESERVING_OPERATIONS + ("count_nonzero",)
+
+if numpy is not None:
+    # each operation takes a 2D array with one row per input stat and one
+    # column per node, in which the nodes without a value are NaN, and
+    # returns an array with one result per row.
+    _NUMPY_OPERATIONS = {
+        "avg": lambda values: numpy.nanmean(values, axis=1),
+        "max": lambda values: numpy.nanmax(values, axis=1),
+        "min": lambda values: numpy.nanmin(values, axis=1),
+        "sum": lambda values: numpy.nansum(values, axis=1),
+        "median": lambda values: numpy.nanmedian(values, axis=1),
+        "p95": lambda values: numpy.nanpercentile(values, 95, axis=1),
+        "p99": lambda values: numpy.nanpercentile(values, 99, axis=1),
+        "stddev": lambda values: numpy.nanstd(values, axis=1),
+        "count_nonzero": lambda values: numpy.count_nonzero(
+            numpy.logical_and(values != 0, ~numpy.isnan(values)), axis=1
+        ),
+    }
+
+
+class NodeStatArraysLayout(object):
+    """
+    The rows and operations of the NodeStatArrays of a stat group, which are
+    shared by all of the clusters of the stat group.
+    """
+
+    def __init__(self, num_node_slots=DEFAULT_NODE_SLOTS):
+        if numpy is None:
+            raise RuntimeError(
+                "The %s composite stats engine requires the numpy package."
+                % COMPOSITE_ENGINE_NUMPY
+            )
+        # grows to the number of node slots that the largest cluster needs
+        self.num_node_slots = num_node_slots
+        self.num_rows = 0
+        self.operations = set()
+
+    def add_input(self, op_names):
+        """
+        Add a row for the input of one or more composite stats.
+        :param list op_names: the operations that are computed from the input.
+        :returns: the index of the input's row.
+        """
+        self.operations.update(op_names)
+        self.num_rows += 1
+        return self.num_rows - 1
+
+    def new_arrays(self):
+        return NodeStatArrays(self)
+
+
+class NodeStatArrays(object):
+    """
+    The node values and timestamps of all of the inputs of the composite stats
+    of a stat group on one cluster, gathered into preallocated arrays with one
+    row per input and one column per devid, from which all of the composite
+    stats are computed at once with NumPy.
+    """
+
+    def __init__(self, layout):
+        self._layout = layout
+        self._values = numpy.empty((layout.num_rows, layout.num_node_slots))
+        self._timestamps = numpy.empty((layout.num_rows, layout.num_node_slots))
+        self._values.fill(numpy.nan)
+        self._timestamps.fill(numpy.nan)
+        self._max_devid = -1
+        # rows that have a value that isn't an int
+        self._non_int_rows = set()
+        # row -> devid -> value of the rows whose values are all ints
+        self._int_values = {}
+        # row -> error message of the values that aren't numbers
+        self._row_errors = {}
+        self._results = None
+
+    def set_value(self, row, devid, value, timestamp):
+        if devid >= self._values.shape[1]:
+            self._grow(devid)
+        try:
+            self._values[row, devid] = value
+        except (TypeError, ValueError) as exc:
+            self._row_errors[row] = "Invalid value %r for node %s: %s" % (
+                value,
+                str(devid),
+                str(exc),
+            )
+            return
+        self._timestamps[row, devid] = int(timestamp)
+        if not isinstance(value, int) or isinstance(value, bool):
+            self._non_int_rows.add(row)
+            self._int_values.pop(row, None)
+        elif row not in self._non_int_rows:
+            try:
+                self._int_values[row][devid] = value
+            except KeyError:
+                self._int_values[row] = {devid: value}
+        if devid > self._max_devid:
+            self._max_devid = devid
+        self._results = None
+
+    def _grow(self, devid):
+        num_node_slots = self._values.shape[1]
+        while num_node_slots <= devid:
+            num_node_slots *= 2
+        for name in ("_values", "_timestamps"):
+            old_array = getattr(self, name)
+            new_array = numpy.empty((old_array.shape[0], num_node_slots))
+            new_array.fill(numpy.nan)
+            new_array[:, :old_array.shape[1]] = old_array
+            setattr(self, name, new_array)
+        if num_node_slots > self._layout.num_node_slots:
+            self._layout.num_node_slots = num_node_slots
+
+    def _compute(self):
+        values = self._values[:, :self._max_devid + 1]
+        counts = numpy.count_nonzero(~numpy.isnan(values), axis=1)
+        timestamp_sums = numpy.nansum(self._timestamps[:, :self._max_devid + 1], axis=1)
+        results = {}
+        # the all NaN rows are reported as errors, so don't warn about them.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for op_name in self._layout.operations:
+                results[op_name] = _NUMPY_OPERATIONS[op_name](values).tolist()
+        self._results = (counts.tolist(), timestamp_sums.tolist(), results)
+
+    def get_timestamp(self, row):
+        """
+        :returns: the average timestamp of the row's values, which is the
+        timestamp of its composite stats.
+        """
+        if self._results is None:
+            self._compute()
+        counts, timestamp_sums, _ = self._results
+        return old_div(int(timestamp_sums[row]), counts[row])
+
+    def get_result(self, row, op_name):
+        """
+        :returns: a tuple of the value of the operation for the row and an
+        error message or None.
+        """
+        try:
+            return None, self._row_errors[row]
+        except KeyError:
+            pass
+        if self._results is None:
+            self._compute()
+        counts, _, results = self._results
+        if counts[row] == 0:
+            return None, "No node values were selected."
+        if op_name in _EXACT_INT_OPERATIONS and row not in self._non_int_rows:
+            # the same value and type that the python engine returns
+            return COMPOSITE_OPERATIONS[op_name](list(self._int_values[row].values())), None
+        value = results[op_name][row]
+        if op_name == "count_nonzero":
+            return int(value), None
+        return value, None
+
+
+class NumpyCompositeStatComputer(DerivedStatComputer):
+    """
+    Computes all of the composite stats of a single input stat, from a
+    NodeStatArrays per cluster that is shared with the other composite stats of its stat
+    group. Each node value is only gathered once no matter how many
+    operations are computed from it.
+    """
+
+    DESCRIPTION = ClusterCompositeStatComputer.DESCRIPTION
+
+    def __init__(self, input_stat, composites, layout):
+        """
+        :param list composites: a list of (operation name, out stat name)
+        tuples of the composite stats of input_stat.
+        :param NodeStatArraysLayout layout: the layout of the NodeStatArrays
+        of the stat group.
+        """
+        super(NumpyCompositeStatComputer, self).__init__(composites[0][1])
+        self._input_stat = input_stat
+        self._composites = composites
+        self._layout = layout
+        self._row = layout.add_input([op_name for op_name, _ in composites])
+
+    def new_state(self, context):
+        state = super(NumpyCompositeStatComputer, self).new_state(context)
+        state.stat_arrays = context.get_shared_state(
+            self._layout, self._layout.new_arrays
+        )
+        return state
+
+    def input_keys(self):
+        return (self._input_stat.name,)
+
+    def output_keys(self):
+        return tuple(out_stat_name for _, out_stat_name in self._composites)
+
+    def select_stat(self, state, stat):
+        if stat.key == self._input_stat.name:
+            state.stat_arrays.set_value(
+                self._row, stat.devid, self._input_stat.get_value(stat.value), stat.time
+            )
+
+    def compute_derived_stats(self, state):
+        derived_stats = []
+        for op_name, out_stat_name in self._composites:
+            value, error = state.stat_arrays.get_result(self._row, op_name)
+            LOG.debug("CCSC %s=%s", out_stat_name, str(value))
+            if error is not None:
+                derived_stats.append(
+                    StatRecord(
+                        out_stat_name,
+                        0,
+                        0,
+                        None,
+                        "Failed to compute %s: %s" % (out_stat_name, error),
+                        DERIVED_STAT_ERROR_CODE,
+                    )
+                )
+            else:
+                derived_stats.append(
+                    StatRecord(
+                        out_stat_name,
+                        0,
+                        state.stat_arrays.get_timestamp(self._row),
+                        value,
+                        None,
+                    )
+                )
+        return derived_stats
+
+
+def numpy_available():
+    return numpy is not None
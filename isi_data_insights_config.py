@@ -10,18 +10,19 @@ standard_library.install_aliases()  # noqa: E402
 from builtins import input
 from builtins import str
 from builtins import range
-from past.utils import old_div
 import argparse
 import configparser
+import functools
 import getpass
 import logging
 import os
-import re
 import sys
 import urllib3
 
+import gevent
+import gevent.pool
+
 from ast import literal_eval
-from Equation import Expression
 
 from isi_data_insights_daemon import (
     StatsConfig,
@@ -31,7 +32,36 @@ from isi_data_insights_daemon import (
     PercentChangeStatComputer,
     DerivedStatInput,
 )
-from isi_stats_client import IsiStatsClient
+from isi_composite_stats import (
+    COMPOSITE_ENGINE_NUMPY,
+    COMPOSITE_ENGINE_PYTHON,
+    COMPOSITE_ENGINES,
+    COMPOSITE_OPERATIONS,
+    NodeStatArraysLayout,
+    NumpyCompositeStatComputer,
+    numpy_available,
+)
+from isi_equation import compile_equation
+from isi_papi_session import DEFAULT_CONNECTION_POOL_SIZE
+from isi_query_limiter import (
+    DEFAULT_MAX_ASYNC_QUERIES,
+    DEFAULT_MAX_CLUSTER_QUERIES,
+    DEFAULT_QUERY_LATENCY_TARGET,
+)
+from isi_stats_client import IsiStatsClient, DEFAULT_MAX_PARALLEL_CHUNKS
+from isi_stats_metadata_cache import (
+    DEFAULT_STATS_METADATA_CACHE_FILE,
+    DEFAULT_STATS_METADATA_CACHE_TTL,
+    StatMetadata,
+    StatsMetadataCache,
+)
+from isi_stats_rollup import DEFAULT_MAX_ROLLUP_SERIES, parse_rollup_window
+from isi_windowed_stats import (
+    RateStatComputer,
+    build_windowed_stat_computer,
+    parse_windowed_stat,
+    rate_stat_name,
+)
 import isi_sdk_utils
 
 
@@ -53,21 +83,65 @@ MIN_UPDATE_INTERVAL = 30  # seconds
 # name of the config file param that can be used to specify a lower
 # MIN_UPDATE_INTERVAL.
 MIN_UPDATE_INTERVAL_OVERRIDE_PARAM = "min_update_interval_override"
+# name of the config file param that specifies what to do when a cluster's
+# update takes longer than its update interval.
+OVERRUN_POLICY_PARAM = "overrun_policy"
+STATS_QUERY_ENGINE_PARAM = "stats_query_engine"
+# names of the config file params that configure the concurrency limits of the
+# stats queries.
+MAX_ASYNC_QUERIES_PARAM = "max_async_queries"
+MAX_CLUSTER_QUERIES_PARAM = "max_cluster_queries"
+QUERY_LATENCY_TARGET_PARAM = "query_latency_target"
+# names of the config file params that configure how the stats queries are
+# split into chunks.
+MAX_KEYS_PER_QUERY_PARAM = "max_keys_per_query"
+MAX_PARALLEL_CHUNKS_PARAM = "max_parallel_chunks"
+NODE_SHARD_SIZE_PARAM = "node_shard_size"
+# max number of clusters that are bootstrapped in parallel at startup.
+MAX_CONCURRENT_CLUSTER_BOOTSTRAPS = 8
+# names of the config file params that configure the stats metadata cache.
+STATS_METADATA_CACHE_FILE_PARAM = "stats_metadata_cache_file"
+STATS_METADATA_CACHE_TTL_PARAM = "stats_metadata_cache_ttl"
+
+
+# name of the config file param that selects the composite stats engine.
+COMPOSITE_STATS_ENGINE_PARAM = "composite_stats_engine"
+# names of the config file params that configure the rollups of the stats.
+ROLLUP_WINDOWS_PARAM = "rollup_windows"
+ROLLUP_FORWARD_RAW_STATS_PARAM = "rollup_forward_raw_stats"
+ROLLUP_MAX_SERIES_PARAM = "rollup_max_series"
+
+
+class ConfigError(Exception):
+    """
+    Raised by the functions that configure the stat groups of the clusters,
+    which are also called by the background retries of the unreachable
+    clusters, where an invalid configuration must not exit the daemon.
+    """
 
 
-def avg(stat_values):
-    # XXX investigate if plain '/' is OK here
-    return old_div(sum(stat_values), len(stat_values))
-
-
-# operations use by ClusterCompositeStatComputer
-COMPOSITE_OPERATIONS = {"avg": avg, "max": max, "min": min, "sum": sum}
-
 # keep track of auth data that we have username and passwords for so that we
 # don't prompt more than once.
 g_cluster_auth_data = {}
 # keep track of the name and version of each cluster
 g_cluster_configs = {}
+# the engine that computes the composite stats, see isi_composite_stats
+g_composite_stats_engine = COMPOSITE_ENGINE_PYTHON
+# the StatsMetadataCache or None if it is disabled
+g_stats_metadata_cache = None
+# cluster address -> stat name -> StatMetadata of the stats of every stat group
+g_stats_metadata = {}
+# max number of connections kept alive to each cluster
+g_connection_pool_size = DEFAULT_CONNECTION_POOL_SIZE
+# cluster address -> the exception raised when bootstrapping the cluster
+g_unreachable_clusters = {}
+# cluster address -> list of functions that configure the stat groups of the
+# cluster once it has been bootstrapped (see _build_cluster_configs)
+g_deferred_cluster_configs = {}
+# cluster address -> list of functions that configure the stat groups of the
+# cluster, which are called again when the metadata of its stats changes (see
+# _reconfigure_cluster)
+g_cluster_configure_funcs = {}
 
 
 def _add_cluster_auth_data(cluster_address, username, password, verify_ssl):
@@ -163,42 +237,162 @@ def _query_cluster_name(cluster_address, isi_sdk, api_client):
         return cluster_address
 
 
-def _build_cluster_configs(cluster_list):
-    cluster_configs = []
+def _bootstrap_cluster(cluster):
+    """
+    Configure the SDK for the cluster and get its name, GUID and release.
+    :returns: the tuple that is stored in g_cluster_configs.
+    """
+    username, password, verify_ssl = _get_cluster_auth_data(cluster)
+    if verify_ssl is False:
+        urllib3.disable_warnings()
+    # the cluster config that is used to detect the version also has the
+    # cluster's name, so only one request is sent to each cluster.
+    isi_sdk, api_client, version, identity = isi_sdk_utils.configure_cluster(
+        cluster, username, password, verify_ssl, pool_size=g_connection_pool_size
+    )
+    print(
+        "Configured %s as version %d cluster, using SDK %s."
+        % (cluster, int(version), isi_sdk.__name__)
+    )
+    if identity is None:
+        return (
+            _query_cluster_name(cluster, isi_sdk, api_client),
+            isi_sdk,
+            api_client,
+            version,
+            None,
+            None,
+        )
+    return identity.name, isi_sdk, api_client, version, identity.guid, identity.release
+
+
+def _bootstrap_clusters(cluster_list):
+    """
+    Bootstrap the clusters that haven't been bootstrapped yet in parallel.
+    Clusters that fail are added to g_unreachable_clusters.
+    """
+    cluster_list = [
+        cluster
+        for cluster in cluster_list
+        if cluster not in g_cluster_configs and cluster not in g_unreachable_clusters
+    ]
+    # prompt for any missing credentials before bootstrapping in parallel
     for cluster in cluster_list:
-        username, password, verify_ssl = _get_cluster_auth_data(cluster)
+        _get_cluster_auth_data(cluster)
 
-        if cluster in g_cluster_configs:
-            cluster_name, isi_sdk, api_client, version = g_cluster_configs[cluster]
-        else:
-            if verify_ssl is False:
-                urllib3.disable_warnings()
-            try:
-                isi_sdk, api_client, version = isi_sdk_utils.configure(
-                    cluster, username, password, verify_ssl
-                )
-            except RuntimeError as exc:
-                print(
-                    "Failed to configure SDK for "
-                    "cluster %s. Exception raised: %s" % (cluster, str(exc)),
-                    file=sys.stderr,
-                )
-                sys.exit(1)
+    def bootstrap(cluster):
+        try:
+            g_cluster_configs[cluster] = _bootstrap_cluster(cluster)
+        except Exception as exc:
+            # any error, e.g. of the SDK's HTTP client, means that the
+            # cluster is unreachable for now and is retried later.
             print(
-                "Configured %s as version %d cluster, using SDK %s."
-                % (cluster, int(version), isi_sdk.__name__)
+                "Failed to configure SDK for "
+                "cluster %s. Exception raised: %s" % (cluster, str(exc)),
+                file=sys.stderr,
             )
-            cluster_name = _query_cluster_name(cluster, isi_sdk, api_client)
-            g_cluster_configs[cluster] = cluster_name, isi_sdk, api_client, version
+            g_unreachable_clusters[cluster] = exc
+
+    pool = gevent.pool.Pool(MAX_CONCURRENT_CLUSTER_BOOTSTRAPS)
+    pool.map(bootstrap, cluster_list)
 
+
+def _build_cluster_configs(cluster_list, configure_func=None):
+    """
+    Build the ClusterConfig of each cluster in cluster_list.
+    :param list cluster_list: the addresses of the clusters.
+    :param function configure_func: if specified then it is called with a
+    list containing the ClusterConfig of each cluster that could not be
+    bootstrapped once the cluster is bootstrapped by the daemon's background
+    retries (see _configure_cluster_bootstrap_retries), and with a list
+    containing the ClusterConfig of a cluster whose stats metadata changed
+    (see _reconfigure_cluster).
+    :returns: a list of the ClusterConfigs of the clusters that were
+    bootstrapped.
+    """
+    _bootstrap_clusters(cluster_list)
+    cluster_configs = []
+    for cluster in cluster_list:
+        if configure_func is not None:
+            g_cluster_configure_funcs.setdefault(cluster, []).append(configure_func)
+        if cluster in g_unreachable_clusters:
+            if configure_func is not None:
+                g_deferred_cluster_configs.setdefault(cluster, []).append(
+                    configure_func
+                )
+            continue
+        cluster_name, isi_sdk, api_client, version, guid, release = g_cluster_configs[
+            cluster
+        ]
         cluster_config = ClusterConfig(
-            cluster, cluster_name, version, isi_sdk, api_client
+            cluster, cluster_name, version, isi_sdk, api_client, guid, release
         )
         cluster_configs.append(cluster_config)
 
     return cluster_configs
 
 
+def _retry_cluster_bootstrap(cluster, configure_funcs):
+    """
+    Try to bootstrap an unreachable cluster again and configure the stat
+    groups that it belongs to. The stat groups that fail to be configured for
+    the cluster, e.g. because it doesn't have some of their stats, are
+    skipped rather than exiting the daemon, which is already running.
+    """
+    g_unreachable_clusters.pop(cluster, None)
+    cluster_configs = _build_cluster_configs([cluster])
+    if not cluster_configs:
+        raise g_unreachable_clusters[cluster]
+    for configure_func in configure_funcs:
+        try:
+            configure_func(cluster_configs)
+        except ConfigError as exc:
+            LOG.error(
+                "Failed to configure stats of cluster %s, skipping them. %s",
+                cluster,
+                str(exc),
+            )
+    _save_stats_metadata_cache()
+
+
+def _reconfigure_cluster(cluster):
+    """
+    Configure the stat groups of a cluster again after the metadata of its
+    stats changed, so that the update intervals that are relative to the
+    collection intervals of the stats are recomputed. The same as for the
+    background retries, the stat groups that fail to be configured are
+    skipped.
+    :param ClusterConfig cluster: the cluster to configure.
+    """
+    g_stats_metadata.pop(cluster.address, None)
+    for configure_func in g_cluster_configure_funcs.get(cluster.address, []):
+        try:
+            configure_func([cluster])
+        except ConfigError as exc:
+            LOG.error(
+                "Failed to configure stats of cluster %s, skipping them. %s",
+                cluster.name,
+                str(exc),
+            )
+    _save_stats_metadata_cache()
+
+
+def _configure_cluster_bootstrap_retries(daemon):
+    """
+    Have the daemon keep trying to bootstrap the clusters that were not
+    reachable in the background, rather than holding up the other clusters.
+    """
+    for cluster, configure_funcs in g_deferred_cluster_configs.items():
+        print(
+            "Cluster %s is not reachable, will keep retrying in the background."
+            % cluster,
+            file=sys.stderr,
+        )
+        daemon.add_cluster_bootstrap(
+            cluster, functools.partial(_retry_cluster_bootstrap, cluster, configure_funcs)
+        )
+
+
 def _configure_stat_group(
     daemon,
     update_interval,
@@ -208,9 +402,11 @@ def _configure_stat_group(
     equation_stats=None,
     pct_change_stats=None,
     final_equation_stats=None,
+    windowed_stats=None,
 ):
     """
     Configure the daemon with some StatsConfigs.
+    :raises ConfigError: if the daemon rejects the stats.
     """
     # configure daemon with stats
     if update_interval < MIN_UPDATE_INTERVAL:
@@ -236,7 +432,14 @@ def _configure_stat_group(
         stats_config.pct_change_stats.extend(pct_change_stats)
     if final_equation_stats is not None:
         stats_config.final_equation_stats.extend(final_equation_stats)
-    daemon.add_stats(stats_config)
+    if windowed_stats is not None:
+        stats_config.windowed_stats.extend(windowed_stats)
+    try:
+        daemon.add_stats(stats_config)
+    except ValueError as exc:
+        raise ConfigError(
+            "Failed to configure stats: %s.\nERROR: %s" % (str(stats_list), str(exc))
+        )
 
 
 def _query_stats_metadata(cluster, stat_names):
@@ -246,7 +449,83 @@ def _query_stats_metadata(cluster, stat_names):
     """
     stats_api = cluster.isi_sdk.StatisticsApi(cluster.api_client)
     isi_stats_client = IsiStatsClient(stats_api)
-    return isi_stats_client.get_stats_metadata(stat_names)
+    return [
+        None if stat_metadata is None else StatMetadata.from_statistics_key(stat_metadata)
+        for stat_metadata in isi_stats_client.get_stats_metadata(stat_names)
+    ]
+
+
+def _fetch_stats_metadata(cluster, stat_names):
+    """
+    Get the metadata of the stats specified in stat_names list from the stats
+    metadata cache, or the cluster if the cache is disabled, and save it in
+    g_stats_metadata.
+    """
+    if g_stats_metadata_cache is None:
+        stats_metadata = _query_stats_metadata(cluster, stat_names)
+    else:
+        stats_metadata = g_stats_metadata_cache.get_stats_metadata(
+            cluster, stat_names, _query_stats_metadata
+        )
+    cluster_metadata = g_stats_metadata.setdefault(cluster.address, {})
+    for stat_name, stat_metadata in zip(stat_names, stats_metadata):
+        cluster_metadata[stat_name] = stat_metadata
+
+
+def _get_stats_metadata(cluster, stat_names):
+    """
+    Get the metadata of the stats specified in stat_names list, only fetching
+    the ones that weren't already fetched by _prefetch_stats_metadata.
+    """
+    cluster_metadata = g_stats_metadata.get(cluster.address, {})
+    missing_names = [
+        stat_name for stat_name in stat_names if stat_name not in cluster_metadata
+    ]
+    if missing_names:
+        _fetch_stats_metadata(cluster, missing_names)
+        cluster_metadata = g_stats_metadata[cluster.address]
+    return [cluster_metadata[stat_name] for stat_name in stat_names]
+
+
+def _prefetch_stats_metadata(config_file, active_stat_groups, global_cluster_list):
+    """
+    Fetch the metadata of the stats of every stat group whose update interval
+    is relative to the collection interval of its stats in one pass per
+    cluster, rather than once per stat group, and fetch from the clusters in
+    parallel.
+    """
+    # cluster address -> set of stat names
+    cluster_stat_names = {}
+    for stat_group in active_stat_groups:
+        if not config_file.get(stat_group, "update_interval").startswith("*"):
+            continue
+        stat_names = config_file.get(stat_group, "stats").split()
+        for cluster in _get_stat_group_cluster_list(
+            config_file, stat_group, global_cluster_list
+        ):
+            cluster_stat_names.setdefault(cluster, set()).update(stat_names)
+    if not cluster_stat_names:
+        return
+
+    cluster_configs = _build_cluster_configs(list(cluster_stat_names.keys()))
+    fetchers = [
+        gevent.spawn(
+            _fetch_stats_metadata, cluster, list(cluster_stat_names[cluster.address])
+        )
+        for cluster in cluster_configs
+    ]
+    gevent.joinall(fetchers, raise_error=True)
+    _save_stats_metadata_cache()
+
+
+def _save_stats_metadata_cache():
+    """
+    Save the metadata that was fetched from the clusters to the stats metadata
+    cache file, once after all of the clusters were fetched from rather than
+    after each of them.
+    """
+    if g_stats_metadata_cache is not None:
+        g_stats_metadata_cache.save()
 
 
 def _compute_stat_group_update_intervals(
@@ -255,10 +534,14 @@ def _compute_stat_group_update_intervals(
     # update interval is supposed to be set relative to the collection
     # interval, which might be different for each stat and each cluster.
     for cluster in cluster_configs:
-        stats_metadata = _query_stats_metadata(cluster, stat_names)
+        stats_metadata = _get_stats_metadata(cluster, stat_names)
         for stat_index in range(0, len(stats_metadata)):
             stat_metadata = stats_metadata[stat_index]
             stat_name = stat_names[stat_index]
+            if stat_metadata is None:
+                raise ConfigError(
+                    "Stat %s doesn't exist on cluster %s." % (stat_name, cluster.name)
+                )
             # cache time is the length of time the system will store the
             # value before it updates.
             cache_time = -1
@@ -270,31 +553,33 @@ def _compute_stat_group_update_intervals(
                     * update_interval_multiplier
                 )
             # the policy intervals seem to override the default cache time
-            if stat_metadata.policies:
+            if stat_metadata.policy_intervals:
                 smallest_interval = cache_time
-                for policy in stat_metadata.policies:
+                for policy_interval in stat_metadata.policy_intervals:
                     if smallest_interval == -1:
-                        smallest_interval = policy.interval
+                        smallest_interval = policy_interval
                     else:
-                        smallest_interval = min(policy.interval, smallest_interval)
+                        smallest_interval = min(policy_interval, smallest_interval)
                 cache_time = smallest_interval * update_interval_multiplier
             # if the cache_time is still -1 then it means that the statistic is
             # continually updated, so the fastest it can be queried is
             # once every second.
             if cache_time == -1:
                 cache_time = ONE_SEC * update_interval_multiplier
+            # keep the stats separate per cluster because the same stat might
+            # have a different collection interval on each cluster.
             try:
-                update_interval = update_intervals[cache_time]
-                update_interval[0].add(cluster)
-                update_interval[1].add(stat_name)
+                cluster_stats = update_intervals[cache_time]
             except KeyError:
                 # insert a new interval time
-                update_intervals[cache_time] = (set([cluster]), set([stat_name]))
+                update_intervals[cache_time] = cluster_stats = {}
+            try:
+                cluster_stats[cluster].add(stat_name)
+            except KeyError:
+                cluster_stats[cluster] = set([stat_name])
 
 
-def _configure_stat_groups_via_file(
-    daemon, config_file, stat_group, global_cluster_list
-):
+def _get_stat_group_cluster_list(config_file, stat_group, global_cluster_list):
     cluster_list = []
     cluster_list.extend(global_cluster_list)
     try:
@@ -318,9 +603,37 @@ def _configure_stat_groups_via_file(
             file=sys.stderr,
         )
         sys.exit(1)
+    return cluster_list
 
-    cluster_configs = _build_cluster_configs(cluster_list)
 
+def _configure_stat_groups_via_file(
+    daemon, config_file, stat_group, global_cluster_list
+):
+    cluster_list = _get_stat_group_cluster_list(
+        config_file, stat_group, global_cluster_list
+    )
+    cluster_configs = _build_cluster_configs(
+        cluster_list,
+        functools.partial(
+            _configure_stat_group_clusters_via_file, daemon, config_file, stat_group
+        ),
+    )
+    try:
+        _configure_stat_group_clusters_via_file(
+            daemon, config_file, stat_group, cluster_configs
+        )
+    except ConfigError as exc:
+        print(str(exc), file=sys.stderr)
+        sys.exit(1)
+
+
+def _configure_stat_group_clusters_via_file(
+    daemon, config_file, stat_group, cluster_configs
+):
+    """
+    Configure the stat group for the clusters in cluster_configs.
+    :raises ConfigError: if the stat group's config is invalid.
+    """
     update_interval_param = config_file.get(stat_group, "update_interval")
     stat_names = config_file.get(stat_group, "stats").split()
     # remove duplicates
@@ -342,12 +655,31 @@ def _configure_stat_groups_via_file(
             config_file, stat_group, "percent_change_stats", _parse_pct_change_stats
         )
 
+    # the rate stats are windowed stats with a window of one previous value
+    windowed_stats = []
+    if config_file.has_option(stat_group, "rate_stats") is True:
+        windowed_stats = _parse_derived_stats(
+            config_file, stat_group, "rate_stats", _parse_rate_stats
+        )
+    if config_file.has_option(stat_group, "windowed_stats") is True:
+        windowed_stats += _parse_derived_stats(
+            config_file, stat_group, "windowed_stats", _parse_windowed_stats
+        )
+
     final_eq_stats = []
     if config_file.has_option(stat_group, "final_equation_stats") is True:
         final_eq_stats = _build_equation_stats_list(
             config_file, stat_group, "final_equation_stats"
         )
 
+    _check_equation_stat_inputs(
+        config_file,
+        stat_group,
+        stat_names,
+        eq_stats + final_eq_stats,
+        composite_stats + eq_stats + pct_change_stats + windowed_stats + final_eq_stats,
+    )
+
     update_intervals = {}
     if update_interval_param.startswith("*"):
         try:
@@ -355,12 +687,10 @@ def _configure_stat_groups_via_file(
                 1 if update_interval_param == "*" else int(update_interval_param[1:])
             )
         except ValueError as exc:
-            print(
+            raise ConfigError(
                 "Failed to parse update interval multiplier "
-                "from %s stat group.\nERROR: %s" % (stat_group, str(exc)),
-                file=sys.stderr,
+                "from %s stat group.\nERROR: %s" % (stat_group, str(exc))
             )
-            sys.exit(1)
         print("Computing update intervals for stat group: %s." % stat_group)
         _compute_stat_group_update_intervals(
             update_interval_multiplier, cluster_configs, stat_names, update_intervals
@@ -369,22 +699,26 @@ def _configure_stat_groups_via_file(
         try:
             update_interval = int(update_interval_param)
         except ValueError as exc:
-            print(
+            raise ConfigError(
                 "Failed to parse update interval from %s "
-                "stat group.\nERROR: %s" % (stat_group, str(exc)),
-                file=sys.stderr,
+                "stat group.\nERROR: %s" % (stat_group, str(exc))
             )
-            sys.exit(1)
-        update_intervals[update_interval] = (cluster_configs, stat_names)
+        update_intervals[update_interval] = {
+            cluster: stat_names for cluster in cluster_configs
+        }
 
     # TODO - fix this - for now if there are derived stats then we are going to
     # query all the stats in this section at once (i.e. using the the smallest
     # of the configured update intervals) in order to make sure that all of the
     # input parameters of the derived stats are available at once.
+    if not update_intervals:
+        # none of the stat group's clusters are reachable yet
+        return
     if (
         len(composite_stats) > 0
         or len(eq_stats) > 0
         or len(pct_change_stats) > 0
+        or len(windowed_stats) > 0
         or len(final_eq_stats) > 0
     ):
         update_interval_keys = list(update_intervals.keys())
@@ -399,19 +733,17 @@ def _configure_stat_groups_via_file(
             eq_stats,
             pct_change_stats,
             final_eq_stats,
+            windowed_stats,
         )
     else:
-        for update_interval, clusters_stats_tuple in update_intervals.items():
-            # first item in clusters_stats_tuple is the unique list of clusters
-            # associated with the current update_interval, the second item is the
-            # unique list of stats to query on the set of clusters at the current
-            # update_interval.
-            _configure_stat_group(
-                daemon,
-                update_interval,
-                clusters_stats_tuple[0],
-                clusters_stats_tuple[1],
-            )
+        for update_interval, cluster_stats in update_intervals.items():
+            # cluster_stats maps each cluster associated with the current
+            # update_interval to the unique list of stats to query on that
+            # cluster at the current update_interval.
+            for cluster, cluster_stat_names in cluster_stats.items():
+                _configure_stat_group(
+                    daemon, update_interval, [cluster], list(cluster_stat_names)
+                )
 
 
 def _parse_derived_stats(config_file, stat_group, derived_stats_name, parse_func):
@@ -419,12 +751,10 @@ def _parse_derived_stats(config_file, stat_group, derived_stats_name, parse_func
     try:
         derived_stats = parse_func(derived_stats_cfg)
     except RuntimeError as rterr:
-        print(
+        raise ConfigError(
             "Failed to parse %s from %s "
-            "section. %s" % (derived_stats_name, stat_group, str(rterr)),
-            file=sys.stderr,
+            "section. %s" % (derived_stats_name, stat_group, str(rterr))
         )
-        sys.exit(1)
 
     return derived_stats
 
@@ -441,15 +771,24 @@ def _parse_composite_stats(composite_stats_cfg):
     # Example of what is expected for each stat_cfg:
     # sum(node.ifs.ops.in[:field1:field2])
     composite_stats = []
+    # the node values of all of the stat group's composite stats are gathered
+    # into one set of arrays per cluster by the numpy engine.
+    arrays_layout = None
+    # input stat full name -> (input stat, list of (op name, out stat name))
+    numpy_composites = {}
+    numpy_inputs = []
+    if g_composite_stats_engine == COMPOSITE_ENGINE_NUMPY:
+        arrays_layout = NodeStatArraysLayout()
     for stat_cfg in composite_stats_cfg.split():
         bracket1 = stat_cfg.find("(")
         bracket2 = stat_cfg.find(")")
         if bracket1 <= 0 or bracket2 == -1 or bracket1 > bracket2:
             raise RuntimeError(
                 "Failed to parse operation from %s."
-                "Expected: op(stat) where op is avg, min, max, "
-                " or sum and stat is the name of a base OneFS "
-                ' statistic name that starts with "node.".' % stat_cfg
+                "Expected: op(stat) where op is %s"
+                " and stat is the name of a base OneFS "
+                ' statistic name that starts with "node.".'
+                % (stat_cfg, ", ".join(sorted(COMPOSITE_OPERATIONS)))
             )
         op_name = stat_cfg[0:bracket1]
         if op_name not in COMPOSITE_OPERATIONS:
@@ -466,13 +805,31 @@ def _parse_composite_stats(composite_stats_cfg):
         out_stat_name = "cluster.%s.%s" % (in_stat_name.replace(":", "."), op_name)
         in_stat_name, fields = _parse_fields(in_stat_name)
         # TODO should validate that this is a valid stat name
+        input_stat = DerivedStatInput(in_stat_name, fields)
+        if arrays_layout is not None:
+            # one computer computes all the composite stats of each input
+            try:
+                numpy_composites[input_stat.full_name][1].append(
+                    (op_name, out_stat_name)
+                )
+            except KeyError:
+                numpy_composites[input_stat.full_name] = (
+                    input_stat,
+                    [(op_name, out_stat_name)],
+                )
+                numpy_inputs.append(input_stat.full_name)
+            continue
         composite_stat = ClusterCompositeStatComputer(
-            DerivedStatInput(in_stat_name, fields),
-            out_stat_name,
-            COMPOSITE_OPERATIONS[op_name],
+            input_stat, out_stat_name, COMPOSITE_OPERATIONS[op_name]
         )
         composite_stats.append(composite_stat)
 
+    for input_name in numpy_inputs:
+        input_stat, composites = numpy_composites[input_name]
+        composite_stats.append(
+            NumpyCompositeStatComputer(input_stat, composites, arrays_layout)
+        )
+
     return composite_stats
 
 
@@ -480,15 +837,16 @@ def _build_equation_stats_list(config_file, stat_group, equation_stats):
     eq_stats = []
     eq_stats_list = config_file.get(stat_group, equation_stats).split()
     for eq_stat in eq_stats_list:
-        eq_stat_names = _parse_derived_stats(
-            config_file, stat_group, eq_stat, _parse_equation_stats
-        )
-        cfg_expression = config_file.get(stat_group, eq_stat)
-        # the Equation package doesn't like having '.' characters in the
-        # input param names, so we have to replace them with placeholder
-        # names.
-        eq_func = _build_equation_expression(cfg_expression, eq_stat_names)
-        eq_stat_inputs = _build_equation_stat_inputs(eq_stat_names)
+        # Example of what is expected:
+        # (cluster.node.ifs.ops.in.sum + cluster.node.ifs.ops.out.sum)
+        # * cluster.node.disk.iosched.latency.avg.avg
+        # Example of what is expected from stat with specific fields:
+        # (cluster.protostats.nfs.total:op_count
+        #  + cluster.protostats.smb2.total:op_count)
+        eq_func = _parse_derived_stats(
+            config_file, stat_group, eq_stat, compile_equation
+        )
+        eq_stat_inputs = _build_equation_stat_inputs(eq_func.input_names)
         eq_stats.append(EquationStatComputer(eq_func, eq_stat_inputs, eq_stat))
 
     return eq_stats
@@ -503,29 +861,33 @@ def _build_equation_stat_inputs(eq_stat_names):
     return input_stats
 
 
-def _parse_equation_stats(equation_stat_expression):
-    # Example of what is expected:
-    # (cluster.node.ifs.ops.in.sum + cluster.node.ifs.ops.out.sum)
-    # * cluster.node.disk.iosched.latency.avg.avg
-    # Example of what is expected from stat with specific fields:
-    # (cluster.protostats.nfs.total:op_count
-    #  + cluster.protostats.smb2.total:op_count)
-    equation_stats = re.findall("[a-zA-Z.:_0-9]+", equation_stat_expression)
-
-    # remove items that don't start with an alphabet character
-    equation_stats = [eq_stat for eq_stat in equation_stats if eq_stat[0].isalpha()]
-    return equation_stats
-
-
-def _build_equation_expression(cfg_expression, eq_stat_names):
-    params_list = []
-    for eindex in range(0, len(eq_stat_names)):
-        eq_stat_name = eq_stat_names[eindex]
-        param_name = "param" + str(eindex)
-        cfg_expression = cfg_expression.replace(eq_stat_name, param_name, 1)
-        params_list.append(param_name)
-
-    return Expression(cfg_expression, params_list)
+def _check_equation_stat_inputs(
+    config_file, stat_group, stat_names, eq_stats, derived_stats
+):
+    """
+    Warn about the inputs of the equation stats that are neither queried nor
+    computed by the stat group, because they'll never have a value unless
+    another stat group that is queried at the same time provides them.
+    """
+    known_names = set(stat_names)
+    for computer in derived_stats:
+        known_names.update(computer.output_keys())
+    for eq_stat in eq_stats:
+        cfg_expression = config_file.get(stat_group, eq_stat.out_stat_name)
+        for input_key in eq_stat.input_keys():
+            if input_key in known_names:
+                continue
+            print(
+                "WARNING: %s from %s section uses stat %s at column %d, which "
+                "isn't in the section's stats or derived stats."
+                % (
+                    eq_stat.out_stat_name,
+                    stat_group,
+                    input_key,
+                    cfg_expression.find(input_key) + 1,
+                ),
+                file=sys.stderr,
+            )
 
 
 def _parse_pct_change_stats(pct_change_stats_cfg):
@@ -542,6 +904,33 @@ def _parse_pct_change_stats(pct_change_stats_cfg):
     return pct_change_stats
 
 
+def _parse_rate_stats(rate_stats_cfg):
+    # Expected is just a white-space delimitted list of counter stat names
+    rate_stats = []
+    for stat_name in rate_stats_cfg.split():
+        out_stat_name = rate_stat_name(stat_name)
+        stat_name, fields = _parse_fields(stat_name)
+        rate_stats.append(
+            RateStatComputer(DerivedStatInput(stat_name, fields), out_stat_name)
+        )
+    return rate_stats
+
+
+def _parse_windowed_stats(windowed_stats_cfg):
+    # Expected is a white-space delimitted list of op(stat[,param]), e.g.:
+    # moving_avg(node.cpu.idle.avg,10) ewma(node.ifs.ops.in,0.2)
+    windowed_stats = []
+    for stat_cfg in windowed_stats_cfg.split():
+        op_name, stat_name, param, out_stat_name = parse_windowed_stat(stat_cfg)
+        stat_name, fields = _parse_fields(stat_name)
+        windowed_stats.append(
+            build_windowed_stat_computer(
+                op_name, DerivedStatInput(stat_name, fields), param, out_stat_name
+            )
+        )
+    return windowed_stats
+
+
 def _configure_stat_groups_via_cli(daemon, args):
     if len(args.stat_groups) == 0:
         print(
@@ -574,15 +963,28 @@ def _configure_stat_groups_via_cli(daemon, args):
 
     # remove duplicates
     cluster_list = list(set(cluster_list))
-    cluster_configs = _build_cluster_configs(cluster_list)
-
-    for index in range(0, len(args.stat_groups)):
-        stats_list = args.stat_groups[index].split(",")
+    for stat_group in args.stat_groups:
         # split always results in at least one item, so check if the first
         # item is empty to validate the stats input arg
-        if stats_list[0] == "":
+        if stat_group.split(",")[0] == "":
             print("Please provide at least one stat name.", file=sys.stderr)
             sys.exit(1)
+    cluster_configs = _build_cluster_configs(
+        cluster_list, functools.partial(_configure_cli_stat_groups, daemon, args)
+    )
+    try:
+        _configure_cli_stat_groups(daemon, args, cluster_configs)
+    except ConfigError as exc:
+        print(str(exc), file=sys.stderr)
+        sys.exit(1)
+
+
+def _configure_cli_stat_groups(daemon, args, cluster_configs):
+    """
+    :raises ConfigError: if the daemon rejects the stats.
+    """
+    for index in range(0, len(args.stat_groups)):
+        stats_list = args.stat_groups[index].split(",")
         update_interval = args.update_intervals[index]
         _configure_stat_group(daemon, update_interval, cluster_configs, stats_list)
 
@@ -632,22 +1034,167 @@ def _update_args_with_config_file(config_file, args):
         args.log_level = config_file.get(MAIN_CFG_SEC, "log_level")
 
 
+def _get_main_cfg_param(config_file, param_name, param_type, default):
+    """
+    Get the value of an optional param from the MAIN_CFG_SEC of the config
+    file converted to param_type, or default if the param is not specified.
+    """
+    if config_file.has_option(MAIN_CFG_SEC, param_name) is False:
+        return default
+    try:
+        return param_type(config_file.get(MAIN_CFG_SEC, param_name))
+    except ValueError as exc:
+        print(
+            "Failed to parse %s from %s section.\nERROR: %s"
+            % (param_name, MAIN_CFG_SEC, str(exc)),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+def _configure_query_limits_via_file(daemon, config_file):
+    max_queries = _get_main_cfg_param(
+        config_file, MAX_ASYNC_QUERIES_PARAM, int, DEFAULT_MAX_ASYNC_QUERIES
+    )
+    max_cluster_queries = _get_main_cfg_param(
+        config_file, MAX_CLUSTER_QUERIES_PARAM, int, DEFAULT_MAX_CLUSTER_QUERIES
+    )
+    latency_target = _get_main_cfg_param(
+        config_file, QUERY_LATENCY_TARGET_PARAM, float, DEFAULT_QUERY_LATENCY_TARGET
+    )
+    max_keys_per_query = _get_main_cfg_param(
+        config_file, MAX_KEYS_PER_QUERY_PARAM, int, None
+    )
+    max_parallel_chunks = _get_main_cfg_param(
+        config_file, MAX_PARALLEL_CHUNKS_PARAM, int, DEFAULT_MAX_PARALLEL_CHUNKS
+    )
+    node_shard_size = _get_main_cfg_param(config_file, NODE_SHARD_SIZE_PARAM, int, None)
+    # keep enough connections alive to each cluster for all of the cluster's
+    # queries that are allowed to be in flight at once.
+    global g_connection_pool_size
+    g_connection_pool_size = max(max_cluster_queries, max_parallel_chunks)
+    try:
+        daemon.set_query_limits(max_queries, max_cluster_queries, latency_target)
+        daemon.set_query_chunking(max_keys_per_query, max_parallel_chunks)
+        daemon.set_node_shard_size(node_shard_size)
+    except ValueError as exc:
+        print(
+            "Invalid query limits in %s section.\nERROR: %s" % (MAIN_CFG_SEC, str(exc)),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+def _configure_stats_metadata_cache_via_file(daemon, config_file):
+    global g_stats_metadata_cache
+    cache_file = _get_main_cfg_param(
+        config_file,
+        STATS_METADATA_CACHE_FILE_PARAM,
+        str,
+        DEFAULT_STATS_METADATA_CACHE_FILE,
+    )
+    if not cache_file:
+        # an empty file name disables the cache
+        return
+    cache_ttl = _get_main_cfg_param(
+        config_file, STATS_METADATA_CACHE_TTL_PARAM, int, DEFAULT_STATS_METADATA_CACHE_TTL
+    )
+    parent_dir = os.path.dirname(cache_file)
+    if parent_dir and os.path.exists(parent_dir) is False:
+        print("Invalid stats metadata cache file path: %s." % cache_file, file=sys.stderr)
+        sys.exit(1)
+    g_stats_metadata_cache = StatsMetadataCache(os.path.abspath(cache_file), cache_ttl)
+    daemon.set_stats_metadata_cache(
+        g_stats_metadata_cache, _query_stats_metadata, _reconfigure_cluster
+    )
+
+
 def _print_stat_groups(daemon):
     """
     Print out the list of stat sets that were configured for the daemon prior
     to starting it so that user can verify that it was configured as expected.
     """
-    for update_interval, stat_set in daemon.get_next_stat_set():
+    for cluster, update_interval, stat_set in daemon.get_next_stat_set():
         msg = (
-            "Configured stat set:\n\tClusters: %s\n\t"
+            "Configured stat set:\n\tCluster: %s\n\t"
             "Update Interval: %d\n\tStat Keys: %s"
-            % (str(stat_set.cluster_configs), update_interval, str(stat_set.stats))
+            % (str(cluster), update_interval, str(sorted(stat_set.stats)))
         )
         # print it to stdout and the log file.
         print(msg)
         LOG.debug(msg)
 
 
+def _configure_composite_stats_engine_via_file(config_file):
+    global g_composite_stats_engine
+    if not config_file.has_option(MAIN_CFG_SEC, COMPOSITE_STATS_ENGINE_PARAM):
+        return
+    engine = config_file.get(MAIN_CFG_SEC, COMPOSITE_STATS_ENGINE_PARAM).strip()
+    if engine not in COMPOSITE_ENGINES:
+        print(
+            "Failed to parse %s from %s section.\nERROR: Invalid engine %s, "
+            "expected one of: %s."
+            % (
+                COMPOSITE_STATS_ENGINE_PARAM,
+                MAIN_CFG_SEC,
+                engine,
+                ", ".join(COMPOSITE_ENGINES),
+            ),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    if engine == COMPOSITE_ENGINE_NUMPY and not numpy_available():
+        print(
+            "The %s %s requires the numpy package, "
+            "install it with: pip install numpy"
+            % (engine, COMPOSITE_STATS_ENGINE_PARAM),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    g_composite_stats_engine = engine
+
+
+def _configure_stats_rollups_via_file(daemon, config_file):
+    windows_cfg = _get_main_cfg_param(config_file, ROLLUP_WINDOWS_PARAM, str, "")
+    windows = []
+    try:
+        for window_cfg in windows_cfg.split():
+            window = parse_rollup_window(window_cfg)
+            if window[1] not in [length for _, length in windows]:
+                windows.append(window)
+    except ValueError as exc:
+        print(
+            "Failed to parse %s from %s section.\nERROR: %s"
+            % (ROLLUP_WINDOWS_PARAM, MAIN_CFG_SEC, str(exc)),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    forward_raw_stats = True
+    if config_file.has_option(MAIN_CFG_SEC, ROLLUP_FORWARD_RAW_STATS_PARAM):
+        try:
+            forward_raw_stats = config_file.getboolean(
+                MAIN_CFG_SEC, ROLLUP_FORWARD_RAW_STATS_PARAM
+            )
+        except ValueError as exc:
+            print(
+                "Failed to parse %s from %s section.\nERROR: %s"
+                % (ROLLUP_FORWARD_RAW_STATS_PARAM, MAIN_CFG_SEC, str(exc)),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    max_series = _get_main_cfg_param(
+        config_file, ROLLUP_MAX_SERIES_PARAM, int, DEFAULT_MAX_ROLLUP_SERIES
+    )
+    try:
+        daemon.set_stats_rollups(windows, forward_raw_stats, max_series)
+    except ValueError as exc:
+        print(
+            "Invalid rollups in %s section.\nERROR: %s" % (MAIN_CFG_SEC, str(exc)),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
 def configure_via_file(daemon, args, config_file):
     """
     Configure the daemon's stat groups and the stats processor via command line
@@ -690,6 +1237,35 @@ def configure_via_file(daemon, args, config_file):
         )
         MIN_UPDATE_INTERVAL = override_update_interval
 
+    if config_file.has_option(MAIN_CFG_SEC, OVERRUN_POLICY_PARAM):
+        try:
+            daemon.set_overrun_policy(config_file.get(MAIN_CFG_SEC, OVERRUN_POLICY_PARAM))
+        except ValueError as exc:
+            print(
+                "Failed to parse %s from %s section.\nERROR: %s"
+                % (OVERRUN_POLICY_PARAM, MAIN_CFG_SEC, str(exc)),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+    if config_file.has_option(MAIN_CFG_SEC, STATS_QUERY_ENGINE_PARAM):
+        try:
+            daemon.set_stats_query_engine(
+                config_file.get(MAIN_CFG_SEC, STATS_QUERY_ENGINE_PARAM)
+            )
+        except ValueError as exc:
+            print(
+                "Failed to parse %s from %s section.\nERROR: %s"
+                % (STATS_QUERY_ENGINE_PARAM, MAIN_CFG_SEC, str(exc)),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+    _configure_query_limits_via_file(daemon, config_file)
+    _configure_stats_metadata_cache_via_file(daemon, config_file)
+    _configure_composite_stats_engine_via_file(config_file)
+    _configure_stats_rollups_via_file(daemon, config_file)
+
     # if there are any clusters, stats, or update_intervals specified via CLI
     # then try to configure the daemon using them first.
     if args.update_intervals or args.stat_groups or args.clusters:
@@ -707,19 +1283,29 @@ def configure_via_file(daemon, args, config_file):
     # now configure with config file params too
     if config_file.has_option(MAIN_CFG_SEC, "active_stat_groups"):
         active_stat_groups = config_file.get(MAIN_CFG_SEC, "active_stat_groups").split()
+        # bootstrap the clusters of all the stat groups at once
+        all_cluster_list = set()
+        for stat_group in active_stat_groups:
+            all_cluster_list.update(
+                _get_stat_group_cluster_list(config_file, stat_group, global_cluster_list)
+            )
+        _bootstrap_clusters(list(all_cluster_list))
+        _prefetch_stats_metadata(config_file, active_stat_groups, global_cluster_list)
         for stat_group in active_stat_groups:
             _configure_stat_groups_via_file(
                 daemon, config_file, stat_group, global_cluster_list
             )
+        _save_stats_metadata_cache()
 
     # check that at least one stat group was added to the daemon.
-    if daemon.get_stat_set_count() == 0:
+    if daemon.get_stat_set_count() == 0 and not g_deferred_cluster_configs:
         print(
             "Please provide stat groups to query via "
             "command line args or via config file parameters.",
             file=sys.stderr,
         )
         sys.exit(1)
+    _configure_cluster_bootstrap_retries(daemon)
 
     _print_stat_groups(daemon)
 
@@ -731,6 +1317,7 @@ def configure_via_cli(daemon, args):
     """
     _configure_stat_groups_via_cli(daemon, args)
     _configure_stats_processor(daemon, args.stats_processor, args.processor_args)
+    _configure_cluster_bootstrap_retries(daemon)
 
     _print_stat_groups(daemon)
 
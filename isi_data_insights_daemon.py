@@ -3,30 +3,78 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 from builtins import object
+from future.utils import string_types
 import gevent
 import gevent.pool
 
 from daemons.prefab import run
 from ast import literal_eval
 import logging
-import sys
+import math
 import time
 import urllib3.exceptions
 
-from isi_stats_client import IsiStatsClient
-
-MAX_ASYNC_QUERIES = 20
+from isi_query_limiter import QueryLimiter
+from isi_stat_decoder import StatValueDecoder
+from isi_stats_rollup import RollupStatsProcessor
+from isi_stats_client import (
+    DEFAULT_MAX_PARALLEL_CHUNKS,
+    DERIVED_STAT_ERROR_CODE,
+    QUERY_ENGINE_SDK,
+    QUERY_ENGINES,
+    IsiStatsClient,
+    StatRecord,
+    build_query_keys,
+    intern_stat_key,
+)
+
+# Policies for dealing with an update that takes longer than its interval:
+# skip - drop the missed deadlines and wait for the next one on the timeline.
+# coalesce - run a single catch-up update for all of the missed deadlines right
+# away and then continue on the original timeline.
+# late - run the missed update right away and restart the timeline from then.
+OVERRUN_SKIP = "skip"
+OVERRUN_COALESCE = "coalesce"
+OVERRUN_LATE = "late"
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_COALESCE, OVERRUN_LATE)
+DEFAULT_OVERRUN_POLICY = OVERRUN_LATE
+# QueryPlans are compiled up front for every combination of a cluster's update
+# intervals if it has no more than this many of them, otherwise they are
+# compiled on first use.
+MAX_PRECOMPILED_INTERVALS = 8
+# stats whose name starts with this prefix have a value per node.
+NODE_STAT_PREFIX = "node."
+# stat that lists the devids of all the nodes of a cluster, which are needed in
+# order to split node stats queries into shards.
+NODE_LIST_STAT = "cluster.node.list.all"
+# how often, in seconds, the list of devids of each cluster is refreshed.
+NODE_LIST_REFRESH_INTERVAL = 300
+# how long, in seconds, to wait before the first and between the last retries
+# of the bootstrap of a cluster that was unreachable at startup.
+MIN_BOOTSTRAP_RETRY_INTERVAL = 30
+MAX_BOOTSTRAP_RETRY_INTERVAL = 600
+# how often, in seconds, the query limits and the overrun counts of the
+# clusters are logged.
+RUNTIME_STATS_LOG_INTERVAL = 300
+# the stats metadata cache is revalidated at most this often, in seconds, e.g.
+# while the metadata of a cluster can't be queried because it is unreachable.
+MIN_METADATA_REVALIDATION_INTERVAL = 300
 
 LOG = logging.getLogger(__name__)
 
 
 class ClusterConfig(object):
-    def __init__(self, address, name, version, isi_sdk, api_client):
+    def __init__(
+        self, address, name, version, isi_sdk, api_client, guid=None, release=None
+    ):
         self.address = address
         self.name = name
         self.version = version
         self.isi_sdk = isi_sdk
         self.api_client = api_client
+        # the cluster's GUID and OneFS release, if known
+        self.guid = guid
+        self.release = release
 
     def __eq__(self, other):
         """
@@ -45,88 +93,237 @@ class ClusterConfig(object):
         return self.name
 
 
-class DerivedStatsProcessor(object):
+class DerivedStatGraph(object):
+    """
+    The derived stat computers of a QueryPlan compiled into a dependency
+    graph. Each stat, queried or derived, is only passed to the computers that
+    consume its key and each computer is computed after all of the computers
+    that produce its inputs, so derived stats can be chained to any depth.
+    The graph is immutable, the state of each processing pass is kept in a
+    DerivedStatContext.
+    """
+
     def __init__(self, derived_stat_computers):
-        self._derived_stat_computers = derived_stat_computers
+        """
+        :param list derived_stat_computers: the computers in the order that
+        they are configured in, which is also the order that independent
+        computers are computed in.
+        :raises ValueError: if the computers depend on each other in a cycle.
+        """
+        producers = {}
+        for computer in derived_stat_computers:
+            for output_key in computer.output_keys():
+                producers.setdefault(output_key, []).append(computer)
+        # computer -> set of computers that produce its inputs
+        dependencies = {}
+        consumers = {}
+        for computer in derived_stat_computers:
+            computer_dependencies = dependencies[computer] = set()
+            for input_key in computer.input_keys():
+                consumers.setdefault(input_key, []).append(computer)
+                computer_dependencies.update(producers.get(input_key, ()))
+
+        # topological sort that keeps the configured order of the computers
+        # that don't depend on each other.
+        ordered = []
+        computed = set()
+        remaining = list(derived_stat_computers)
+        while remaining:
+            ready = [
+                computer
+                for computer in remaining
+                if dependencies[computer].issubset(computed)
+            ]
+            if not ready:
+                raise ValueError(
+                    "Derived stats have circular dependencies: %s."
+                    % ", ".join(computer.out_stat_name for computer in remaining)
+                )
+            for computer in ready:
+                ordered.append(computer)
+                computed.add(computer)
+                remaining.remove(computer)
+
+        self.computers = tuple(ordered)
+        computer_indexes = {computer: index for index, computer in enumerate(ordered)}
+        # stat key -> tuple of the indexes of the computers that consume it
+        self.consumers = {
+            input_key: tuple(computer_indexes[computer] for computer in key_consumers)
+            for input_key, key_consumers in consumers.items()
+        }
+
+    def begin_process(self, cluster_name, cluster_history):
+        """
+        Begin processing the stats of a cluster.
+        :param dict cluster_history: the state that the computers carry over
+        from one processing pass of the cluster to the next, see
+        DerivedStatContext.get_history.
+        :returns: the DerivedStatContext of the processing pass.
+        """
+        return DerivedStatContext(self, cluster_name, cluster_history)
 
-    def begin_process(self, cluster_name):
-        for derived_stat_computer in self._derived_stat_computers:
-            derived_stat_computer.begin_process(cluster_name)
+
+class DerivedStatContext(object):
+    """
+    The state of all of the computers of a DerivedStatGraph while they process
+    the stats of a single cluster. The computers are shared by all of the
+    clusters and don't keep any state of their own, so the stats of different
+    clusters can be processed concurrently, each pass with its own context.
+    """
+
+    def __init__(self, graph, cluster_name, cluster_history):
+        self.cluster_name = cluster_name
+        self._cluster_history = cluster_history
+        # owner -> state that is shared by several computers
+        self._shared_states = {}
+        self._computers = graph.computers
+        self._consumers = graph.consumers
+        self._states = [computer.new_state(self) for computer in graph.computers]
+
+    def get_history(self, computer):
+        """
+        :returns: the dict in which the computer keeps the state that it
+        carries over to its next processing pass of the cluster, e.g. the
+        previous values of its input stats.
+        """
+        try:
+            return self._cluster_history[computer]
+        except KeyError:
+            history = self._cluster_history[computer] = {}
+            return history
+
+    def get_shared_state(self, owner, factory):
+        """
+        :returns: the state of owner in this processing pass, which is created
+        by calling factory the first time that it is requested.
+        """
+        try:
+            return self._shared_states[owner]
+        except KeyError:
+            shared_state = self._shared_states[owner] = factory()
+            return shared_state
+
+    def computer_states(self):
+        """
+        :returns: the (computer, state) of each computer in the order that
+        they have to be computed in.
+        """
+        return zip(self._computers, self._states)
 
     def select_stat(self, stat):
-        for derived_stat_computer in self._derived_stat_computers:
-            derived_stat_computer.select_stat(stat)
+        try:
+            stat_consumers = self._consumers[stat.key]
+        except KeyError:
+            return
+        computers = self._computers
+        states = self._states
+        for index in stat_consumers:
+            computers[index].select_stat(states[index], stat)
 
-    def end_process(self, cluster_name):
-        for derived_stat_computer in self._derived_stat_computers:
-            derived_stat_computer.end_process(cluster_name)
+    def end_process(self):
+        for derived_stat_computer, state in self.computer_states():
+            derived_stat_computer.end_process(state)
 
-    def stats(self):
-        for derived_stat_computer in self._derived_stat_computers:
-            yield derived_stat_computer
+
+class DerivedStatState(object):
+    """
+    The state of a DerivedStatComputer while it processes the stats of a
+    single cluster. Computers add their own attributes in new_state.
+    """
+
+    def __init__(self, cluster_name, history):
+        self.cluster_name = cluster_name
+        # the state carried over from the previous processing pass of the
+        # cluster, see DerivedStatContext.get_history.
+        self.history = history
+        # devid -> list of the timestamps of the selected stats
+        self.selected_stat_timestamps = {}
 
 
 class DerivedStatComputer(object):
+    """
+    Computes a type of derived stat. The computers are shared by every
+    cluster, so all of the state of a processing pass is kept in the
+    DerivedStatState that new_state creates and that is passed to the other
+    methods.
+    """
+
+    # describes the type of derived stat in log messages
+    DESCRIPTION = "Derived stat"
+
     def __init__(self, out_stat_name):
-        self._initialize()
         self.out_stat_name = out_stat_name
 
-    def _initialize(self):
-        self._selected_stat_timestamps = {}
-        self._selected_stat_errors = {}
-
-    def begin_process(self, cluster_name):
-        self._initialize()
+    def new_state(self, context):
+        """
+        :param DerivedStatContext context: the context of the processing pass.
+        :returns: the DerivedStatState of the processing pass.
+        """
+        return DerivedStatState(context.cluster_name, context.get_history(self))
 
-    def end_process(self, cluster_name):
+    def end_process(self, state):
         pass
 
-    def process(self, stat):
+    def select_stat(self, state, stat):
         pass
 
-    def _choose_stat(self, stat):
+    def input_keys(self):
+        """
+        :returns: the keys of the stats that this computer selects.
+        """
+        return ()
+
+    def output_keys(self):
+        """
+        :returns: the keys of the stats that this computer derives.
+        """
+        return (self.out_stat_name,)
+
+    def compute_derived_stats(self, state):
+        return []
+
+    def _choose_stat(self, state, stat):
         LOG.debug("Choose stat: %s", stat.key)
         try:
-            self._selected_stat_timestamps[stat.devid].append(int(stat.time))
+            state.selected_stat_timestamps[stat.devid].append(int(stat.time))
         except KeyError:
-            self._selected_stat_timestamps[stat.devid] = [int(stat.time)]
-
-    def _create_derived_stat(self, value, devid=0, error=None):
-        class DerivedStat(object):
-            """ Pretend to be a Stat returned by PAPI """
-
-            def __init__(self, key, val, node, timestamp, err):
-                self.key = key
-                self.value = val
-                self.devid = node
-                self.time = timestamp
-                self.error = err
-                self.error_code = None if error is None else 1
+            state.selected_stat_timestamps[stat.devid] = [int(stat.time)]
 
+    def _create_derived_stat(self, state, value, devid=0, error=None):
+        # the timestamp of a derived stat is the average of the timestamps of
+        # the stats that it was derived from.
         avg_timestamp = 0
-        if error is not None:
+        if error is None:
             try:
-                avg_timestamp = self._get_timestamp_avg(devid)
+                avg_timestamp = self._get_timestamp_avg(state, devid)
             except ZeroDivisionError:
                 error = (
                     "Caught ZeroDivisionError from _get_timestamp_avg "
                     "for stat %s on node %s." % (self.out_stat_name, str(devid))
                 )
 
-        return DerivedStat(self.out_stat_name, value, devid, avg_timestamp, error)
+        return StatRecord(
+            self.out_stat_name,
+            devid,
+            avg_timestamp,
+            value,
+            error,
+            None if error is None else DERIVED_STAT_ERROR_CODE,
+        )
 
-    def _get_timestamp_avg(self, devid):
-        if devid not in self._selected_stat_timestamps and devid == 0:
+    def _get_timestamp_avg(self, state, devid):
+        selected_stat_timestamps = state.selected_stat_timestamps
+        if devid not in selected_stat_timestamps and devid == 0:
             tot = 0
             tot_count = 0
-            for node in self._selected_stat_timestamps:
-                tot += sum(self._selected_stat_timestamps[node])
-                tot_count += len(self._selected_stat_timestamps[node])
+            for node in selected_stat_timestamps:
+                tot += sum(selected_stat_timestamps[node])
+                tot_count += len(selected_stat_timestamps[node])
             return int(old_div(tot, tot_count))
         return int(
             old_div(
-                sum(self._selected_stat_timestamps[devid]),
-                len(self._selected_stat_timestamps[devid]),
+                sum(selected_stat_timestamps[devid]),
+                len(selected_stat_timestamps[devid]),
             )
         )
 
@@ -177,30 +374,57 @@ class DerivedStatInput(object):
 
 
 class ClusterCompositeStatComputer(DerivedStatComputer):
+    DESCRIPTION = "Cluster node composite stat"
+
     def __init__(self, input_stat, out_stat_name, operation):
         super(ClusterCompositeStatComputer, self).__init__(out_stat_name)
         self._input_stat = input_stat
         self._operation = operation
 
-    def _initialize(self):
-        super(ClusterCompositeStatComputer, self)._initialize()
-        self._selected_stat_values = []
+    def new_state(self, context):
+        state = super(ClusterCompositeStatComputer, self).new_state(context)
+        state.selected_stat_values = []
+        return state
 
-    def select_stat(self, stat):
+    def input_keys(self):
+        return (self._input_stat.name,)
+
+    def select_stat(self, state, stat):
         if stat.key == self._input_stat.name:
-            self._selected_stat_values.append(self._input_stat.get_value(stat.value))
-            self._choose_stat(stat)
+            state.selected_stat_values.append(self._input_stat.get_value(stat.value))
+            self._choose_stat(state, stat)
 
-    def compute_derived_stat(self):
+    def compute_derived_stat(self, state):
         LOG.debug(
             "CCSC %s(%s)",
             str(self._operation.__name__),
-            str(self._selected_stat_values),
+            str(state.selected_stat_values),
         )
-        return self._create_derived_stat(self._operation(self._selected_stat_values))
+        if not state.selected_stat_values:
+            return self._create_derived_stat(
+                state,
+                None,
+                error="Failed to compute %s: No node values were selected."
+                % self.out_stat_name,
+            )
+        try:
+            value = self._operation(state.selected_stat_values)
+        except Exception as exception:
+            return self._create_derived_stat(
+                state,
+                None,
+                error="Failed to compute %s: %s" % (self.out_stat_name, str(exception)),
+            )
+        return self._create_derived_stat(state, value)
+
+    def compute_derived_stats(self, state):
+        # composite stats always return only one derived stat
+        return [self.compute_derived_stat(state)]
 
 
 class EquationStatComputer(DerivedStatComputer):
+    DESCRIPTION = "Equation computed stat"
+
     def __init__(self, eq_func, input_stats, out_stat_name):
         super(EquationStatComputer, self).__init__(out_stat_name)
         self._eq_func = eq_func
@@ -222,29 +446,39 @@ class EquationStatComputer(DerivedStatComputer):
                 self._input_stat_locations[input_stat.full_name].append(index)
             except KeyError:
                 self._input_stat_locations[input_stat.full_name] = [index]
-
-    def _initialize(self):
-        super(EquationStatComputer, self)._initialize()
-        self._selected_stat_values = {}
-        self._nodes = set()
-
-    def select_stat(self, stat):
+        # list of (input stat full name, location(s) in the equation, whether
+        # it is a cluster stat)
+        self._input_stat_args = [
+            (in_stat_name, in_arg_locations, intern_stat_key(in_stat_name)[1])
+            for in_stat_name, in_arg_locations in self._input_stat_locations.items()
+        ]
+
+    def input_keys(self):
+        return tuple(self._input_stats_names.keys())
+
+    def new_state(self, context):
+        state = super(EquationStatComputer, self).new_state(context)
+        state.selected_stat_values = {}
+        state.nodes = set()
+        return state
+
+    def select_stat(self, state, stat):
         # check if this stat is included in this equation
         try:
             input_stats = self._input_stats_names[stat.key]
             # if there is an entry for this stat then it is part of my equation
-            self._choose_stat(stat)
-            self._nodes.add(stat.devid)
+            self._choose_stat(state, stat)
+            state.nodes.add(stat.devid)
         except KeyError:
             return
         for input_stat in input_stats:
             try:
-                selected_stats_by_node = self._selected_stat_values[
+                selected_stats_by_node = state.selected_stat_values[
                     input_stat.full_name
                 ]
             except KeyError:
-                self._selected_stat_values[input_stat.full_name] = {}
-                selected_stats_by_node = self._selected_stat_values[
+                state.selected_stat_values[input_stat.full_name] = {}
+                selected_stats_by_node = state.selected_stat_values[
                     input_stat.full_name
                 ]
 
@@ -254,20 +488,19 @@ class EquationStatComputer(DerivedStatComputer):
                 selected_stats_by_node = {}
                 selected_stats_by_node[stat.devid] = input_stat.get_value(stat.value)
 
-    def compute_derived_stats(self):
+    def compute_derived_stats(self, state):
         # return one derived stat per node that the selected stats were
         # collected for.
         derived_stats = []
-        for node in self._nodes:
+        eval_nodes = []
+        eval_args = []
+        for node in state.nodes:
             # for each node build a tuple of the args to the equation
             # by iterating through the intput stat names
             func_args = [None] * self._num_func_args
-            for in_stat_name in self._input_stat_locations.keys():
-                stat_node = node
-                if in_stat_name.startswith("cluster.") is True:
-                    stat_node = 0  # this is a cluster stat
-                stat_value = self._get_stat_value(in_stat_name, stat_node)
-                in_arg_locations = self._input_stat_locations[in_stat_name]
+            for in_stat_name, in_arg_locations, cluster_scoped in self._input_stat_args:
+                stat_node = 0 if cluster_scoped else node
+                stat_value = self._get_stat_value(state, in_stat_name, stat_node)
                 for in_arg_loc in in_arg_locations:
                     func_args[in_arg_loc] = stat_value
             # if there is at least one non-None arg then convert the Nones to
@@ -275,31 +508,52 @@ class EquationStatComputer(DerivedStatComputer):
             if self._null_to_zero(func_args) is False:
                 # failed to get this stat, so return error for it
                 derived_stat = self._create_derived_stat(
+                    state,
                     None,
                     node,
                     "Failed to get equation input for %s, "
                     "input params: %s." % (self.out_stat_name, tuple(func_args)),
                 )
+                derived_stats.append(derived_stat)
             else:
-                try:
-                    func_args_tuple = tuple(func_args)
-                    LOG.debug(
-                        "EQS [%s]=%s(%s)",
-                        str(node),
-                        str(self._eq_func),
-                        str(func_args_tuple),
-                    )
-                    derived_stat_value = self._eq_func(*func_args_tuple)
-                    derived_stat = self._create_derived_stat(derived_stat_value, node)
-                except Exception as exception:
-                    derived_stat = self._create_derived_stat(
-                        None,
-                        node,
-                        error="Exception caught evaluating "
-                        "expression for %s, input "
-                        "params: %s, exception: %s"
-                        % (self.out_stat_name, str(func_args_tuple), str(exception)),
+                eval_nodes.append(node)
+                eval_args.append(tuple(func_args))
+
+        if not eval_nodes:
+            return derived_stats
+        LOG.debug("EQS %s%s", str(self._eq_func), str(list(zip(eval_nodes, eval_args))))
+        # evaluate all the nodes in one call if the equation supports it, if
+        # that fails then one of the nodes failed, so fall back to evaluating
+        # them one at a time to find out which one.
+        evaluate_vector = getattr(self._eq_func, "evaluate_vector", None)
+        if evaluate_vector is not None:
+            try:
+                derived_stat_values = evaluate_vector(eval_args)
+            except Exception:
+                pass
+            else:
+                for node, derived_stat_value in zip(eval_nodes, derived_stat_values):
+                    derived_stats.append(
+                        self._create_derived_stat(state, derived_stat_value, node)
                     )
+                return derived_stats
+
+        for node, func_args_tuple in zip(eval_nodes, eval_args):
+            try:
+                derived_stat_value = self._eq_func(*func_args_tuple)
+                derived_stat = self._create_derived_stat(
+                    state, derived_stat_value, node
+                )
+            except Exception as exception:
+                derived_stat = self._create_derived_stat(
+                    state,
+                    None,
+                    node,
+                    error="Exception caught evaluating "
+                    "expression for %s, input "
+                    "params: %s, exception: %s"
+                    % (self.out_stat_name, str(func_args_tuple), str(exception)),
+                )
             derived_stats.append(derived_stat)
 
         return derived_stats
@@ -326,44 +580,48 @@ class EquationStatComputer(DerivedStatComputer):
 
         return True
 
-    def _get_stat_value(self, stat_name, node):
+    def _get_stat_value(self, state, stat_name, node):
         try:
-            return self._selected_stat_values[stat_name][node]
+            return state.selected_stat_values[stat_name][node]
         except KeyError:
             return None
 
 
 class PercentChangeStatComputer(DerivedStatComputer):
+    DESCRIPTION = "Percent change stat"
+
     def __init__(self, input_stat, out_stat_name):
         super(PercentChangeStatComputer, self).__init__(out_stat_name)
         self._input_stat = input_stat
-        # per node/cluster value
-        self._cur_values = {}
-        self._prev_values = {}
 
-    def begin_process(self, cluster_name):
-        super(PercentChangeStatComputer, self).begin_process(cluster_name)
-        self._cur_cluster_name = cluster_name
-        self._cur_values = {}
+    def new_state(self, context):
+        state = super(PercentChangeStatComputer, self).new_state(context)
+        # per node value
+        state.cur_values = {}
+        return state
 
-    def end_process(self, cluster_name):
-        super(PercentChangeStatComputer, self).end_process(cluster_name)
-        self._prev_values[cluster_name] = self._cur_values
+    def end_process(self, state):
+        super(PercentChangeStatComputer, self).end_process(state)
+        state.history["prev_values"] = state.cur_values
 
-    def select_stat(self, stat):
+    def input_keys(self):
+        return (self._input_stat.name,)
+
+    def select_stat(self, state, stat):
         if stat.key == self._input_stat.name:
-            self._cur_values[stat.devid] = self._input_stat.get_value(stat.value)
-            self._choose_stat(stat)
+            state.cur_values[stat.devid] = self._input_stat.get_value(stat.value)
+            self._choose_stat(state, stat)
 
-    def compute_derived_stats(self):
+    def compute_derived_stats(self, state):
         derived_stats = []
-        for node in self._cur_values:
+        for node in state.cur_values:
             try:
-                cur_value = self._cur_values[node]
+                cur_value = state.cur_values[node]
             except KeyError:
                 cur_value = None
             if cur_value is None:
                 derived_stat = self._create_derived_stat(
+                    state,
                     None,
                     node,
                     error="Unable to determine current value "
@@ -371,7 +629,7 @@ class PercentChangeStatComputer(DerivedStatComputer):
                 )
             else:
                 try:
-                    prev_values = self._prev_values[self._cur_cluster_name]
+                    prev_values = state.history["prev_values"]
                     # TREAT no previous value as zero?
                     prev_value = prev_values[node]
                     LOG.debug(
@@ -398,7 +656,9 @@ class PercentChangeStatComputer(DerivedStatComputer):
                     # no previous value will cause a KeyError
                     # so return 0% change
                     derived_stat_value = 0.0
-                derived_stat = self._create_derived_stat(derived_stat_value, node)
+                derived_stat = self._create_derived_stat(
+                    state, derived_stat_value, node
+                )
             derived_stats.append(derived_stat)
 
         return derived_stats
@@ -412,23 +672,278 @@ class StatsConfig(object):
         self.cluster_composite_stats = []
         self.equation_stats = []
         self.pct_change_stats = []
+        self.windowed_stats = []
         self.final_equation_stats = []
 
 
 class StatSet(object):
+    """
+    The stats and derived stats to query on a single cluster at a single
+    update interval.
+    """
+
     def __init__(self):
-        self.cluster_configs = []
         self.stats = set()
         self.cluster_composite_stats = []
         self.equation_stats = []
         self.pct_change_stats = []
+        self.windowed_stats = []
         self.final_equation_stats = []
 
 
+def _interval_stats(cluster_stat_sets):
+    """
+    :returns: a dict of update interval -> the stats queried at the interval,
+    used to tell whether a cluster's update intervals changed.
+    """
+    return {
+        update_interval: stat_set.stats
+        for update_interval, stat_set in cluster_stat_sets.items()
+    }
+
+
+class QueryPlan(object):
+    """
+    Immutable, precompiled description of the stats to query on a cluster and
+    the derived stats to compute from them when a particular set of the
+    cluster's update intervals is due.
+    """
+
+    __slots__ = (
+        "intervals",
+        "stats",
+        "query_keys",
+        "cluster_query_keys",
+        "node_query_keys",
+        "derived_stats",
+    )
+
+    def __init__(
+        self,
+        intervals,
+        stats,
+        cluster_composite_stats,
+        equation_stats,
+        pct_change_stats,
+        windowed_stats,
+        final_equation_stats,
+        max_keys_per_query=None,
+    ):
+        self.intervals = tuple(intervals)
+        self.stats = tuple(sorted(stats))
+        # the stat keys already joined and split into MAX_KEYS_LEN strings
+        self.query_keys = tuple(build_query_keys(self.stats, max_keys_per_query))
+        # the same keys split into cluster and node stats for node sharded
+        # queries.
+        self.cluster_query_keys = tuple(
+            build_query_keys(
+                [stat for stat in self.stats if not stat.startswith(NODE_STAT_PREFIX)],
+                max_keys_per_query,
+            )
+        )
+        self.node_query_keys = tuple(
+            build_query_keys(
+                [stat for stat in self.stats if stat.startswith(NODE_STAT_PREFIX)],
+                max_keys_per_query,
+            )
+        )
+        # the configured order of the derived stats is only a tie breaker,
+        # the graph orders them by their dependencies.
+        self.derived_stats = DerivedStatGraph(
+            list(cluster_composite_stats)
+            + list(equation_stats)
+            + list(pct_change_stats)
+            + list(windowed_stats)
+            + list(final_equation_stats)
+        )
+
+
+class ClusterQueryPlans(object):
+    """
+    The QueryPlans of a single cluster indexed by the bit mask of the update
+    intervals that are due (see ClusterSchedule.due_mask).
+    """
+
+    def __init__(self, cluster, interval_stat_sets, max_keys_per_query=None):
+        """
+        :param ClusterConfig cluster: the cluster the plans are for.
+        :param dict interval_stat_sets: update interval to StatSet of the stats
+        that are queried on the cluster at that interval.
+        :param int max_keys_per_query: optional max number of stat keys per
+        query, see build_query_keys.
+        """
+        self.cluster = cluster
+        self._max_keys_per_query = max_keys_per_query
+        self.intervals = tuple(sorted(interval_stat_sets.keys()))
+        self._stat_sets = [interval_stat_sets[interval] for interval in self.intervals]
+        self._plans = {}
+        if len(self.intervals) <= MAX_PRECOMPILED_INTERVALS:
+            for due_mask in range(1, 1 << len(self.intervals)):
+                self._plans[due_mask] = self._compile(due_mask)
+
+    def get_plan(self, due_mask):
+        try:
+            return self._plans[due_mask]
+        except KeyError:
+            # too many intervals to compile every combination up front, so
+            # compile this one now and keep it for next time.
+            self._plans[due_mask] = plan = self._compile(due_mask)
+            return plan
+
+    def _compile(self, due_mask):
+        intervals = []
+        stats = set()
+        derived_stats = ([], [], [], [], [])
+        for index in range(0, len(self.intervals)):
+            if not due_mask & (1 << index):
+                continue
+            intervals.append(self.intervals[index])
+            stat_set = self._stat_sets[index]
+            stats.update(stat_set.stats)
+            for derived_stats_list, stat_set_derived_stats in zip(
+                derived_stats,
+                (
+                    stat_set.cluster_composite_stats,
+                    stat_set.equation_stats,
+                    stat_set.pct_change_stats,
+                    stat_set.windowed_stats,
+                    stat_set.final_equation_stats,
+                ),
+            ):
+                for derived_stat in stat_set_derived_stats:
+                    if derived_stat not in derived_stats_list:
+                        derived_stats_list.append(derived_stat)
+        return QueryPlan(
+            intervals, stats, *derived_stats, max_keys_per_query=self._max_keys_per_query
+        )
+
+
 class UpdateInterval(object):
+    """
+    Drift-free timeline of a single update interval. The deadlines are always
+    computed from the anchor time, rather than from the time at which the
+    previous update finished, so the length of a query does not shift the
+    timeline.
+    """
+
     def __init__(self, interval):
         self.interval = interval
-        self.last_update = 0.0
+        self.anchor = 0.0
+        self.next_update = 0.0
+
+    def start(self, start_time):
+        self.anchor = start_time
+        self.next_update = start_time
+
+    def next_slot(self, after_time):
+        """
+        Return the first deadline on the timeline that is after after_time.
+        """
+        num_slots = int(math.floor(old_div(after_time - self.anchor, self.interval)))
+        next_slot = self.anchor + (num_slots + 1) * self.interval
+        # guard against floating point error when after_time is on the timeline
+        if next_slot <= after_time:
+            next_slot += self.interval
+        return next_slot
+
+
+class OverrunCounters(object):
+    def __init__(self):
+        # number of deadlines that were dropped (OVERRUN_SKIP)
+        self.skipped = 0
+        # number of deadlines that were folded into a single catch-up update
+        # (OVERRUN_COALESCE)
+        self.coalesced = 0
+        # number of updates that were run late and re-anchored the timeline
+        # (OVERRUN_LATE)
+        self.late = 0
+
+    def __repr__(self):
+        return "skipped=%d coalesced=%d late=%d" % (
+            self.skipped,
+            self.coalesced,
+            self.late,
+        )
+
+
+class ClusterSchedule(object):
+    """
+    The set of update interval timelines of a single cluster. Each cluster is
+    scheduled independently of the others so that one slow cluster can't delay
+    the updates of the rest of them.
+    """
+
+    def __init__(self, cluster, intervals, overrun_policy):
+        self.cluster = cluster
+        self.overrun_policy = overrun_policy
+        self.update_intervals = [UpdateInterval(interval) for interval in intervals]
+        self.overruns = OverrunCounters()
+        # set when the cluster's stats are reconfigured, which replaces the
+        # schedule with a new one.
+        self.cancelled = False
+
+    def start(self, start_time):
+        for update_interval in self.update_intervals:
+            update_interval.start(start_time)
+
+    def next_update(self):
+        return min(
+            update_interval.next_update for update_interval in self.update_intervals
+        )
+
+    def due_mask(self, cur_time):
+        """
+        Return a bit mask of the update intervals that are due at cur_time,
+        bit N is set if self.update_intervals[N] is due.
+        """
+        due_mask = 0
+        interval_bit = 1
+        for update_interval in self.update_intervals:
+            if update_interval.next_update <= cur_time:
+                due_mask |= interval_bit
+            interval_bit <<= 1
+        return due_mask
+
+    def advance(self, due_mask, end_time):
+        """
+        Move the deadlines of the update intervals that were just updated
+        forward and apply the overrun policy to those whose next deadline was
+        already missed by the time the update finished at end_time.
+        """
+        interval_bit = 1
+        for update_interval in self.update_intervals:
+            is_due = due_mask & interval_bit
+            interval_bit <<= 1
+            if not is_due:
+                continue
+            next_update = update_interval.next_slot(update_interval.next_update)
+            if next_update > end_time:
+                update_interval.next_update = next_update
+                continue
+            # the update took longer than the interval, so one or more
+            # deadlines have already passed.
+            missed = (
+                int(old_div(end_time - next_update, update_interval.interval)) + 1
+            )
+            if self.overrun_policy == OVERRUN_SKIP:
+                self.overruns.skipped += missed
+                update_interval.next_update = update_interval.next_slot(end_time)
+            elif self.overrun_policy == OVERRUN_COALESCE:
+                self.overruns.coalesced += missed
+                update_interval.next_update = end_time
+            else:
+                self.overruns.late += 1
+                update_interval.start(end_time)
+            LOG.warning(
+                "Update of interval %d on cluster %s overran by %f seconds, "
+                "missed %d deadline(s), applying overrun policy %s (%s).",
+                update_interval.interval,
+                self.cluster.name,
+                end_time - next_update,
+                missed,
+                self.overrun_policy,
+                str(self.overruns),
+            )
 
 
 class IsiDataInsightsDaemon(run.RunDaemon):
@@ -444,11 +959,142 @@ class IsiDataInsightsDaemon(run.RunDaemon):
         """
         super(IsiDataInsightsDaemon, self).__init__(pidfile=pidfile)
         self._stat_sets = {}
-        self._update_intervals = []
         self._stats_processor = None
         self._stats_processor_args = None
         self._process_stats_func = None
-        self.async_worker_pool = gevent.pool.Pool(MAX_ASYNC_QUERIES)
+        self._overrun_policy = DEFAULT_OVERRUN_POLICY
+        self._cluster_schedules = []
+        self._query_plans = {}
+        self._query_limiter = QueryLimiter()
+        self._max_keys_per_query = None
+        self._max_parallel_chunks = DEFAULT_MAX_PARALLEL_CHUNKS
+        self._node_shard_size = None
+        self._cluster_devids = {}
+        # cluster address -> IsiStatsClient
+        self._stats_clients = {}
+        # cluster name -> the state that the derived stat computers carry over
+        # from one processing pass of the cluster to the next.
+        self._derived_stat_history = {}
+        self._query_engine = QUERY_ENGINE_SDK
+        self._value_decoder = StatValueDecoder()
+        self._stats_metadata_cache = None
+        self._query_stats_metadata_func = None
+        self._reconfigure_cluster_func = None
+        # list of (cluster address, bootstrap function) of the clusters that
+        # still have to be bootstrapped
+        self._cluster_bootstraps = []
+        self._cluster_loops = None
+
+    def set_overrun_policy(self, overrun_policy):
+        """
+        Set the policy applied when a cluster's update takes longer than its
+        update interval.
+        :param string overrun_policy: one of OVERRUN_POLICIES.
+        """
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(
+                "Invalid overrun policy: %s, must be one of %s."
+                % (overrun_policy, ", ".join(OVERRUN_POLICIES))
+            )
+        self._overrun_policy = overrun_policy
+
+    def set_stats_metadata_cache(
+        self, stats_metadata_cache, query_func, reconfigure_func=None
+    ):
+        """
+        Set the StatsMetadataCache whose stale entries are revalidated in the
+        background while the daemon is running.
+        :param function query_func: the function used to query a cluster for
+        stats metadata, see StatsMetadataCache.revalidate.
+        :param function reconfigure_func: if specified then it is called with
+        the ClusterConfig of each cluster whose stats metadata changed, and is
+        expected to add the cluster's stats again via add_stats, so that their
+        update intervals are recomputed from the new metadata.
+        """
+        self._stats_metadata_cache = stats_metadata_cache
+        self._query_stats_metadata_func = query_func
+        self._reconfigure_cluster_func = reconfigure_func
+
+    def add_cluster_bootstrap(self, cluster_address, bootstrap_func):
+        """
+        Add a cluster that could not be reached when the daemon was
+        configured. Once the daemon is running, bootstrap_func is retried in
+        the background until it succeeds, at which point it is expected to have
+        added the cluster's stats via add_stats, and then the cluster's stats
+        are queried the same as every other cluster's.
+        :param string cluster_address: the address of the cluster.
+        :param function bootstrap_func: called without arguments, raises an
+        exception if the cluster is still unreachable.
+        """
+        self._cluster_bootstraps.append((cluster_address, bootstrap_func))
+
+    def set_stats_query_engine(self, query_engine):
+        """
+        Set the engine that the current stats are queried with.
+        :param string query_engine: one of isi_stats_client.QUERY_ENGINES.
+        """
+        if query_engine not in QUERY_ENGINES:
+            raise ValueError(
+                "Invalid stats query engine: %s, must be one of %s."
+                % (query_engine, ", ".join(QUERY_ENGINES))
+            )
+        self._query_engine = query_engine
+
+    def set_query_limits(self, max_queries, max_cluster_queries, latency_target):
+        """
+        Configure the concurrency limits of the PAPI stats queries.
+        :param int max_queries: max number of queries in flight in total.
+        :param int max_cluster_queries: max number of queries in flight to a
+        single cluster, the actual per cluster limit adapts between 1 and this
+        value depending on the latency and error rate of the cluster.
+        :param float latency_target: queries that take longer than this many
+        seconds cause the cluster's limit to be decreased.
+        """
+        self._query_limiter.configure(max_queries, max_cluster_queries, latency_target)
+
+    def set_query_chunking(self, max_keys_per_query, max_parallel_chunks):
+        """
+        Configure how the stats queried from a cluster are split into chunks.
+        Must be called before add_stats.
+        :param int max_keys_per_query: max number of stat keys per query, or
+        None to only limit each query by the length of its keys (MAX_KEYS_LEN).
+        :param int max_parallel_chunks: max number of chunks of a cluster's
+        stats that are queried in parallel.
+        """
+        if max_keys_per_query is not None and max_keys_per_query < 1:
+            raise ValueError("Max keys per query must be at least 1.")
+        if max_parallel_chunks < 1:
+            raise ValueError("Max parallel chunks must be at least 1.")
+        self._max_keys_per_query = max_keys_per_query
+        self._max_parallel_chunks = max_parallel_chunks
+
+    def set_node_shard_size(self, node_shard_size):
+        """
+        Query the node stats of clusters with more than node_shard_size nodes
+        in parallel shards of node_shard_size nodes each, rather than all nodes
+        at once.
+        :param int node_shard_size: max number of nodes per shard, or None to
+        always query all nodes at once.
+        """
+        if node_shard_size is not None and node_shard_size < 1:
+            raise ValueError("Node shard size must be at least 1.")
+        self._node_shard_size = node_shard_size
+
+    def get_query_limiter_stats(self):
+        """
+        Return the current concurrency limits, number of queries in flight and
+        queue depths, in total and per cluster.
+        """
+        return self._query_limiter.get_stats()
+
+    def get_overrun_counts(self):
+        """
+        Return a dict of cluster name to the OverrunCounters of that cluster.
+        """
+        return {
+            schedule.cluster.name: schedule.overruns
+            for schedule in self._cluster_schedules
+        }
 
     def set_stats_processor(self, stats_processor, processor_args):
         self._stats_processor = stats_processor
@@ -471,6 +1117,29 @@ class IsiDataInsightsDaemon(run.RunDaemon):
             LOG.info("Starting stats processor.")
             self._stats_processor.start(self._stats_processor_args)
 
+    def set_stats_rollups(self, windows, forward_raw_stats, max_series):
+        """
+        Roll up the stats over each of the windows before they are passed to
+        the stats processor, see RollupStatsProcessor. Must be called after
+        set_stats_processor.
+        :param list windows: a list of (label, length in seconds) tuples, or
+        an empty list to not roll up the stats.
+        :param bool forward_raw_stats: whether to also pass the raw stats to the
+        stats processor or only the rollups.
+        :param int max_series: max number of series that are rolled up at once.
+        """
+        if not windows:
+            return
+        if self._process_stats_func != self._process_stats_with_derived_stats:
+            raise ValueError(
+                "Rollups require a stats processor with a process_stat() function."
+            )
+        if max_series < 1:
+            raise ValueError("Max rollup series must be at least 1.")
+        self._stats_processor = RollupStatsProcessor(
+            self._stats_processor, windows, forward_raw_stats, max_series
+        )
+
     def _init_derived_stats_processor(self):
         # if the stats processor doesn't define begin_process or end_process,
         # then add a noop version so we don't have to check each time we
@@ -489,80 +1158,239 @@ class IsiDataInsightsDaemon(run.RunDaemon):
         :param: stats_config is an instance of StatsConfig, which defines the
         list of stats, an update interval, and the list of clusters to query.
         """
-        try:
-            # organize the stat sets by update interval
-            stat_set = self._stat_sets[stats_config.update_interval]
-        except KeyError:
-            self._stat_sets[stats_config.update_interval] = stat_set = StatSet()
-            self._update_intervals.append(UpdateInterval(stats_config.update_interval))
-
-        # add the new clusters to the list of clusters associated with this
-        # update interval's stat set.
         for cluster in stats_config.cluster_configs:
-            if cluster not in stat_set.cluster_configs:
-                # TODO this is a bug - this causes these stats to be queried on
-                # all clusters in this update interval, not just the clusters
-                # defined in this stats_config
-                stat_set.cluster_configs.append(cluster)
-
-        # add the new stats to the stat set
-        for stat_name in stats_config.stats:
-            stat_set.stats.add(stat_name)
-
-        stat_set.cluster_composite_stats.extend(stats_config.cluster_composite_stats)
-
-        stat_set.equation_stats.extend(stats_config.equation_stats)
-
-        stat_set.pct_change_stats.extend(stats_config.pct_change_stats)
-
-        stat_set.final_equation_stats.extend(stats_config.final_equation_stats)
+            # organize the stat sets by cluster and then by update interval so
+            # that each cluster is only queried for the stats that were
+            # configured for it.
+            try:
+                cluster_stat_sets = self._stat_sets[cluster]
+            except KeyError:
+                self._stat_sets[cluster] = cluster_stat_sets = {}
+            try:
+                stat_set = cluster_stat_sets[stats_config.update_interval]
+            except KeyError:
+                cluster_stat_sets[stats_config.update_interval] = stat_set = StatSet()
+
+            # add the new stats to the stat set
+            stat_set.stats.update(stats_config.stats)
+
+            for stat_set_derived_stats, derived_stats in (
+                (
+                    stat_set.cluster_composite_stats,
+                    stats_config.cluster_composite_stats,
+                ),
+                (stat_set.equation_stats, stats_config.equation_stats),
+                (stat_set.pct_change_stats, stats_config.pct_change_stats),
+                (stat_set.windowed_stats, stats_config.windowed_stats),
+                (stat_set.final_equation_stats, stats_config.final_equation_stats),
+            ):
+                for derived_stat in derived_stats:
+                    if derived_stat not in stat_set_derived_stats:
+                        stat_set_derived_stats.append(derived_stat)
 
     def get_stat_set_count(self):
-        return len(self._stat_sets)
+        return sum(
+            len(cluster_stat_sets) for cluster_stat_sets in self._stat_sets.values()
+        )
 
     def get_next_stat_set(self):
-        for update_interval, stat_set in self._stat_sets.items():
-            yield update_interval, stat_set
+        for cluster, cluster_stat_sets in self._stat_sets.items():
+            for update_interval, stat_set in cluster_stat_sets.items():
+                yield cluster, update_interval, stat_set
 
     def run(self, debug=False):
         """
-        Loop through stat sets, query for their values, and process them with
-        the stats processor.
+        Start an independent update loop for each cluster that queries for
+        the cluster's stats and processes them with the stats processor.
         """
         LOG.info("Starting.")
 
-        sleep_secs = 0
+        self._cluster_loops = gevent.pool.Group()
+        self._start_cluster_loops(debug)
+        for cluster_address, bootstrap_func in self._cluster_bootstraps:
+            self._cluster_loops.spawn(
+                self._cluster_bootstrap_loop, cluster_address, bootstrap_func, debug
+            )
+        if self._stats_metadata_cache is not None:
+            gevent.spawn(self._revalidate_stats_metadata_loop, debug)
+        gevent.spawn(self._log_runtime_stats_loop)
+        self._cluster_loops.join(raise_error=debug)
+
+    def _log_runtime_stats_loop(self):
+        """
+        Periodically log the adaptive query limits and the overrun counts of
+        the clusters, so that it is visible when a cluster is throttled or
+        can't keep up with its update intervals.
+        """
+        while True:
+            time.sleep(RUNTIME_STATS_LOG_INTERVAL)
+            limiter_stats = self.get_query_limiter_stats()
+            LOG.info(
+                "Queries in flight: %d of %d, queued: %d.",
+                limiter_stats["in_flight"],
+                limiter_stats["limit"],
+                limiter_stats["queued"],
+            )
+            overrun_counts = self.get_overrun_counts()
+            for cluster_name, cluster_stats in limiter_stats["clusters"].items():
+                LOG.info(
+                    "Cluster %s query limit: %d, in flight: %d, queued: %d, "
+                    "latency: %s, error rate: %.2f, overruns: %s.",
+                    cluster_name,
+                    cluster_stats["limit"],
+                    cluster_stats["in_flight"],
+                    cluster_stats["queued"],
+                    "-"
+                    if cluster_stats["latency"] is None
+                    else "%.2fs" % cluster_stats["latency"],
+                    cluster_stats["error_rate"],
+                    overrun_counts.get(cluster_name),
+                )
+
+    def _revalidate_stats_metadata_loop(self, debug):
+        """
+        Revalidate the stats metadata cache each time its oldest entry
+        expires and reconfigure the clusters whose metadata changed.
+        """
+        while True:
+            next_time = self._stats_metadata_cache.next_revalidation_time()
+            if next_time is None:
+                sleep_secs = self._stats_metadata_cache.ttl
+            else:
+                sleep_secs = next_time - time.time()
+            time.sleep(max(sleep_secs, MIN_METADATA_REVALIDATION_INTERVAL))
+            changed_clusters = self._stats_metadata_cache.revalidate(
+                self._query_stats_metadata_func
+            )
+            if self._reconfigure_cluster_func is None:
+                continue
+            for cluster in changed_clusters:
+                self._reconfigure_cluster(cluster, debug)
+
+    def _reconfigure_cluster(self, cluster, debug):
+        """
+        Add the stats of a cluster again via the reconfigure function and, if
+        their update intervals changed, replace the cluster's update loop.
+        """
+        old_stat_sets = self._stat_sets.pop(cluster, None)
+        try:
+            self._reconfigure_cluster_func(cluster)
+        except Exception:
+            LOG.exception("Failed to reconfigure stats of cluster %s.", cluster.name)
+            self._stat_sets.pop(cluster, None)
+        new_stat_sets = self._stat_sets.get(cluster)
+        if not new_stat_sets or _interval_stats(new_stat_sets) == _interval_stats(
+            old_stat_sets or {}
+        ):
+            # keep the current update loop if the reconfiguration failed or
+            # didn't change anything.
+            if old_stat_sets is not None:
+                self._stat_sets[cluster] = old_stat_sets
+            return
+        LOG.info(
+            "Update intervals of cluster %s changed from %s to %s.",
+            cluster.name,
+            sorted(old_stat_sets or {}),
+            sorted(new_stat_sets),
+        )
+        for schedule in self._cluster_schedules:
+            if schedule.cluster == cluster:
+                schedule.cancelled = True
+        self._cluster_schedules = [
+            schedule
+            for schedule in self._cluster_schedules
+            if schedule.cancelled is False
+        ]
+        self._start_cluster_loops(debug)
+
+    def _start_cluster_loops(self, debug):
+        """
+        Start the update loop of each cluster that doesn't have one yet.
+        """
         start_time = time.time()
-        # setup the last update time of each update interval so that they all
-        # get updated on the first pass.
-        for update_interval in self._update_intervals:
-            update_interval.last_update = start_time - update_interval.interval
+        started_clusters = set(schedule.cluster for schedule in self._cluster_schedules)
+        for cluster, cluster_stat_sets in self._stat_sets.items():
+            if cluster in started_clusters:
+                continue
+            # the plans are compiled once all of the cluster's stats were
+            # added, rather than on each add_stats call.
+            query_plans = self._query_plans[cluster] = ClusterQueryPlans(
+                cluster, cluster_stat_sets, self._max_keys_per_query
+            )
+            schedule = ClusterSchedule(
+                cluster, query_plans.intervals, self._overrun_policy
+            )
+            self._cluster_schedules.append(schedule)
+            # setup the timelines of each cluster so that they all get updated
+            # on the first pass.
+            schedule.start(start_time)
+            self._cluster_loops.spawn(self._cluster_loop, schedule, debug)
 
+    def _cluster_bootstrap_loop(self, cluster_address, bootstrap_func, debug):
+        """
+        Retry the bootstrap of an unreachable cluster with exponential backoff
+        and start its update loop once it succeeds.
+        """
+        retry_interval = MIN_BOOTSTRAP_RETRY_INTERVAL
         while True:
-            LOG.debug("Sleeping for %f seconds.", sleep_secs)
+            time.sleep(retry_interval)
+            try:
+                bootstrap_func()
+                break
+            except Exception as exc:
+                retry_interval = min(retry_interval * 2, MAX_BOOTSTRAP_RETRY_INTERVAL)
+                LOG.warning(
+                    "Failed to bootstrap cluster %s, retrying in %d seconds. "
+                    "Error: %s",
+                    cluster_address,
+                    retry_interval,
+                    str(exc),
+                )
+        LOG.info("Bootstrapped cluster %s.", cluster_address)
+        self._start_cluster_loops(debug)
+
+    def _cluster_loop(self, schedule, debug):
+        """
+        Query and process the stats of a single cluster each time one or more
+        of its update intervals is due.
+        """
+        query_plans = self._query_plans[schedule.cluster]
+        while True:
+            sleep_secs = max(0.0, schedule.next_update() - time.time())
+            LOG.debug(
+                "Sleeping for %f seconds on cluster %s.",
+                sleep_secs,
+                schedule.cluster.name,
+            )
             time.sleep(sleep_secs)
+            if schedule.cancelled is True:
+                return
 
-            # query and process the stat sets whose update interval has been
-            # hit or surpassed.
-            self._query_and_process_stats(time.time(), debug)
-
-            cur_time = time.time()
-            # figure out the shortest amount of time until the next update is
-            # needed and sleep for that amount of time.
-            min_next_update = sys.float_info.max
-            for update_interval in self._update_intervals:
-                next_update_time = (
-                    update_interval.last_update + update_interval.interval
+            due_mask = schedule.due_mask(time.time())
+            try:
+                if due_mask:
+                    self._query_and_process_stats(
+                        schedule.cluster, query_plans.get_plan(due_mask), debug
+                    )
+            except Exception:
+                # a failed pass must not stop the cluster's loop, so only
+                # re-raise in debug mode, in which bugs should be fatal.
+                if debug is True:
+                    raise
+                LOG.exception(
+                    "Failed to process stats of cluster %s.", schedule.cluster.name
                 )
-
-                time_to_next_update = next_update_time - cur_time
-                min_next_update = min(time_to_next_update, min_next_update)
-            sleep_secs = max(0.0, min_next_update)
+            schedule.advance(due_mask, time.time())
 
     def shutdown(self, signum):
         """
         Stops the stats processor prior to stopping the daemon.
         """
+        if gevent.getcurrent() is gevent.get_hub():
+            # the signal handler was called from the event loop, which can't
+            # wait for the stats processor to flush, so stop from a greenlet.
+            gevent.spawn(self.shutdown, signum)
+            return
         LOG.info("Stopping.")
         if (
             self._stats_processor is not None
@@ -572,95 +1400,33 @@ class IsiDataInsightsDaemon(run.RunDaemon):
             self._stats_processor.stop()
         super(IsiDataInsightsDaemon, self).shutdown(signum)
 
-    def _query_and_process_stats(self, cur_time, debug):
-        """
-        Build a unique set of stats to update per cluster from each set of
-        stats that are in need of updating based on the amount of time elapsed
-        since their last update.
-        """
-        # there might be more than one stat set that needs updating and thus
-        # there might be common clusters between those stat sets, so this loop
-        # makes sure that we only send one query to each unique cluster.
-        cluster_stats = {}
-        for update_interval in self._update_intervals:
-            # if the update_interval is less than or equal to the elapsed_time
-            # then we need to query the stats associated with this update
-            # interval.
-            time_since_last_update = cur_time - update_interval.last_update
-            if time_since_last_update >= update_interval.interval:
-                LOG.debug(
-                    "updating interval:%d time_since_last_update: %f",
-                    update_interval.interval,
-                    time_since_last_update,
-                )
-                # update the last_update time
-                update_interval.last_update = cur_time
-                # add the stats from stat set to their respective cluster_stats
-                cur_stat_set = self._stat_sets[update_interval.interval]
-                for cluster in cur_stat_set.cluster_configs:
-                    try:
-                        (
-                            cluster_stat_set,
-                            cluster_composite_stats,
-                            equation_stats,
-                            pct_change_stats,
-                            final_equation_stats,
-                        ) = cluster_stats[cluster]
-                        cluster_composite_stats.extend(
-                            cur_stat_set.cluster_composite_stats
-                        )
-                        equation_stats.extend(cur_stat_set.equation_stats)
-                        pct_change_stats.extend(cur_stat_set.pct_change_stats)
-                        final_equation_stats.extend(cur_stat_set.final_equation_stats)
-                    except KeyError:
-                        cluster_stat_set = set()
-                        cluster_stats[cluster] = (
-                            cluster_stat_set,
-                            cur_stat_set.cluster_composite_stats,
-                            cur_stat_set.equation_stats,
-                            cur_stat_set.pct_change_stats,
-                            cur_stat_set.final_equation_stats,
-                        )
-
-                    for stat_name in cur_stat_set.stats:
-                        cluster_stat_set.add(stat_name)
-
-        # now we have a unique list of clusters to query, so query them
-        for (
-            cluster,
-            (stats, composite_stats, eq_stats, pct_change_stats, final_eq_stats),
-        ) in cluster_stats.items():
-            self.async_worker_pool.spawn(
-                self._query_and_process_stats1,
-                cluster,
-                stats,
-                composite_stats,
-                eq_stats,
-                pct_change_stats,
-                final_eq_stats,
-                debug,
-            )
-        self.async_worker_pool.join()
+    def _query_and_process_stats(self, cluster, query_plan, debug):
+        """
+        Query and process the stats of the cluster's QueryPlan for the set of
+        update intervals that are due.
+        """
+        LOG.debug(
+            "updating intervals:%s on cluster %s",
+            str(query_plan.intervals),
+            cluster.name,
+        )
+        self._query_and_process_stats1(cluster, query_plan, debug)
 
-    def _query_and_process_stats1(
-        self,
-        cluster,
-        stats,
-        composite_stats,
-        eq_stats,
-        pct_change_stats,
-        final_eq_stats,
-        debug,
-    ):
+    def _query_and_process_stats1(self, cluster, query_plan, debug):
         LOG.debug("Querying cluster %s %f", cluster.name, cluster.version)
-        LOG.debug("Querying stats %d.", len(stats))
-        stats_client = IsiStatsClient(cluster.isi_sdk.StatisticsApi(cluster.api_client))
+        LOG.debug("Querying stats %d.", len(query_plan.stats))
+        stats_client = self._get_stats_client(cluster)
         # query the current cluster with the current set of stats
         try:
             if cluster.version >= 8.0:
-                results = stats_client.query_stats(stats)
+                if self._node_shard_size is not None and query_plan.node_query_keys:
+                    results = self._node_sharded_query(
+                        cluster, query_plan, stats_client
+                    )
+                else:
+                    results = stats_client.query_stats_keys(query_plan.query_keys)
             else:
-                results = self._v7_2_multistat_query(stats, stats_client)
+                results = self._v7_2_multistat_query(query_plan.stats, stats_client)
         except (
             urllib3.exceptions.HTTPError,
             cluster.isi_sdk.rest.ApiException,
@@ -685,21 +1451,86 @@ class IsiDataInsightsDaemon(run.RunDaemon):
             else:
                 raise gen_exc
 
-        composite_stats_processor = DerivedStatsProcessor(composite_stats)
-        equation_stats_processor = DerivedStatsProcessor(eq_stats)
-        pct_change_stats_processor = DerivedStatsProcessor(pct_change_stats)
-        final_equation_stats_processor = DerivedStatsProcessor(final_eq_stats)
-        derived_stats_processors = (
-            composite_stats_processor,
-            equation_stats_processor,
-            pct_change_stats_processor,
-            final_equation_stats_processor,
-        )
         # calls either _process_all_stats or
         # _process_stats_with_derived_stats depending on whether or not the
         # _stats_processor has a process_stat function or just a process
         # function. The latter requires the process_stat function.
-        self._process_stats_func(cluster.name, results, derived_stats_processors)
+        self._process_stats_func(cluster.name, results, query_plan.derived_stats)
+
+    def _get_stats_client(self, cluster):
+        """
+        Get the IsiStatsClient of the cluster, which is built once and shared
+        by all of the cluster's queries.
+        """
+        try:
+            return self._stats_clients[cluster.address]
+        except KeyError:
+            pass
+        # the query limiter bounds the number of queries in flight in total and
+        # to each cluster.
+        stats_client = IsiStatsClient(
+            cluster.isi_sdk.StatisticsApi(cluster.api_client),
+            self._query_limiter.cluster_limit(cluster.name),
+            self._max_parallel_chunks,
+            self._query_engine,
+        )
+        self._stats_clients[cluster.address] = stats_client
+        return stats_client
+
+    def _node_sharded_query(self, cluster, query_plan, stats_client):
+        devids = self._get_cluster_devids(cluster, stats_client)
+        if devids is None or len(devids) <= self._node_shard_size:
+            return stats_client.query_stats_keys(query_plan.query_keys)
+
+        cluster_query = None
+        if query_plan.cluster_query_keys:
+            cluster_query = gevent.spawn(
+                stats_client.query_stats_keys, query_plan.cluster_query_keys
+            )
+        try:
+            results = stats_client.query_node_stats_keys(
+                query_plan.node_query_keys, devids, self._node_shard_size
+            )
+        except BaseException:
+            if cluster_query is not None:
+                cluster_query.kill()
+            raise
+        if cluster_query is not None:
+            results.extend(cluster_query.get())
+        return results
+
+    def _get_cluster_devids(self, cluster, stats_client):
+        """
+        Get the list of devids of the cluster's nodes, which is cached for
+        NODE_LIST_REFRESH_INTERVAL seconds. Returns None if the list could not
+        be queried.
+        """
+        cur_time = time.time()
+        try:
+            devids, expiration = self._cluster_devids[cluster]
+            if cur_time < expiration:
+                return devids
+        except KeyError:
+            pass
+
+        devids = None
+        try:
+            node_list = stats_client.query_stats_keys([NODE_LIST_STAT])[0]
+            if node_list.error is not None:
+                raise RuntimeError(node_list.error)
+            devids = node_list.value
+            if isinstance(devids, string_types):
+                devids = literal_eval(devids)
+            devids = sorted(int(devid) for devid in devids)
+        except Exception as exc:
+            LOG.warning(
+                "Failed to query the list of nodes of cluster %s, querying all "
+                "nodes at once. Exception raised: %s",
+                cluster.name,
+                str(exc),
+            )
+        self._cluster_devids[cluster] = (devids, cur_time + NODE_LIST_REFRESH_INTERVAL)
+        return devids
 
     def _v7_2_multistat_query(self, stats, stats_client):
         result = []
@@ -720,16 +1551,13 @@ class IsiDataInsightsDaemon(run.RunDaemon):
     ):
         LOG.debug("Processing stat results on %s", cluster_name)
         self._stats_processor.begin_process(cluster_name)
-        (
-            cluster_composite_stats,
-            equation_stats,
-            pct_change_stats,
-            final_equation_stats,
-        ) = derived_stats
-        cluster_composite_stats.begin_process(cluster_name)
-        equation_stats.begin_process(cluster_name)
-        pct_change_stats.begin_process(cluster_name)
-        final_equation_stats.begin_process(cluster_name)
+        try:
+            cluster_history = self._derived_stat_history[cluster_name]
+        except KeyError:
+            cluster_history = self._derived_stat_history[cluster_name] = {}
+        derived_stat_context = derived_stats.begin_process(
+            cluster_name, cluster_history
+        )
         # process the results
         for stat in stats_query_results:
             # check if the stat query returned an error
@@ -745,121 +1573,37 @@ class IsiDataInsightsDaemon(run.RunDaemon):
             # let stats processor process it
             self._stats_processor.process_stat(cluster_name, stat)
             # allow derived stats to select/use this stat
-            cluster_composite_stats.select_stat(stat)
-            equation_stats.select_stat(stat)
-            pct_change_stats.select_stat(stat)
-            final_equation_stats.select_stat(stat)
-
-        LOG.debug("Processing composite stats on %s", cluster_name)
-        for composite_stat in cluster_composite_stats.stats():
-            # composite stats always return only one derived stat
-            derived_stat = composite_stat.compute_derived_stat()
-            if derived_stat.error is not None:
-                LOG.warning(
-                    "Cluster node composite stat: "
-                    "'%s' on '%s', returned error: '%s'.",
-                    str(derived_stat.key),
-                    cluster_name,
-                    str(derived_stat.error),
-                )
-                continue
-            LOG.debug(
-                "ClusterCompositeStat[%s]=%s", derived_stat.key, str(derived_stat.value)
-            )
-            # let stats processor process it
-            self._stats_processor.process_stat(cluster_name, derived_stat)
-            # allow derived stats to select/use this stat
-            equation_stats.select_stat(derived_stat)
-            pct_change_stats.select_stat(derived_stat)
-            final_equation_stats.select_stat(derived_stat)
-
-        LOG.debug("Processing equation stats on %s", cluster_name)
-        for eq_stat in equation_stats.stats():
-            # equation stats might produce more than one derived stat,
-            # potentially one stat per node
-            derived_stats = eq_stat.compute_derived_stats()
-            for derived_stat in derived_stats:
-                if derived_stat.error is not None:
-                    LOG.warning(
-                        "Equation computed stat: "
-                        "'%s' on '%s', returned error: '%s'.",
-                        str(derived_stat.key),
-                        cluster_name,
-                        str(derived_stat.error),
-                    )
-                    continue
-                LOG.debug(
-                    "EquationStat[%s]=%s", derived_stat.key, str(derived_stat.value)
-                )
-                # let stats processor process them
-                self._stats_processor.process_stat(cluster_name, derived_stat)
-                # allow derived stats to select/use this stat
-                pct_change_stats.select_stat(derived_stat)
-                final_equation_stats.select_stat(derived_stat)
+            derived_stat_context.select_stat(stat)
 
-        LOG.debug("Processing percent change stats on %s", cluster_name)
-        for pct_change_stat in pct_change_stats.stats():
-            # percent change stats might produce more than one derived stat,
+        LOG.debug("Processing derived stats on %s", cluster_name)
+        for derived_stat_computer, state in derived_stat_context.computer_states():
+            # derived stats might produce more than one derived stat,
             # potentially one stat per node
-            derived_stats = pct_change_stat.compute_derived_stats()
-            for derived_stat in derived_stats:
+            for derived_stat in derived_stat_computer.compute_derived_stats(state):
                 if derived_stat.error is not None:
                     LOG.warning(
-                        "Percent change stat: " "'%s' on '%s', returned error: '%s'.",
+                        "%s: '%s' on '%s', returned error: '%s'.",
+                        derived_stat_computer.DESCRIPTION,
                         str(derived_stat.key),
                         cluster_name,
                         str(derived_stat.error),
                     )
                     continue
                 LOG.debug(
-                    "PercentChangeStat[%s]=%s",
+                    "%s[%s]=%s",
+                    derived_stat_computer.DESCRIPTION,
                     derived_stat.key,
                     str(derived_stat.value),
                 )
                 # let stats processor process it
                 self._stats_processor.process_stat(cluster_name, derived_stat)
-                # allow derived stats to select/use this stat
-                final_equation_stats.select_stat(derived_stat)
-
-        LOG.debug("Processing final equation stats on %s", cluster_name)
-        for eq_stat in final_equation_stats.stats():
-            # equation stats might produce more than one derived stat,
-            # potentially one stat per node
-            derived_stats = eq_stat.compute_derived_stats()
-            for derived_stat in derived_stats:
-                if derived_stat.error is not None:
-                    LOG.warning(
-                        "Final equation computed stat: "
-                        "'%s' on '%s', returned error: '%s'.",
-                        str(derived_stat.key),
-                        cluster_name,
-                        str(derived_stat.error),
-                    )
-                    continue
-                LOG.debug(
-                    "FinalEquationStat[%s]=%s",
-                    derived_stat.key,
-                    str(derived_stat.value),
-                )
-                # let stats processor process them
-                self._stats_processor.process_stat(cluster_name, derived_stat)
+                # allow the derived stats that depend on it to select/use it
+                derived_stat_context.select_stat(derived_stat)
 
         self._stats_processor.end_process(cluster_name)
-        cluster_composite_stats.end_process(cluster_name)
-        equation_stats.end_process(cluster_name)
-        pct_change_stats.end_process(cluster_name)
-        final_equation_stats.end_process(cluster_name)
+        derived_stat_context.end_process()
 
     def _prep_stat(self, stat):
-        try:
-            # the stat value's data type is variable depending on the key so
-            # use literal_eval() to convert it to the correct type
-            eval_value = literal_eval(stat.value)
-            # convert tuples to a list for simplicity
-            if type(eval_value) == tuple:
-                stat.value = list(eval_value)
-            else:
-                stat.value = eval_value
-        except Exception:  # if literal_eval throws an exception
-            # then just leave it as string value
-            pass
+        # the stat value's data type is variable depending on the key so
+        # convert it to the correct type using the shape of the key's value.
+        stat.value = self._value_decoder.decode(stat.key, stat.value)
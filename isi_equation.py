@@ -0,0 +1,268 @@
+"""
+Compile the expressions of the equation stats into restricted Python code.
+An expression is parsed once at startup, checked against a whitelist of
+syntax (numbers, stat names, arithmetic operators and a few math functions)
+and compiled into a function of its input stats, plus a second function that
+evaluates the expression for a whole list of nodes in one call.
+"""
+from __future__ import division
+from builtins import object
+from builtins import range
+from builtins import str
+import __future__
+import ast
+import math
+import re
+
+
+# same as the tokens that the equation stat names were always parsed with,
+# tokens that start with a letter are stat names, the rest are numbers. "^"
+# is the power operator, like in the Equation package that the expressions
+# were evaluated with before, so it is substituted with "**".
+TOKEN_RE = re.compile(r"[a-zA-Z.:_0-9]+|\^")
+# a stat key optionally followed by :field names (or list indices).
+STAT_NAME_RE = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*(\.[a-zA-Z0-9_]+)*(:[a-zA-Z0-9_]+)*$")
+PARAM_PREFIX = "_p"
+
+FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+    "sqrt": math.sqrt,
+    "exp": math.exp,
+    "log": math.log,
+    "log10": math.log10,
+    "floor": math.floor,
+    "ceil": math.ceil,
+}
+CONSTANTS = {"pi": math.pi, "e": math.e}
+
+BIN_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+UNARY_OPS = (ast.UAdd, ast.USub)
+NUMBER_NODES = tuple(
+    getattr(ast, node_name) for node_name in ("Constant", "Num") if hasattr(ast, node_name)
+)
+
+
+class EquationError(RuntimeError):
+    """
+    An equation that can't be compiled, with the position of the problem.
+    """
+
+    def __init__(self, message, expression, column):
+        """
+        :param int column: the 0 based index into expression of the problem.
+        """
+        super(EquationError, self).__init__(
+            "%s at column %d of:\n  %s\n  %s^"
+            % (message, column + 1, expression, " " * column)
+        )
+        self.column = column
+
+
+class CompiledEquation(object):
+    """
+    Callable that evaluates an equation for a single node, i.e. with one
+    argument per input stat.
+    """
+
+    def __init__(self, expression, input_names, func, vector_func):
+        self.expression = expression
+        # the distinct stat names that the expression uses, in the order of
+        # the arguments of the function.
+        self.input_names = input_names
+        self._func = func
+        self._vector_func = vector_func
+
+    def __call__(self, *args):
+        return self._func(*args)
+
+    def evaluate_vector(self, arg_rows):
+        """
+        Evaluate the equation once for each tuple of arguments in arg_rows.
+        :param list arg_rows: a list of tuples of arguments, e.g. one per node.
+        :returns: a list of the results in the same order.
+        """
+        return self._vector_func(arg_rows)
+
+    def __repr__(self):
+        return self.expression
+
+
+def _substitute_stat_names(expression):
+    """
+    Replace each stat name in the expression with a parameter name.
+    :returns: a tuple of the new expression, the list of distinct stat names
+    and a function that maps an index into the new expression back to the
+    index into the original expression.
+    """
+    input_names = []
+    param_names = {}
+    parts = []
+    # list of (index into new expression, index into original expression)
+    # for the start and end of each substitution.
+    offsets = [(0, 0)]
+    last_end = 0
+    new_len = 0
+    for match in TOKEN_RE.finditer(expression):
+        token = match.group()
+        start, end = match.span()
+        if token == "^":
+            replacement = "**"
+        elif not (token[0].isalpha() or token[0] == "_"):
+            continue
+        elif token in CONSTANTS:
+            continue
+        elif token in FUNCTIONS and expression[end:].lstrip().startswith("("):
+            continue
+        elif STAT_NAME_RE.match(token) is None:
+            raise EquationError('Invalid stat name "%s"' % token, expression, start)
+        else:
+            try:
+                replacement = param_names[token]
+            except KeyError:
+                replacement = param_names[token] = PARAM_PREFIX + str(len(input_names))
+                input_names.append(token)
+        parts.append(expression[last_end:start])
+        new_len += start - last_end
+        offsets.append((new_len, start))
+        parts.append(replacement)
+        new_len += len(replacement)
+        offsets.append((new_len, end))
+        last_end = end
+    parts.append(expression[last_end:])
+
+    def original_column(new_column):
+        for new_offset, orig_offset in reversed(offsets):
+            if new_column >= new_offset:
+                return orig_offset + (new_column - new_offset)
+        return new_column
+
+    return "".join(parts), input_names, original_column
+
+
+def _check_node(node, expression, original_column):
+    """
+    Check that the node and all of its children are whitelisted.
+    """
+    if isinstance(node, ast.Expression):
+        _check_node(node.body, expression, original_column)
+        return
+    column = original_column(getattr(node, "col_offset", 0))
+    if isinstance(node, ast.BinOp):
+        if not isinstance(node.op, BIN_OPS):
+            raise EquationError("Unsupported operator", expression, column)
+        _check_node(node.left, expression, original_column)
+        _check_node(node.right, expression, original_column)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, UNARY_OPS):
+            raise EquationError("Unsupported operator", expression, column)
+        _check_node(node.operand, expression, original_column)
+    elif isinstance(node, NUMBER_NODES):
+        value = getattr(node, "value", getattr(node, "n", None))
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise EquationError("Unsupported constant", expression, column)
+    elif isinstance(node, ast.Name):
+        if node.id not in CONSTANTS and not node.id.startswith(PARAM_PREFIX):
+            raise EquationError('Unknown name "%s"' % node.id, expression, column)
+    elif isinstance(node, ast.Call):
+        if (
+            not isinstance(node.func, ast.Name)
+            or node.func.id not in FUNCTIONS
+            or not node.args
+            or node.keywords
+            or getattr(node, "starargs", None) is not None
+            or getattr(node, "kwargs", None) is not None
+        ):
+            raise EquationError("Unsupported function call", expression, column)
+        for arg in node.args:
+            _check_node(arg, expression, original_column)
+    else:
+        raise EquationError(
+            "Unsupported syntax (%s)" % type(node).__name__, expression, column
+        )
+
+
+def _compile_function(source, name, global_vars):
+    code = compile(source, "<%s>" % name, "exec", __future__.division.compiler_flag, True)
+    local_vars = {}
+    exec(code, global_vars, local_vars)
+    return local_vars[name]
+
+
+def compile_equation(expression):
+    """
+    Compile the expression of an equation stat.
+    :param string expression: e.g. (node.a + node.b:field) * cluster.c
+    :returns: a CompiledEquation.
+    :raises EquationError: if the expression is invalid.
+    """
+    if not expression.strip():
+        raise EquationError("Empty equation", expression, 0)
+    py_expression, input_names, original_column = _substitute_stat_names(expression)
+    stripped_expression = py_expression.strip()
+    try:
+        tree = ast.parse(stripped_expression, mode="eval")
+    except SyntaxError as syntax_error:
+        # the offset is 1 based, and 0 or past the end if the expression is
+        # incomplete.
+        offset = syntax_error.offset or 0
+        if offset <= 0 or offset > len(stripped_expression):
+            offset = len(stripped_expression)
+        column = original_column(
+            offset - 1 + len(py_expression) - len(py_expression.lstrip())
+        )
+        raise EquationError(
+            "Syntax error: %s" % syntax_error.msg, expression, column
+        )
+    _check_node(tree, expression, original_column)
+
+    # the expression is re-generated from the checked tree, so nothing but
+    # the whitelisted syntax makes it into the compiled code.
+    body = _unparse(tree.body)
+    params = [PARAM_PREFIX + str(index) for index in range(0, len(input_names))]
+    global_vars = {"__builtins__": {}}
+    global_vars.update(FUNCTIONS)
+    global_vars.update(CONSTANTS)
+    func = _compile_function(
+        "def _eq(%s):\n    return %s\n" % (", ".join(params), body), "_eq", global_vars
+    )
+    row_vars = "(%s,)" % ", ".join(params) if params else "_"
+    vector_func = _compile_function(
+        "def _eq_vector(_rows):\n    return [%s for %s in _rows]\n" % (body, row_vars),
+        "_eq_vector",
+        global_vars,
+    )
+    return CompiledEquation(expression, input_names, func, vector_func)
+
+
+def _unparse(node):
+    """
+    Convert a checked expression tree back to source code.
+    """
+    if isinstance(node, ast.BinOp):
+        return "(%s %s %s)" % (
+            _unparse(node.left),
+            _BIN_OP_SYMBOLS[type(node.op)],
+            _unparse(node.right),
+        )
+    elif isinstance(node, ast.UnaryOp):
+        return "(%s%s)" % ("-" if isinstance(node.op, ast.USub) else "+", _unparse(node.operand))
+    elif isinstance(node, NUMBER_NODES):
+        return repr(getattr(node, "value", getattr(node, "n", None)))
+    elif isinstance(node, ast.Name):
+        return node.id
+    # the only other node that passes _check_node
+    return "%s(%s)" % (node.func.id, ", ".join(_unparse(arg) for arg in node.args))
+
+
+_BIN_OP_SYMBOLS = {
+    ast.Add: "+",
+    ast.Sub: "-",
+    ast.Mult: "*",
+    ast.Div: "/",
+    ast.FloorDiv: "//",
+    ast.Mod: "%",
+    ast.Pow: "**",
+}
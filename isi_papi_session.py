@@ -0,0 +1,237 @@
+"""
+Authenticate with the PAPI using a session cookie rather than HTTP basic
+authentication. With basic authentication OneFS has to authenticate the user
+via PAM on every single request, whereas a session is only authenticated once
+when it is created and then each request just has to present the session's
+cookie and CSRF token.
+"""
+from builtins import object
+import json
+import logging
+import time
+
+import gevent.lock
+
+
+LOG = logging.getLogger(__name__)
+
+SESSION_PATH = "/session/1/session"
+SESSION_SERVICES = ["platform"]
+SESSION_COOKIE = "isisessid"
+CSRF_COOKIE = "isicsrf"
+# create a new session this many seconds before the current one expires.
+SESSION_REFRESH_MARGIN = 60  # seconds
+# lifetime of a session whose response doesn't say when it expires, after
+# which it is renewed, or earlier if a request is rejected with a 401.
+DEFAULT_SESSION_TIMEOUT = 900  # seconds
+# max number of connections that are kept alive to each cluster.
+DEFAULT_CONNECTION_POOL_SIZE = 8
+
+
+class PapiSession(object):
+    """
+    The PAPI session of a single cluster, which is shared by every greenlet
+    that sends requests to the cluster.
+    """
+
+    def __init__(self, host_url, username, password, pool_manager):
+        """
+        :param string host_url: the https://<address>:8080 URL of the cluster.
+        :param urllib3.PoolManager pool_manager: the connection pool that is
+        used to create the session.
+        """
+        self.host_url = host_url
+        self._username = username
+        self._password = password
+        self._pool_manager = pool_manager
+        self._cookie = None
+        self._csrf_token = None
+        self._expiration = 0.0
+        self._lock = gevent.lock.Semaphore()
+        # incremented each time a new session is created, see login.
+        self.generation = 0
+        # True if the cluster doesn't support sessions, in which case the
+        # requests fall back to basic authentication.
+        self.basic_auth = False
+
+    def get_auth_headers(self):
+        """
+        Get the headers that authenticate a request with the current session,
+        creating a new session if there isn't one or it is about to expire.
+        :returns: a dict of headers.
+        """
+        if self._cookie is None or time.time() >= self._expiration:
+            self.login(self.generation)
+        if self.basic_auth:
+            return {}
+        headers = {"Cookie": SESSION_COOKIE + "=" + self._cookie}
+        if self._csrf_token is not None:
+            headers["X-CSRF-Token"] = self._csrf_token
+            headers["Origin"] = self.host_url
+        return headers
+
+    def login(self, generation):
+        """
+        Create a new session, unless another greenlet already created a new
+        one since the caller got the session of the specified generation.
+        :param int generation: the generation of the session that the caller
+        found to be expired or invalid.
+        """
+        with self._lock:
+            if generation != self.generation or self.basic_auth:
+                return
+            body = {
+                "username": self._username,
+                "password": self._password,
+                "services": SESSION_SERVICES,
+            }
+            response = self._pool_manager.request(
+                "POST",
+                self.host_url + SESSION_PATH,
+                body=json.dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+            if response.status == 404:
+                LOG.warning(
+                    "Cluster %s doesn't support PAPI sessions, using basic "
+                    "authentication instead.",
+                    self.host_url,
+                )
+                self.basic_auth = True
+                return
+            if response.status != 201:
+                raise RuntimeError(
+                    "Failed to create PAPI session on %s. Status: %d Reason: %s"
+                    % (self.host_url, response.status, response.reason)
+                )
+
+            cookie = csrf_token = None
+            for set_cookie in response.headers.getlist("Set-Cookie"):
+                name, _, value = set_cookie.split(";", 1)[0].strip().partition("=")
+                if name == SESSION_COOKIE:
+                    cookie = value
+                elif name == CSRF_COOKIE:
+                    # older releases don't have CSRF protection
+                    csrf_token = value
+            if cookie is None:
+                raise RuntimeError(
+                    "PAPI session response from %s has no session cookie."
+                    % self.host_url
+                )
+            self._cookie = cookie
+            self._csrf_token = csrf_token
+            timeout = _get_session_timeout(response.data)
+            # renew the session before it expires, but not so early that a
+            # short lived session is renewed on every request.
+            self._expiration = time.time() + max(
+                timeout - SESSION_REFRESH_MARGIN, timeout // 2
+            )
+            self.generation += 1
+            LOG.debug("Created PAPI session on %s.", self.host_url)
+
+
+def _get_session_timeout(response_data):
+    """
+    :returns: the number of seconds until the session expires according to
+    the response that created it, or DEFAULT_SESSION_TIMEOUT if it doesn't
+    say.
+    """
+    try:
+        session = json.loads(response_data)
+    except (ValueError, TypeError):
+        return DEFAULT_SESSION_TIMEOUT
+    if not isinstance(session, dict):
+        return DEFAULT_SESSION_TIMEOUT
+    for timeout_name in ("timeout_absolute", "timeout_inactive"):
+        timeout = session.get(timeout_name)
+        if isinstance(timeout, int) and timeout > 0:
+            return timeout
+    return DEFAULT_SESSION_TIMEOUT
+
+
+# isi_sdk module name -> SessionApiClient class of the module
+_session_api_client_classes = {}
+
+
+def _get_session_api_client_class(isi_sdk):
+    try:
+        return _session_api_client_classes[isi_sdk.__name__]
+    except KeyError:
+        pass
+
+    class SessionApiClient(isi_sdk.ApiClient):
+        """
+        An isi_sdk.ApiClient that authenticates with a PapiSession and
+        transparently creates a new session when the cluster rejects the
+        current one.
+        """
+
+        def __init__(self, configuration):
+            super(SessionApiClient, self).__init__(configuration)
+            self.papi_session = PapiSession(
+                configuration.host,
+                configuration.username,
+                configuration.password,
+                self.rest_client.pool_manager,
+            )
+
+        def update_params_for_auth(self, headers, querys, auth_settings):
+            if not auth_settings:
+                return
+            headers.update(self.papi_session.get_auth_headers())
+            if self.papi_session.basic_auth:
+                headers["Authorization"] = self.configuration.get_basic_auth_token()
+
+        def request(self, method, url, query_params=None, headers=None, **kwargs):
+            generation = self.papi_session.generation
+            try:
+                return super(SessionApiClient, self).request(
+                    method, url, query_params=query_params, headers=headers, **kwargs
+                )
+            except isi_sdk.rest.ApiException as api_exc:
+                if (
+                    api_exc.status != 401
+                    or self.papi_session.basic_auth
+                    or headers is None
+                    or "Cookie" not in headers
+                ):
+                    raise
+                LOG.debug(
+                    "PAPI session on %s was rejected, creating a new one.",
+                    self.papi_session.host_url,
+                )
+            # the session expired or the cluster forgot it (e.g. the node
+            # rebooted), so create a new one and retry the request once.
+            self.papi_session.login(generation)
+            headers.update(self.papi_session.get_auth_headers())
+            return super(SessionApiClient, self).request(
+                method, url, query_params=query_params, headers=headers, **kwargs
+            )
+
+    _session_api_client_classes[isi_sdk.__name__] = SessionApiClient
+    return SessionApiClient
+
+
+def build_session_api_client(
+    isi_sdk,
+    host_url,
+    username,
+    password,
+    verify_ssl,
+    pool_size=DEFAULT_CONNECTION_POOL_SIZE,
+):
+    """
+    Build an instance of the isi_sdk's ApiClient that authenticates with a
+    PAPI session and keeps up to pool_size connections alive to the cluster.
+    The client is safe to share between greenlets.
+    :returns: an instance of a subclass of isi_sdk.ApiClient.
+    """
+    configuration = isi_sdk.Configuration()
+    configuration.username = username
+    configuration.password = password
+    configuration.verify_ssl = verify_ssl
+    configuration.host = host_url
+    # the urllib3 pool discards connections beyond its maxsize rather than
+    # keeping them alive, so size it to the max number of requests in flight.
+    configuration.connection_pool_maxsize = pool_size
+    return _get_session_api_client_class(isi_sdk)(configuration)
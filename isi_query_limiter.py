@@ -0,0 +1,209 @@
+"""
+Limit the number of concurrent PAPI requests, both in total and per cluster.
+The per cluster limits adapt to the latency and error rate of each cluster's
+requests using additive increase/multiplicative decrease (AIMD) so that
+clusters that respond quickly are allowed more requests in flight and clusters
+that are struggling are sent fewer.
+"""
+from __future__ import division
+from builtins import object
+import collections
+import logging
+import time
+
+import gevent.event
+
+
+LOG = logging.getLogger(__name__)
+
+# max number of PAPI requests in flight across all clusters.
+DEFAULT_MAX_ASYNC_QUERIES = 20
+# max number of PAPI requests in flight to a single cluster.
+DEFAULT_MAX_CLUSTER_QUERIES = 8
+# requests that take longer than this many seconds are treated the same as an
+# error, i.e. as a sign that the cluster is overloaded. It is half of the 60
+# second timeout of the stats queries, so that the large queries of healthy
+# clusters don't keep their limit at the minimum.
+DEFAULT_QUERY_LATENCY_TARGET = 30.0  # seconds
+# the per cluster limit never goes below this number of requests.
+MIN_CLUSTER_QUERIES = 1.0
+# the per cluster limit that each cluster starts with.
+INITIAL_CLUSTER_QUERIES = 2.0
+# factor applied to the per cluster limit when a request fails or is slow.
+DECREASE_FACTOR = 0.5
+# smoothing factor of the latency and error rate moving averages.
+EWMA_ALPHA = 0.2
+
+
+class ClusterQueryLimit(object):
+    """
+    The adaptive concurrency limit of a single cluster.
+    """
+
+    def __init__(self, limiter, cluster_name):
+        self._limiter = limiter
+        self.cluster_name = cluster_name
+        self.limit = min(INITIAL_CLUSTER_QUERIES, limiter.max_cluster_queries)
+        self.in_flight = 0
+        self.queued = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self._last_decrease = 0.0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func once there is room for another request to this cluster and
+        feed its latency and outcome back into the cluster's limit.
+        """
+        self._limiter._acquire(self)
+        start_time = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            self._limiter._release(self, start_time, True)
+            raise
+        self._limiter._release(self, start_time, False)
+        return result
+
+    def _can_run(self):
+        return self.in_flight < int(self.limit)
+
+    def _update(self, start_time, end_time, error):
+        latency = end_time - start_time
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+
+        if error or latency > self._limiter.latency_target:
+            # only back off once per congestion event, i.e. ignore the other
+            # requests that were already in flight when the last one failed.
+            if start_time >= self._last_decrease:
+                self.limit = max(MIN_CLUSTER_QUERIES, self.limit * DECREASE_FACTOR)
+                self._last_decrease = end_time
+                LOG.debug(
+                    "Decreased query limit of cluster %s to %f "
+                    "(latency: %f error: %s).",
+                    self.cluster_name,
+                    self.limit,
+                    latency,
+                    str(error),
+                )
+        else:
+            self.limit = min(
+                float(self._limiter.max_cluster_queries), self.limit + 1.0 / self.limit
+            )
+
+    def get_stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+        }
+
+
+class QueryLimiter(object):
+    """
+    Hands out permission to send a PAPI request subject to a global limit and
+    each cluster's adaptive limit. Requests that have to wait are granted in
+    the order that they arrived, except that a request for a cluster that is
+    at its limit doesn't hold up the requests of other clusters.
+    """
+
+    def __init__(
+        self,
+        max_queries=DEFAULT_MAX_ASYNC_QUERIES,
+        max_cluster_queries=DEFAULT_MAX_CLUSTER_QUERIES,
+        latency_target=DEFAULT_QUERY_LATENCY_TARGET,
+    ):
+        self.configure(max_queries, max_cluster_queries, latency_target)
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._cluster_limits = {}
+
+    def configure(self, max_queries, max_cluster_queries, latency_target):
+        if max_queries < 1 or max_cluster_queries < 1:
+            raise ValueError("Query limits must be at least 1.")
+        if latency_target <= 0:
+            raise ValueError("Query latency target must be greater than 0.")
+        self.max_queries = max_queries
+        self.max_cluster_queries = max_cluster_queries
+        self.latency_target = latency_target
+
+    def cluster_limit(self, cluster_name):
+        """
+        Get the ClusterQueryLimit of the specified cluster.
+        """
+        try:
+            return self._cluster_limits[cluster_name]
+        except KeyError:
+            self._cluster_limits[cluster_name] = cluster_limit = ClusterQueryLimit(
+                self, cluster_name
+            )
+            return cluster_limit
+
+    def get_stats(self):
+        """
+        Return the current global and per cluster limits, number of requests
+        in flight and queue depths.
+        """
+        return {
+            "limit": self.max_queries,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "clusters": {
+                cluster_name: cluster_limit.get_stats()
+                for cluster_name, cluster_limit in self._cluster_limits.items()
+            },
+        }
+
+    def _can_run(self, cluster_limit):
+        return self.in_flight < self.max_queries and cluster_limit._can_run()
+
+    def _grant(self, cluster_limit):
+        self.in_flight += 1
+        cluster_limit.in_flight += 1
+
+    def _acquire(self, cluster_limit):
+        if cluster_limit.queued == 0 and self._can_run(cluster_limit):
+            self._grant(cluster_limit)
+            return
+        waiter = (cluster_limit, gevent.event.Event())
+        self._waiters.append(waiter)
+        cluster_limit.queued += 1
+        try:
+            waiter[1].wait()
+        except BaseException:
+            # the waiting greenlet was killed, give up its place in the queue
+            # or its request slot if it was already granted one.
+            try:
+                self._waiters.remove(waiter)
+                cluster_limit.queued -= 1
+            except ValueError:
+                self._release(cluster_limit, None, False)
+            raise
+
+    def _release(self, cluster_limit, start_time, error):
+        self.in_flight -= 1
+        cluster_limit.in_flight -= 1
+        if start_time is not None:
+            cluster_limit._update(start_time, time.time(), error)
+        self._wake()
+
+    def _wake(self):
+        """
+        Grant the waiting requests that are now allowed to run.
+        """
+        index = 0
+        while index < len(self._waiters) and self.in_flight < self.max_queries:
+            cluster_limit, event = self._waiters[index]
+            if cluster_limit._can_run():
+                del self._waiters[index]
+                cluster_limit.queued -= 1
+                self._grant(cluster_limit)
+                event.set()
+            else:
+                index += 1
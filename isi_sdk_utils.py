@@ -3,6 +3,7 @@ Handle the details of building a Swagger client with the correct version of the
 SDK to talk to a specific Isilon host.
 """
 from __future__ import print_function
+from builtins import object
 from builtins import str
 
 try:
@@ -17,6 +18,19 @@ except ImportError:
 
 import sys
 
+from isi_papi_session import DEFAULT_CONNECTION_POOL_SIZE, build_session_api_client
+
+
+class ClusterIdentity(object):
+    """
+    The identity of a cluster as returned by its cluster config.
+    """
+
+    def __init__(self, name, guid, release):
+        self.name = name
+        self.guid = guid
+        self.release = release
+
 
 def configure(host, username, password, verify_ssl=False, use_version="detect"):
     """
@@ -42,13 +56,38 @@ def configure(host, username, password, verify_ssl=False, use_version="detect"):
     of the SDK.
     :returns: tuple
     """
+    isi_sdk, api_client, host_version, _ = configure_cluster(
+        host, username, password, verify_ssl, use_version
+    )
+    return isi_sdk, api_client, host_version
+
+
+def configure_cluster(
+    host,
+    username,
+    password,
+    verify_ssl=False,
+    use_version="detect",
+    pool_size=DEFAULT_CONNECTION_POOL_SIZE,
+):
+    """
+    Same as configure except that the tuple also contains the ClusterIdentity
+    of the host, which comes from the same request that is used to detect the
+    host's version, or None if the version was not detected or the host did
+    not return its cluster config.
+    :param int pool_size: the max number of connections to the host that are
+    kept alive.
+    :returns: tuple
+    """
     if isi_sdk_7_2 is None and isi_sdk_8_0 is None:
         raise RuntimeError("Isilon SDK is not installed.")
 
-    host_url = "https://" + host + ":8080"
-
+    identity = None
+    detect_sdk = detect_api_client = None
     if use_version is None or use_version == "detect":
-        host_version = _detect_host_version(host, username, password, verify_ssl)
+        detect_sdk, detect_api_client, host_version, identity = _detect_host(
+            host, username, password, verify_ssl, pool_size
+        )
     else:
         host_version = use_version
 
@@ -63,34 +102,40 @@ def configure(host, username, password, verify_ssl=False, use_version="detect"):
     else:
         isi_sdk = isi_sdk_8_0
 
-    configuration = isi_sdk.Configuration()
-    configuration.username = username
-    configuration.password = password
-    configuration.verify_ssl = verify_ssl
-    configuration.host = host_url
-    api_client = isi_sdk.ApiClient(configuration)
+    # reuse the client that detected the version if it is from the same SDK.
+    if isi_sdk is detect_sdk:
+        api_client = detect_api_client
+    else:
+        api_client = _build_api_client(
+            isi_sdk, host, username, password, verify_ssl, pool_size
+        )
+
+    return isi_sdk, api_client, host_version, identity
 
-    return isi_sdk, api_client, host_version
 
+def _build_api_client(isi_sdk, host, username, password, verify_ssl, pool_size):
+    # authenticate with a PAPI session rather than basic auth, which OneFS has
+    # to authenticate via PAM on every request.
+    return build_session_api_client(
+        isi_sdk, "https://" + host + ":8080", username, password, verify_ssl, pool_size
+    )
 
-def _detect_host_version(host, username, password, verify_ssl):
+
+def _detect_host(host, username, password, verify_ssl, pool_size):
     # if 7.2 is available then use it to check the version of the cluster
     # because it will work for 7.2 or newer clusters.
     isi_sdk = isi_sdk_7_2 if isi_sdk_7_2 else isi_sdk_8_0
+    api_client = _build_api_client(
+        isi_sdk, host, username, password, verify_ssl, pool_size
+    )
 
-    configuration = isi_sdk.Configuration()
-    configuration.username = username
-    configuration.password = password
-    configuration.verify_ssl = verify_ssl
-    configuration.host = "https://" + host + ":8080"
-    api_client = isi_sdk.ApiClient(configuration)
-
+    identity = None
     try:
         try:
             config = isi_sdk.ClusterApi(api_client).get_cluster_config()
-            host_version = (
-                7.2 if config.onefs_version.release.startswith("v7.") else 8.0
-            )
+            release = config.onefs_version.release
+            host_version = 7.2 if release.startswith("v7.") else 8.0
+            identity = ClusterIdentity(config.name, config.guid, release)
         except isi_sdk.rest.ApiException as api_exc:
             # if we are using isi_sdk_8_0 (because 7.2 is not installed) and the
             # cluster is a 7.2 cluster then it will return 404 for the
@@ -120,4 +165,4 @@ def _detect_host_version(host, username, password, verify_ssl):
             file=sys.stderr,
         )
 
-    return host_version
+    return isi_sdk, api_client, host_version, identity
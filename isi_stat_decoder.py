@@ -0,0 +1,147 @@
+"""
+Decode the values of the stats returned by the PAPI. The Isilon SDK returns
+each stat value as the Python string representation of the value, so in
+general it has to be converted back with literal_eval, which is expensive for
+the large nested values of stats like node.ifs.cache or the protostats. The
+StatValueDecoder learns the shape of each stat key's value the first time it
+sees it and uses a fast path specific to that shape from then on.
+"""
+from builtins import object
+from future.utils import string_types
+from ast import literal_eval
+import json
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+# the value is a string that is not a Python literal.
+SHAPE_STRING = "string"
+SHAPE_INT = "int"
+SHAPE_FLOAT = "float"
+# the value is a dict or list whose string representation becomes JSON by
+# swapping the quote characters.
+SHAPE_JSON = "json"
+# anything else is decoded with literal_eval.
+SHAPE_LITERAL = "literal"
+
+# first characters of a string that might be a Python literal.
+LITERAL_START_CHARS = frozenset("0123456789-+.[{('\"TFNu")
+
+
+def _literal_decode(value):
+    """
+    The slow path, decode value the same way that it always has been.
+    """
+    try:
+        # the stat value's data type is variable depending on the key so
+        # use literal_eval() to convert it to the correct type
+        eval_value = literal_eval(value)
+    except Exception:  # if literal_eval throws an exception
+        # then just leave it as string value
+        return value
+    # convert tuples to a list for simplicity
+    if isinstance(eval_value, tuple):
+        return list(eval_value)
+    return eval_value
+
+
+def _json_decode(value):
+    """
+    Decode the string representation of a dict or list of numbers and strings.
+    The values originally came from the JSON of the PAPI response, so as long
+    as none of the strings contain a quote or backslash (in which case their
+    representation might use double quotes or escapes), swapping the single
+    quotes for double quotes gives back the JSON, which is much faster to parse
+    than the Python representation.
+    """
+    if '"' in value or "\\" in value:
+        raise ValueError("Value is not JSON compatible.")
+    return json.loads(value.replace("'", '"'))
+
+
+def _is_json_compatible(value):
+    """
+    Check that the decoded value only contains the types that _json_decode
+    returns, i.e. no tuples, bools or None (which are spelled differently in
+    JSON).
+    """
+    value_type = type(value)
+    if value_type == dict:
+        for item_key, item_value in value.items():
+            if not isinstance(item_key, string_types) or not _is_json_compatible(
+                item_value
+            ):
+                return False
+        return True
+    elif value_type == list:
+        for item in value:
+            if not _is_json_compatible(item):
+                return False
+        return True
+    return value_type == int or value_type == float or isinstance(value, string_types)
+
+
+class StatValueDecoder(object):
+    """
+    Decodes stat values using a shape learned per stat key.
+    """
+
+    def __init__(self):
+        # stat key -> shape
+        self._shapes = {}
+
+    def decode(self, key, value):
+        """
+        Decode the string representation of the stat value.
+        :param string key: the stat key.
+        :param string value: the stat value as returned by the SDK.
+        :returns: the decoded value, or value if it is not a literal.
+        """
+        if not isinstance(value, string_types):
+            return value
+        try:
+            shape = self._shapes[key]
+            if shape == SHAPE_JSON:
+                return _json_decode(value)
+            elif shape == SHAPE_INT:
+                return int(value)
+            elif shape == SHAPE_FLOAT:
+                # float() also accepts integers and inf/nan, but those would
+                # not be decoded as floats by literal_eval.
+                if "." in value or "e" in value:
+                    return float(value)
+            elif shape == SHAPE_STRING:
+                if value[:1] not in LITERAL_START_CHARS:
+                    return value
+            elif shape == SHAPE_LITERAL:
+                return _literal_decode(value)
+        except (KeyError, ValueError):
+            # first sight of this key, or the value doesn't match the shape
+            # learned so far.
+            pass
+        return self._learn(key, value)
+
+    def _learn(self, key, value):
+        decoded_value = _literal_decode(value)
+        decoded_type = type(decoded_value)
+        if decoded_value is value:
+            shape = SHAPE_STRING
+        elif decoded_type == int:
+            shape = SHAPE_INT
+        elif decoded_type == float:
+            shape = SHAPE_FLOAT
+        elif (decoded_type == dict or decoded_type == list) and _is_json_compatible(
+            decoded_value
+        ):
+            try:
+                json_compatible = _json_decode(value) == decoded_value
+            except ValueError:
+                json_compatible = False
+            shape = SHAPE_JSON if json_compatible else SHAPE_LITERAL
+        else:
+            shape = SHAPE_LITERAL
+        if self._shapes.get(key) != shape:
+            LOG.debug("Decoding values of stat %s as %s.", key, shape)
+        self._shapes[key] = shape
+        return decoded_value
@@ -2,6 +2,14 @@ from builtins import range
 from builtins import object
 import logging
 
+import gevent.pool
+
+try:
+    # orjson parses the statistics responses several times faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 LOG = logging.getLogger(__name__)
 # Apache/PAPI has a request URI limit of 8096, MAX_KEYS_LEN is the max
@@ -13,6 +21,155 @@ MAX_KEYS_LEN = 7000
 # side. Testing revealed that 200 is the optimal cutoff point for a virtual
 # cluster.
 MAX_DIRECT_METADATA_STATS = 200
+# default number of chunks of a stats query, see build_query_keys, that are
+# sent to the cluster in parallel.
+DEFAULT_MAX_PARALLEL_CHUNKS = 4
+# the engines that IsiStatsClient can query the current stats with:
+# the isi_sdk's StatisticsApi, which deserializes each stat into a swagger
+# model that is then converted to a StatRecord, or the JSON of the response
+# parsed directly into StatRecords.
+QUERY_ENGINE_SDK = "sdk"
+QUERY_ENGINE_JSON = "json"
+QUERY_ENGINES = (QUERY_ENGINE_SDK, QUERY_ENGINE_JSON)
+STATISTICS_CURRENT_PATH = "/platform/1/statistics/current"
+# error_code of the derived stats that failed to be computed, which don't have
+# an error code from the cluster.
+DERIVED_STAT_ERROR_CODE = 1
+
+
+# prefix of the stats that have a single value for the whole cluster.
+CLUSTER_STAT_PREFIX = "cluster."
+
+# stat key -> (the first instance of the key, whether the stat is cluster
+# scoped), so that every StatRecord of a key shares the same string and the
+# prefix check is only done once per key.
+_stat_keys = {}
+
+
+def intern_stat_key(key):
+    """
+    :returns: a tuple of the shared instance of the key and whether it is the
+    key of a cluster scoped stat, i.e. one that has a single value for the
+    whole cluster rather than one per node.
+    """
+    try:
+        return _stat_keys[key]
+    except KeyError:
+        stat_key = _stat_keys[key] = (
+            key,
+            key is not None and key.startswith(CLUSTER_STAT_PREFIX),
+        )
+        return stat_key
+
+
+class StatRecord(object):
+    """
+    The compact record that every stat, queried or derived, is passed through
+    the daemon and to the stats processors as. It has the same attributes as
+    isi_sdk.models.StatisticsCurrentStat, but unlike the swagger model the
+    value is not converted to a string by the json query engine.
+    """
+
+    __slots__ = (
+        "key",
+        "devid",
+        "time",
+        "value",
+        "error",
+        "error_code",
+        "cluster_scoped",
+    )
+
+    def __init__(self, key, devid, time, value, error, error_code=None):
+        self.key, self.cluster_scoped = intern_stat_key(key)
+        self.devid = devid
+        self.time = time
+        self.value = value
+        self.error = error
+        self.error_code = error_code
+
+    @classmethod
+    def from_model(cls, stat):
+        """
+        Build a StatRecord from an isi_sdk.models.StatisticsCurrentStat.
+        """
+        return cls(
+            stat.key,
+            stat.devid,
+            stat.time,
+            stat.value,
+            stat.error,
+            getattr(stat, "error_code", None),
+        )
+
+    def __repr__(self):
+        return "StatRecord(%r, %r, %r, %r, %r)" % (
+            self.key,
+            self.devid,
+            self.time,
+            self.value,
+            self.error,
+        )
+
+
+def parse_stat_records(response_data):
+    """
+    Parse the JSON body of a statistics/current response.
+    :param bytes response_data: the body of the response.
+    :returns: a list of StatRecords.
+    """
+    return [
+        StatRecord(
+            stat.get("key"),
+            stat.get("devid"),
+            stat.get("time"),
+            stat.get("value"),
+            stat.get("error"),
+            stat.get("error_code"),
+        )
+        for stat in json_loads(response_data)["stats"]
+    ]
+
+
+def build_query_keys(stats, max_keys=None):
+    """
+    Join the list of stat names into comma delimitted strings that are each no
+    longer than MAX_KEYS_LEN so that they can be used as the keys argument of a
+    statistics query.
+    :param list stats: a list of stat names.
+    :param int max_keys: if specified then each string also contains no more
+    than this many stat names, which makes the size and server side cost of
+    each query more predictable.
+    :returns: a list of comma delimitted strings of stat names.
+    """
+    if max_keys is not None:
+        stats = list(stats)
+        query_keys_list = []
+        for stat_index in range(0, len(stats), max_keys):
+            query_keys_list.extend(
+                build_query_keys(stats[stat_index:stat_index + max_keys])
+            )
+        return query_keys_list
+
+    query_keys_list = []
+    stat_keys = ",".join(stats)
+    stat_index = 0
+    stat_keys_len = len(stat_keys)
+    while stat_index < stat_keys_len:
+        if stat_keys_len - stat_index > MAX_KEYS_LEN:
+            # find the last comma between stat_index and
+            # stat_index + MAX_KEYS_LEN
+            next_stat_index = stat_keys.rfind(",", stat_index, stat_index + MAX_KEYS_LEN)
+            # unless there's a key that is longer than MAX_KEYS_LEN
+            # then the rfind should never return -1 because there should
+            # definitely be at least one comma.
+            query_keys_list.append(stat_keys[stat_index:next_stat_index])
+            stat_index = next_stat_index + 1
+        else:
+            query_keys_list.append(stat_keys[stat_index:])
+            stat_index = stat_keys_len
+
+    return query_keys_list
 
 
 class IsiStatsClient(object):
@@ -21,14 +178,68 @@ class IsiStatsClient(object):
     metadata using the Isilon SDK.
     """
 
-    def __init__(self, stats_api):
+    def __init__(
+        self,
+        stats_api,
+        query_limit=None,
+        max_parallel_chunks=DEFAULT_MAX_PARALLEL_CHUNKS,
+        query_engine=QUERY_ENGINE_SDK,
+    ):
         """
         Setup the Isilon SDK to query the specified cluster's statistics.
         :param StatisticsApi stats_api: instance of StatisticsApi from the
         isi_sdk_8_0 or isi_sdk_7_2 package.
+        :param ClusterQueryLimit query_limit: optional concurrency limit that
+        the current stats queries are sent through (see isi_query_limiter).
+        :param int max_parallel_chunks: max number of chunks of a single
+        query_stats call that are sent in parallel.
+        :param string query_engine: one of QUERY_ENGINES.
         """
         # get the Statistics API
         self._stats_api = stats_api
+        self._query_limit = query_limit
+        self._max_parallel_chunks = max_parallel_chunks
+        if query_engine == QUERY_ENGINE_JSON:
+            self._query_current = self._query_current_json
+        else:
+            self._query_current = self._query_current_sdk
+
+    def _call(self, func, **kwargs):
+        if self._query_limit is None:
+            return func(**kwargs)
+        return self._query_limit.call(func, **kwargs)
+
+    def _get_statistics_current(self, **kwargs):
+        return self._query_current(**kwargs)
+
+    def _query_current_sdk(self, **kwargs):
+        return [
+            StatRecord.from_model(stat)
+            for stat in self._call(self._stats_api.get_statistics_current, **kwargs).stats
+        ]
+
+    def _query_current_json(self, **kwargs):
+        # the response is parsed after the query limit is released, so that
+        # the time it takes doesn't count as the cluster's latency.
+        return parse_stat_records(self._call(self._get_current_json_data, **kwargs))
+
+    def _get_current_json_data(self, **kwargs):
+        # same request that StatisticsApi.get_statistics_current sends, but
+        # without deserializing the response into swagger models.
+        response = self._stats_api.api_client.call_api(
+            STATISTICS_CURRENT_PATH,
+            "GET",
+            query_params=list(kwargs.items()),
+            header_params={"Accept": "application/json"},
+            auth_settings=["basicAuth"],
+            collection_formats={"keys": "csv", "key": "csv", "devid": "csv"},
+            _return_http_data_only=True,
+            _preload_content=False,
+        )
+        try:
+            return response.data
+        finally:
+            response.release_conn()
 
     def query_stats(
         self,
@@ -52,32 +263,37 @@ class IsiStatsClient(object):
         unavailable.
         :param bool expand_clientid: If true, use name resolution to expand
         client addresses and other IDs.
-        :returns: a list of isi_sdk.models.StatisticsCurrentStat
-        instances corresponding to the list of stat names provided in the stats
-        input list.
-        """
-        # setup the stat keys for querying as set of comma delimitted values
-        combined_query_results = None
-        stat_keys = ",".join(stats)
-        stat_index = 0
-        stat_keys_len = len(stat_keys)
-        while stat_index < stat_keys_len:
-            if stat_keys_len - stat_index > MAX_KEYS_LEN:
-                # find the last comma between stat_index and
-                # stat_index + MAX_KEYS_LEN
-                next_stat_index = stat_keys.rfind(
-                    ",", stat_index, stat_index + MAX_KEYS_LEN
-                )
-                # unless there's a key that is longer than MAX_KEYS_LEN
-                # then the rfind should never return -1 because there should
-                # definitely be at least one comma.
-                query_keys = stat_keys[stat_index:next_stat_index]
-                stat_index = next_stat_index + 1
-            else:
-                query_keys = stat_keys[stat_index:]
-                stat_index = stat_keys_len
+        :returns: a list of StatRecords corresponding to the list of stat
+        names provided in the stats input list.
+        """
+        return self.query_stats_keys(
+            build_query_keys(stats),
+            devid=devid,
+            substr=substr,
+            timeout=timeout,
+            degraded=degraded,
+            expand_clientid=expand_clientid,
+        )
+
+    def query_stats_keys(
+        self,
+        query_keys_list,
+        devid="all",
+        substr=False,
+        timeout=60,
+        degraded=True,
+        expand_clientid=False,
+    ):
+        """
+        Same as query_stats except the stats are provided as a list of comma
+        delimitted strings of stat names, each no longer than MAX_KEYS_LEN, as
+        returned by build_query_keys.
+        :param list query_keys_list: a list of comma delimitted stat names.
+        :returns: a list of StatRecords.
+        """
 
-            query_result = self._stats_api.get_statistics_current(
+        def query_chunk(query_keys):
+            return self._get_statistics_current(
                 keys=query_keys,
                 devid=devid,
                 substr=substr,
@@ -86,14 +302,80 @@ class IsiStatsClient(object):
                 timeout=timeout,
             )
 
-            if combined_query_results is None:
-                combined_query_results = query_result
-            else:
-                combined_query_results.stats.extend(query_result.stats)
+        if len(query_keys_list) == 1 or self._max_parallel_chunks <= 1:
+            chunk_results = [query_chunk(query_keys) for query_keys in query_keys_list]
+        else:
+            # send the chunks in parallel, imap yields the results in the
+            # same order as the chunks so the stats stay in key order.
+            pool = gevent.pool.Pool(self._max_parallel_chunks)
+            try:
+                chunk_results = list(pool.imap(query_chunk, query_keys_list))
+            except Exception:
+                pool.kill()
+                raise
+
+        combined_stats = []
+        for chunk_stats in chunk_results:
+            combined_stats.extend(chunk_stats)
+        return combined_stats
+
+    def query_node_stats_keys(
+        self,
+        query_keys_list,
+        devids,
+        shard_size,
+        timeout=60,
+        degraded=True,
+        expand_clientid=False,
+    ):
+        """
+        Same as query_stats_keys except that the node stats are queried in
+        shards of shard_size nodes that are sent in parallel, so that a large
+        cluster's slowest node only holds up its own shard. If a shard fails
+        then only the stats of that shard's nodes are dropped.
+        :param list query_keys_list: a list of comma delimitted node stat names.
+        :param list devids: the devids of the cluster's nodes.
+        :param int shard_size: the max number of nodes per shard.
+        :returns: a list of StatRecords.
+        """
+        shards = [
+            [str(devid) for devid in devids[devid_index:devid_index + shard_size]]
+            for devid_index in range(0, len(devids), shard_size)
+        ]
+        shard_errors = []
+
+        def query_shard(shard):
+            try:
+                return self.query_stats_keys(
+                    query_keys_list,
+                    devid=shard,
+                    timeout=timeout,
+                    degraded=degraded,
+                    expand_clientid=expand_clientid,
+                )
+            except Exception as exc:
+                LOG.warning(
+                    "Failed to query stats from nodes %s, exception raised: %s",
+                    ",".join(shard),
+                    str(exc),
+                )
+                shard_errors.append(exc)
+                return []
+
+        pool = gevent.pool.Pool(self._max_parallel_chunks)
+        try:
+            shard_results = list(pool.imap(query_shard, shards))
+        except BaseException:
+            pool.kill()
+            raise
+        if len(shard_errors) == len(shards):
+            # none of the shards worked, so fail the whole query
+            raise shard_errors[0]
 
-        # return the list of stats only (at this point there are no other
-        # fields on the query_results data model).
-        return combined_query_results.stats
+        combined_stats = []
+        for shard_stats in shard_results:
+            combined_stats.extend(shard_stats)
+        return combined_stats
 
     def query_stat(
         self, stat, devid="all", timeout=60, degraded=True, expand_clientid=False
@@ -109,9 +391,9 @@ class IsiStatsClient(object):
         unavailable.
         :param bool expand_clientid: If true, use name resolution to expand
         client addresses and other IDs.
-        :returns: an instance of isi_sdk.models.StatisticsCurrentStat
+        :returns: a list of StatRecords.
         """
-        query_result = self._stats_api.get_statistics_current(
+        return self._get_statistics_current(
             key=stat,
             devid=devid,
             degraded=degraded,
@@ -119,8 +401,6 @@ class IsiStatsClient(object):
             timeout=timeout,
         )
 
-        return query_result.stats
-
     def get_stats_metadata(self, stats=None):
         """
         Query the cluster for the metadata associated with each key specified
@@ -129,7 +409,11 @@ class IsiStatsClient(object):
         :returns: a list of isi_sdk.models.StatisticsKey instances (in
         the same order as the stats input param list).
         """
-        if stats is not None and len(stats) < MAX_DIRECT_METADATA_STATS:
+        # the direct queries are sent in parallel, so the cutoff scales with
+        # the number of queries that are in flight at once.
+        if stats is not None and len(stats) < MAX_DIRECT_METADATA_STATS * max(
+            1, self._max_parallel_chunks
+        ):
             return self._get_metadata_direct(stats)
         return self._get_metadata_indirect(stats)
 
@@ -139,7 +423,7 @@ class IsiStatsClient(object):
         :param string stat: the name of the stat to query
         :returns: a single isi_sdk.models.StatisticsKey.
         """
-        result = self._stats_api.get_statistics_key(statistics_key_id=stat)
+        result = self._call(self._stats_api.get_statistics_key, statistics_key_id=stat)
         return result.keys[0]
 
     def _get_metadata_indirect(self, stats):
@@ -150,32 +434,34 @@ class IsiStatsClient(object):
         is None then return all metadata.
         :returns: a list of isi_sdk.models.StatisticsKey instances.
         """
+        # stat name -> indexes of the stat in the stats list
         stat_map = {}
         if stats is not None:
-            num_stats = len(stats)
-            for stat_index in range(0, num_stats):
-                stat_map[stats[stat_index]] = stat_index
-            result_list = [None] * num_stats
+            for stat_index in range(0, len(stats)):
+                stat_map.setdefault(stats[stat_index], []).append(stat_index)
+            # the number of distinct stats that haven't been found yet
+            num_stats = len(stat_map)
+            result_list = [None] * len(stats)
         else:
+            num_stats = -1
             result_list = []
         query_args = dict()
-        while True:
-            results = self._stats_api.get_statistics_keys(**query_args)
+        # stop paging through the catalog as soon as every stat was found.
+        while num_stats != 0:
+            results = self._call(self._stats_api.get_statistics_keys, **query_args)
             if stats is None:
-                if result_list is None:
-                    result_list = results.keys
-                else:
-                    result_list.extend(results.keys)
+                result_list.extend(results.keys)
             else:
                 for key in results.keys:
                     try:
-                        stat_index = stat_map[key.key]
-                        result_list[stat_index] = key
-                        num_stats -= 1
-                        if num_stats == 0:
-                            break
+                        stat_indexes = stat_map.pop(key.key)
                     except KeyError:
-                        pass
+                        continue
+                    for stat_index in stat_indexes:
+                        result_list[stat_index] = key
+                    num_stats -= 1
+                    if num_stats == 0:
+                        break
 
             resume = results.resume
             if resume is None:
@@ -193,8 +479,11 @@ class IsiStatsClient(object):
         :param list stats: the list of stat names to query for metadata.
         :returns: a list of isi_sdk.models.StatisticsKey instances.
         """
-        metadata_list = []
-        for stat in stats:
-            metadata = self.get_stat_metadata(stat)
-            metadata_list.append(metadata)
-        return metadata_list
+        if len(stats) == 1 or self._max_parallel_chunks <= 1:
+            return [self.get_stat_metadata(stat) for stat in stats]
+        pool = gevent.pool.Pool(self._max_parallel_chunks)
+        try:
+            return list(pool.imap(self.get_stat_metadata, stats))
+        except BaseException:
+            pool.kill()
+            raise
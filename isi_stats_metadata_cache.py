@@ -0,0 +1,265 @@
+"""
+Persistent on-disk cache of the stats metadata (i.e. the default cache time and
+policy intervals of each stat key) that the update intervals of the stat
+groups are computed from, so that restarting the daemon doesn't require
+querying every cluster for the metadata of every stat again.
+"""
+from builtins import object
+from builtins import range
+from builtins import str
+import json
+import logging
+import os
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_STATS_METADATA_CACHE_FILE = "./isi_data_insights_d_metadata.json"
+# entries older than this many seconds are still used, but are revalidated in
+# the background while the daemon is running.
+DEFAULT_STATS_METADATA_CACHE_TTL = 24 * 60 * 60  # seconds
+# entries older than this many TTLs are not used at all.
+MAX_STALE_TTLS = 10
+# version of the format of the cache file.
+CACHE_FILE_VERSION = 1
+
+
+class StatMetadata(object):
+    """
+    The subset of an isi_sdk.models.StatisticsKey that is needed to compute a
+    stat's update interval.
+    """
+
+    __slots__ = ("key", "default_cache_time", "policy_intervals")
+
+    def __init__(self, key, default_cache_time, policy_intervals):
+        self.key = key
+        self.default_cache_time = default_cache_time
+        self.policy_intervals = policy_intervals
+
+    @classmethod
+    def from_statistics_key(cls, statistics_key):
+        policy_intervals = None
+        if statistics_key.policies:
+            policy_intervals = [policy.interval for policy in statistics_key.policies]
+        return cls(
+            statistics_key.key, statistics_key.default_cache_time, policy_intervals
+        )
+
+    def to_json(self):
+        return {
+            "default_cache_time": self.default_cache_time,
+            "policy_intervals": self.policy_intervals,
+        }
+
+    def __eq__(self, other):
+        return (
+            self.key == other.key
+            and self.default_cache_time == other.default_cache_time
+            and self.policy_intervals == other.policy_intervals
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def cluster_cache_key(cluster):
+    """
+    The metadata of a stat might change when the cluster is upgraded, so the
+    entries of each cluster are stored per release of the cluster. The GUID
+    and release are used when they are known because the name and SDK version
+    of a cluster don't change when it is replaced or upgraded.
+    """
+    if cluster.guid is not None and cluster.release is not None:
+        return "%s/%s" % (cluster.guid, cluster.release)
+    return "%s/%s" % (cluster.name, str(cluster.version))
+
+
+class StatsMetadataCache(object):
+    def __init__(
+        self,
+        path=DEFAULT_STATS_METADATA_CACHE_FILE,
+        ttl=DEFAULT_STATS_METADATA_CACHE_TTL,
+    ):
+        self.path = path
+        self.ttl = ttl
+        # cluster cache key -> stat key -> (StatMetadata, update time)
+        self._entries = {}
+        # cluster -> set of the stat keys whose metadata was used, whose
+        # entries are revalidated once they are older than the ttl.
+        self._used = {}
+        # whether there are entries that haven't been saved yet
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.path) is False:
+            return
+        try:
+            with open(self.path, "r") as cache_fp:
+                cache_json = json.load(cache_fp)
+            if cache_json.get("version") != CACHE_FILE_VERSION:
+                LOG.info("Ignoring stats metadata cache with different version.")
+                return
+            for cluster_key, stats_json in cache_json["clusters"].items():
+                self._entries[cluster_key] = {
+                    stat_key: (
+                        StatMetadata(
+                            stat_key,
+                            stat_json["default_cache_time"],
+                            stat_json["policy_intervals"],
+                        ),
+                        stat_json["updated"],
+                    )
+                    for stat_key, stat_json in stats_json.items()
+                }
+        except (IOError, OSError, ValueError, KeyError, TypeError) as exc:
+            LOG.warning(
+                "Failed to load stats metadata cache %s, ignoring it. Error: %s",
+                self.path,
+                str(exc),
+            )
+            self._entries = {}
+
+    def save(self):
+        """
+        Write the entries to the cache file, unless none of them changed since
+        they were last saved or loaded.
+        """
+        if self._dirty is False:
+            return
+        self._dirty = False
+        cache_json = {"version": CACHE_FILE_VERSION, "clusters": {}}
+        for cluster_key, cluster_entries in self._entries.items():
+            stats_json = cache_json["clusters"][cluster_key] = {}
+            for stat_key, (stat_metadata, update_time) in cluster_entries.items():
+                stat_json = stat_metadata.to_json()
+                stat_json["updated"] = update_time
+                stats_json[stat_key] = stat_json
+        # write to a temp file and then rename it so that the cache file is
+        # never left partially written.
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cache_fp:
+                json.dump(cache_json, cache_fp)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            LOG.warning(
+                "Failed to save stats metadata cache %s. Error: %s",
+                self.path,
+                str(exc),
+            )
+
+    def get_stats_metadata(self, cluster, stat_names, query_func):
+        """
+        Get the metadata of each stat in stat_names from the cache, querying
+        the cluster for the ones that are not cached.
+        :param ClusterConfig cluster: the cluster the stats belong to.
+        :param list stat_names: the stat keys to get the metadata of.
+        :param function query_func: called with the cluster and a list of stat
+        keys to query the cluster for their metadata, returns a list of
+        StatMetadata in the same order.
+        :returns: a list of StatMetadata in the same order as stat_names.
+        The new entries are saved to the cache file by the next call to save.
+        """
+        cur_time = time.time()
+        try:
+            cluster_entries = self._entries[cluster_cache_key(cluster)]
+        except KeyError:
+            self._entries[cluster_cache_key(cluster)] = cluster_entries = {}
+
+        self._used.setdefault(cluster, set()).update(stat_names)
+        results = [None] * len(stat_names)
+        missing = []
+        for stat_index in range(0, len(stat_names)):
+            stat_name = stat_names[stat_index]
+            try:
+                stat_metadata, update_time = cluster_entries[stat_name]
+            except KeyError:
+                missing.append(stat_index)
+                continue
+            age = cur_time - update_time
+            if age > self.ttl * MAX_STALE_TTLS:
+                missing.append(stat_index)
+                continue
+            results[stat_index] = stat_metadata
+
+        if missing:
+            missing_names = [stat_names[stat_index] for stat_index in missing]
+            missing_metadata = query_func(cluster, missing_names)
+            for stat_index, stat_metadata in zip(missing, missing_metadata):
+                results[stat_index] = stat_metadata
+                if stat_metadata is not None:
+                    cluster_entries[stat_metadata.key] = (stat_metadata, cur_time)
+                    self._dirty = True
+
+        return results
+
+    def next_revalidation_time(self):
+        """
+        :returns: the time at which the oldest of the used entries becomes
+        stale, or None if no entries were used.
+        """
+        oldest_update_time = None
+        for cluster, stat_names in self._used.items():
+            cluster_entries = self._entries[cluster_cache_key(cluster)]
+            for stat_name in stat_names:
+                try:
+                    update_time = cluster_entries[stat_name][1]
+                except KeyError:
+                    # the stat doesn't exist on the cluster
+                    continue
+                if oldest_update_time is None or update_time < oldest_update_time:
+                    oldest_update_time = update_time
+        if oldest_update_time is None:
+            return None
+        return oldest_update_time + self.ttl
+
+    def revalidate(self, query_func):
+        """
+        Query the clusters for the metadata of the used entries that are older
+        than the ttl and update the cache file.
+        :param function query_func: same as for get_stats_metadata.
+        :returns: a list of the clusters whose metadata changed, whose update
+        intervals have to be recomputed.
+        """
+        min_update_time = time.time() - self.ttl
+        changed_clusters = []
+        for cluster, used_stat_names in list(self._used.items()):
+            cluster_entries = self._entries[cluster_cache_key(cluster)]
+            stat_names = [
+                stat_name
+                for stat_name in used_stat_names
+                if stat_name in cluster_entries
+                and cluster_entries[stat_name][1] <= min_update_time
+            ]
+            if not stat_names:
+                continue
+            try:
+                stats_metadata = query_func(cluster, stat_names)
+            except Exception as exc:
+                LOG.warning(
+                    "Failed to revalidate stats metadata of cluster %s. Error: %s",
+                    cluster.name,
+                    str(exc),
+                )
+                continue
+            cur_time = time.time()
+            changed = False
+            for stat_name, stat_metadata in zip(stat_names, stats_metadata):
+                if stat_metadata is None:
+                    continue
+                if cluster_entries[stat_name][0] != stat_metadata:
+                    LOG.info(
+                        "Metadata of stat %s changed on cluster %s.",
+                        stat_name,
+                        cluster.name,
+                    )
+                    changed = True
+                cluster_entries[stat_name] = (stat_metadata, cur_time)
+                self._dirty = True
+            if changed:
+                changed_clusters.append(cluster)
+        self.save()
+        return changed_clusters
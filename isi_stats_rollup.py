@@ -0,0 +1,245 @@
+"""
+Rollup (downsampling) stage between the daemon and the stats processor. It
+keeps streaming aggregates (min, max, mean, last and count) of the numeric
+stats of each cluster over one or more fixed time windows and passes each
+aggregate to the stats processor as a separate stat once its window has
+closed, so the downsampled series don't have to be computed afterwards, e.g.
+by InfluxDB continuous queries.
+"""
+from __future__ import division
+from builtins import object
+from builtins import str
+import logging
+import re
+
+from isi_stats_client import StatRecord
+
+
+LOG = logging.getLogger(__name__)
+
+# max number of (window, cluster, stat key, devid) aggregates that are kept
+# at once, the stats of new series are not rolled up beyond that.
+DEFAULT_MAX_ROLLUP_SERIES = 1000000
+# suffix of the key of the rollup stats, formatted with the window's label.
+ROLLUP_KEY_SUFFIX = ".rollup_%s"
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+WINDOW_RE = re.compile(r"^([0-9]+)([smhd]?)$")
+
+
+def parse_rollup_window(window_cfg):
+    """
+    Parse a rollup window, which is a number of seconds optionally followed by
+    a unit, e.g. 90, 90s, 1m, 15m, 1h or 1d.
+    :returns: a tuple of the window's label and its length in seconds.
+    :raises ValueError: if the window is invalid.
+    """
+    match = WINDOW_RE.match(window_cfg.strip())
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(
+            "Invalid rollup window %s, expected a number of seconds, minutes "
+            "(m), hours (h) or days (d), e.g. 15m." % window_cfg
+        )
+    number, unit = match.groups()
+    return number + (unit or "s"), int(number) * WINDOW_UNITS[unit or "s"]
+
+
+class RollupAggregate(object):
+    """
+    The aggregate of the values of a single series in a single window.
+    """
+
+    __slots__ = ("window_start", "min", "max", "sum", "count", "last")
+
+    def __init__(self, window_start, value):
+        self.window_start = window_start
+        self.min = self.max = self.sum = self.last = value
+        self.count = 1
+
+    def add(self, value):
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+    def to_value(self):
+        return {
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count,
+            "last": self.last,
+            "count": self.count,
+        }
+
+
+class RollupWindow(object):
+    """
+    The aggregates of one cluster's series in one rollup window.
+    """
+
+    def __init__(self, label, length):
+        self.key_suffix = ROLLUP_KEY_SUFFIX % label
+        self.length = length
+        # (stat key, devid) -> RollupAggregate
+        self.aggregates = {}
+        # the aggregates that closed before this time have been collected
+        self.collected_until = 0
+
+
+class RollupStatsProcessor(object):
+    """
+    Stats processor that rolls up the stats on their way to the actual stats
+    processor, which it wraps. Each rollup stat has the key of the original
+    stat followed by ROLLUP_KEY_SUFFIX, the timestamp of the start of its
+    window and a dict value of the aggregates, e.g.:
+    node.disk.busy.avg.rollup_15m {"min", "max", "mean", "last", "count"}
+    """
+
+    def __init__(
+        self,
+        stats_processor,
+        windows,
+        forward_raw_stats=True,
+        max_series=DEFAULT_MAX_ROLLUP_SERIES,
+    ):
+        """
+        :param module stats_processor: the stats processor that the raw and the
+        rollup stats are passed to, which must have a process_stat function.
+        :param list windows: a list of (label, length in seconds) tuples.
+        :param bool forward_raw_stats: whether to also pass the raw stats to the
+        stats processor or only the rollups.
+        """
+        self._stats_processor = stats_processor
+        self._windows = list(windows)
+        self._forward_raw_stats = forward_raw_stats
+        self._max_series = max_series
+        self._num_series = 0
+        self._num_dropped_series = 0
+        # cluster name -> list of the cluster's RollupWindows, in the same
+        # order as self._windows
+        self._cluster_windows = {}
+        # cluster name -> list of the rollup stats that are ready to be passed
+        # to the stats processor at the end of the current pass
+        self._closed_rollups = {}
+        # cluster name -> max timestamp of the stats of the current pass
+        self._pass_times = {}
+
+    def begin_process(self, cluster):
+        self._pass_times[cluster] = 0
+        self._stats_processor.begin_process(cluster)
+
+    def process_stat(self, cluster, stat):
+        if self._forward_raw_stats:
+            self._stats_processor.process_stat(cluster, stat)
+        value = stat.value
+        if (
+            not isinstance(value, (int, float))
+            or isinstance(value, bool)
+            or stat.time is None
+        ):
+            # only numeric stats are rolled up
+            return
+        stat_time = int(stat.time)
+        if stat_time > self._pass_times.get(cluster, 0):
+            self._pass_times[cluster] = stat_time
+        try:
+            cluster_windows = self._cluster_windows[cluster]
+        except KeyError:
+            cluster_windows = self._cluster_windows[cluster] = [
+                RollupWindow(label, length) for label, length in self._windows
+            ]
+        series = (stat.key, stat.devid)
+        for window in cluster_windows:
+            window_start = stat_time - stat_time % window.length
+            try:
+                aggregate = window.aggregates[series]
+            except KeyError:
+                if self._num_series >= self._max_series:
+                    self._num_dropped_series += 1
+                    if self._num_dropped_series == 1:
+                        LOG.warning(
+                            "Reached the max of %d rollup series, the stats of "
+                            "new series are not rolled up.",
+                            self._max_series,
+                        )
+                    continue
+                window.aggregates[series] = RollupAggregate(window_start, value)
+                self._num_series += 1
+                continue
+            if aggregate.window_start == window_start:
+                aggregate.add(value)
+            elif aggregate.window_start < window_start:
+                # the series moved on to the next window, so its aggregate of
+                # the previous window is complete.
+                self._close(cluster, window, series, aggregate)
+                window.aggregates[series] = RollupAggregate(window_start, value)
+                self._num_series += 1
+            # else the stat is older than the current window, which happens if
+            # a node's clock went backwards, and is not rolled up.
+
+    def end_process(self, cluster):
+        # collect the aggregates of the series that weren't updated since
+        # their window closed, e.g. because the stat is no longer queried, so
+        # that the memory they use is bounded.
+        pass_time = self._pass_times.pop(cluster, 0)
+        for window in self._cluster_windows.get(cluster, ()):
+            if pass_time < window.collected_until:
+                continue
+            current_window_start = pass_time - pass_time % window.length
+            for series, aggregate in list(window.aggregates.items()):
+                if aggregate.window_start < current_window_start:
+                    self._close(cluster, window, series, aggregate)
+                    del window.aggregates[series]
+            window.collected_until = current_window_start + window.length
+        self._flush_closed_rollups(cluster)
+        self._stats_processor.end_process(cluster)
+
+    def stop(self):
+        """
+        Pass the aggregates of the windows that are still open to the stats
+        processor, then stop it.
+        """
+        for cluster, cluster_windows in list(self._cluster_windows.items()):
+            for window in cluster_windows:
+                for series, aggregate in list(window.aggregates.items()):
+                    self._close(cluster, window, series, aggregate)
+                window.aggregates = {}
+            if self._closed_rollups.get(cluster):
+                self._stats_processor.begin_process(cluster)
+                self._flush_closed_rollups(cluster)
+                self._stats_processor.end_process(cluster)
+        LOG.info(
+            "Flushed rollups, %d series were not rolled up because of the max "
+            "of %d series.",
+            self._num_dropped_series,
+            self._max_series,
+        )
+        if hasattr(self._stats_processor, "stop") is True:
+            self._stats_processor.stop()
+
+    def _close(self, cluster, window, series, aggregate):
+        key, devid = series
+        self._num_series -= 1
+        try:
+            closed_rollups = self._closed_rollups[cluster]
+        except KeyError:
+            closed_rollups = self._closed_rollups[cluster] = []
+        closed_rollups.append(
+            StatRecord(
+                key + window.key_suffix,
+                devid,
+                aggregate.window_start,
+                aggregate.to_value(),
+                None,
+            )
+        )
+
+    def _flush_closed_rollups(self, cluster):
+        closed_rollups = self._closed_rollups.pop(cluster, None)
+        if not closed_rollups:
+            return
+        LOG.debug("Passing %d rollups of %s.", len(closed_rollups), str(cluster))
+        for rollup_stat in closed_rollups:
+            self._stats_processor.process_stat(cluster, rollup_stat)
@@ -0,0 +1,333 @@
+"""
+Windowed derived stats, i.e. stats that are derived from the recent values of
+a stat on each node (or the cluster) rather than from the current values
+only: moving averages, exponentially weighted moving averages, min/max over a
+window, rates of change and rolling percentiles. The recent values are kept
+in fixed size ring buffers per cluster, devid and stat, so the memory that
+they use is bounded by the size of their windows.
+"""
+from __future__ import division
+from builtins import object
+from builtins import str
+import array
+import logging
+import math
+import re
+
+from isi_composite_stats import percentile
+from isi_data_insights_daemon import DerivedStatComputer
+
+
+LOG = logging.getLogger(__name__)
+
+# max number of values in the window of a windowed stat
+MAX_WINDOW_SIZE = 10000
+# no rate is derived across a gap between two values of a counter that is
+# longer than this many times the previous interval between its values.
+MAX_RATE_GAP_FACTOR = 5
+
+
+class RingBuffer(object):
+    """
+    The last size values of a stat on a single node.
+    """
+
+    __slots__ = ("_values", "_next", "count", "last_time")
+
+    def __init__(self, size):
+        self._values = array.array("d", [0.0]) * size
+        self._next = 0
+        # number of values in the buffer
+        self.count = 0
+        # timestamp of the last value that was pushed
+        self.last_time = None
+
+    def push(self, value, timestamp):
+        values = self._values
+        values[self._next] = value
+        self._next += 1
+        if self._next == len(values):
+            self._next = 0
+        if self.count < len(values):
+            self.count += 1
+        self.last_time = timestamp
+
+    def values(self):
+        """
+        :returns: the values in the buffer, in no particular order.
+        """
+        if self.count < len(self._values):
+            return self._values[:self.count]
+        return self._values
+
+
+class WindowedStatComputer(DerivedStatComputer):
+    """
+    Base class of the windowed stats, which derive one stat per node (or per
+    cluster for cluster stats) from the history of the input stat's values on
+    that node. The history is kept per cluster by the DerivedStatContext.
+    """
+
+    DESCRIPTION = "Windowed stat"
+
+    def __init__(self, input_stat, out_stat_name, new_window, update):
+        """
+        :param function new_window: returns a new window of a node.
+        :param function update: called with a node's window and the value and
+        timestamp of the input stat, adds the value to the window unless it was
+        already added, i.e. the stat wasn't updated since the last pass, and
+        returns the value of the derived stat or None to skip it.
+        """
+        super(WindowedStatComputer, self).__init__(out_stat_name)
+        self._input_stat = input_stat
+        self._new_window = new_window
+        self._update = update
+
+    def new_state(self, context):
+        state = super(WindowedStatComputer, self).new_state(context)
+        # list of (devid, value, timestamp) selected in this pass
+        state.samples = []
+        return state
+
+    def input_keys(self):
+        return (self._input_stat.name,)
+
+    def select_stat(self, state, stat):
+        if stat.key == self._input_stat.name:
+            state.samples.append(
+                (stat.devid, self._input_stat.get_value(stat.value), int(stat.time))
+            )
+            self._choose_stat(state, stat)
+
+    def compute_derived_stats(self, state):
+        derived_stats = []
+        # devid -> the window of the node, see new_window
+        windows = state.history
+        for devid, value, timestamp in state.samples:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                derived_stats.append(
+                    self._create_derived_stat(
+                        state,
+                        None,
+                        devid,
+                        error="Invalid value %r of input stat: %s"
+                        % (value, self._input_stat.full_name),
+                    )
+                )
+                continue
+            try:
+                window = windows[devid]
+            except KeyError:
+                window = windows[devid] = self._new_window()
+            derived_stat_value = self._update(window, value, timestamp)
+            if derived_stat_value is None:
+                continue
+            derived_stats.append(
+                self._create_derived_stat(state, derived_stat_value, devid)
+            )
+        return derived_stats
+
+
+class RingBufferStatComputer(WindowedStatComputer):
+    """
+    A windowed stat that is computed from the last window_size values of the
+    input stat.
+    """
+
+    def __init__(self, input_stat, out_stat_name, window_size, operation):
+        """
+        :param function operation: computes the derived value from the
+        array of the values in the window.
+        """
+        super(RingBufferStatComputer, self).__init__(
+            input_stat, out_stat_name, self._new_ring_buffer, self._push_value
+        )
+        self._window_size = window_size
+        self._operation = operation
+
+    def _new_ring_buffer(self):
+        return RingBuffer(self._window_size)
+
+    def _push_value(self, window, value, timestamp):
+        if window.last_time != timestamp:
+            window.push(value, timestamp)
+        return self._operation(window.values())
+
+
+class EwmaStatComputer(WindowedStatComputer):
+    """
+    Exponentially weighted moving average, in which each new value has a
+    weight of alpha.
+    """
+
+    def __init__(self, input_stat, out_stat_name, alpha):
+        super(EwmaStatComputer, self).__init__(
+            input_stat, out_stat_name, self._new_average, self._update_average
+        )
+        self._alpha = alpha
+
+    def _new_average(self):
+        # [average, timestamp of the last value]
+        return [None, None]
+
+    def _update_average(self, window, value, timestamp):
+        if window[1] != timestamp:
+            if window[0] is None:
+                window[0] = value
+            else:
+                window[0] += self._alpha * (value - window[0])
+            window[1] = timestamp
+        return window[0]
+
+
+class RateStatComputer(WindowedStatComputer):
+    """
+    Per second rate of change of a counter, computed from its last two values
+    and their timestamps. When the counter decreases, because it was reset or
+    the node rebooted, or when the gap since its last value is much longer
+    than usual, because the node was down in the meantime, the counter is
+    re-baselined and no rate is derived from that value.
+    """
+
+    def __init__(self, input_stat, out_stat_name):
+        super(RateStatComputer, self).__init__(
+            input_stat, out_stat_name, self._new_counter, self._update_rate
+        )
+
+    def _new_counter(self):
+        # [last value, timestamp of the last value, interval between the last
+        # two values]
+        return [None, None, None]
+
+    def _update_rate(self, window, value, timestamp):
+        prev_value, prev_time, prev_interval = window
+        if prev_time is not None and timestamp <= prev_time:
+            # the stat wasn't updated since the last pass
+            return None
+        window[0] = value
+        window[1] = timestamp
+        if prev_value is None:
+            return None
+        interval = timestamp - prev_time
+        window[2] = interval
+        if value < prev_value:
+            LOG.debug(
+                "Counter %s was reset from %s to %s.",
+                self._input_stat.full_name,
+                str(prev_value),
+                str(value),
+            )
+            return None
+        if prev_interval is not None and interval > MAX_RATE_GAP_FACTOR * prev_interval:
+            LOG.debug(
+                "Counter %s wasn't updated for %d seconds.",
+                self._input_stat.full_name,
+                interval,
+            )
+            # the next interval is the new baseline
+            window[2] = None
+            return None
+        return (value - prev_value) / interval
+
+
+def _window_avg(values):
+    return math.fsum(values) / len(values)
+
+
+def _window_percentile(percent):
+    def window_percentile(values):
+        return percentile(values, percent)
+
+    return window_percentile
+
+
+# the windowed stats that are configured as op(stat,window_size)
+WINDOW_OPERATIONS = {
+    "moving_avg": _window_avg,
+    "window_min": min,
+    "window_max": max,
+}
+# window_p<percent>(stat,window_size), e.g. window_p95(node.cpu.idle.avg,60)
+WINDOW_PERCENTILE_RE = re.compile(r"^window_p([0-9]{1,2}(\.[0-9]+)?|100)$")
+WINDOWED_STAT_RE = re.compile(r"^([a-z_0-9.]+)\(([^,()]+)(?:,([^,()]+))?\)$")
+
+
+def parse_windowed_stat(stat_cfg):
+    """
+    Parse the configuration of a windowed stat, which is one of:
+    moving_avg(stat,window_size)
+    window_min(stat,window_size)
+    window_max(stat,window_size)
+    window_p<percent>(stat,window_size)
+    ewma(stat,alpha)
+    rate(stat)
+    where stat is the name of a stat (optionally with :fields), window_size is
+    the number of values in the window and alpha is the weight of each new
+    value in the ewma.
+    :returns: a tuple of the op name, the stat, the parameter (or None) and
+    the name of the output stat.
+    :raises RuntimeError: if stat_cfg is invalid.
+    """
+    match = WINDOWED_STAT_RE.match(stat_cfg)
+    if match is None:
+        raise RuntimeError(
+            "Failed to parse %s. Expected: op(stat,window_size), ewma(stat,alpha)"
+            " or rate(stat)." % stat_cfg
+        )
+    op_name, in_stat_name, param = match.groups()
+    in_stat_name = in_stat_name.strip()
+    out_stat_name = in_stat_name.replace(":", ".") + "." + op_name
+    if op_name == "rate":
+        if param is not None:
+            raise RuntimeError("The rate of %s doesn't take a parameter." % stat_cfg)
+    elif param is None:
+        raise RuntimeError("Missing parameter of %s." % stat_cfg)
+    elif op_name == "ewma":
+        try:
+            param = float(param)
+        except ValueError:
+            param = None
+        if param is None or param <= 0.0 or param > 1.0:
+            raise RuntimeError(
+                "Invalid alpha of %s, expected a number greater than 0 and "
+                "less than or equal to 1." % stat_cfg
+            )
+        out_stat_name += "_" + match.group(3).strip().replace(".", "_")
+    elif op_name in WINDOW_OPERATIONS or WINDOW_PERCENTILE_RE.match(op_name):
+        try:
+            param = int(param)
+        except ValueError:
+            param = None
+        if param is None or param < 1 or param > MAX_WINDOW_SIZE:
+            raise RuntimeError(
+                "Invalid window size of %s, expected an integer from 1 to %d."
+                % (stat_cfg, MAX_WINDOW_SIZE)
+            )
+        out_stat_name += "_" + str(param)
+    else:
+        raise RuntimeError("Invalid operation %s specified for %s." % (op_name, stat_cfg))
+    return op_name, in_stat_name, param, out_stat_name
+
+
+def rate_stat_name(stat_name):
+    """
+    :returns: the name of the rate stat of stat_name, which may include
+    :fields.
+    """
+    return stat_name.replace(":", ".") + ".rate"
+
+
+def build_windowed_stat_computer(op_name, input_stat, param, out_stat_name):
+    if op_name == "rate":
+        return RateStatComputer(input_stat, out_stat_name)
+    if op_name == "ewma":
+        return EwmaStatComputer(input_stat, out_stat_name, param)
+    try:
+        operation = WINDOW_OPERATIONS[op_name]
+    except KeyError:
+        operation = _window_percentile(
+            float(WINDOW_PERCENTILE_RE.match(op_name).group(1))
+        )
+    return RingBufferStatComputer(input_stat, out_stat_name, param, operation)
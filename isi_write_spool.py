@@ -0,0 +1,285 @@
+"""
+Durable on-disk spool of the batches of points that couldn't be written to the
+stats processor's backend, e.g. because the InfluxDB was down, so that they
+can be replayed, oldest first, once the backend has recovered. The spool is a
+directory of append-only segment files of compressed, checksummed records,
+bounded by the total size of the segments and the age of their records.
+"""
+from builtins import object
+from builtins import str
+import logging
+import os
+import struct
+import time
+import zlib
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_SPOOL_MAX_AGE = 7 * 24 * 60 * 60  # seconds
+# size at which a segment is closed and a new one is started, which is also
+# the granularity at which the spool is trimmed to its max size and age.
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+# the spool has at least this many segments when it is full
+MIN_SEGMENTS = 4
+SEGMENT_SUFFIX = ".seg"
+# each segment starts with SEGMENT_MAGIC, which includes the format version
+SEGMENT_MAGIC = b"ISWSPL01"
+# crc32, length of the payload, number of points and time at which the record
+# was spooled, followed by the payload, which is the zlib compressed data. The
+# crc32 covers the rest of the header and the payload.
+RECORD_HEADER = struct.Struct("<IIII")
+COMPRESS_LEVEL = 1
+
+
+class SpoolPosition(object):
+    """
+    Position of a record in the spool, see WriteSpool.peek.
+    """
+
+    __slots__ = ("seq", "offset", "end_offset")
+
+    def __init__(self, seq, offset, end_offset):
+        self.seq = seq
+        self.offset = offset
+        self.end_offset = end_offset
+
+
+class WriteSpool(object):
+    def __init__(
+        self,
+        directory,
+        max_bytes=DEFAULT_SPOOL_MAX_BYTES,
+        max_age=DEFAULT_SPOOL_MAX_AGE,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+    ):
+        """
+        Open the spool in directory, which is created if it doesn't exist.
+        The segments of a previous run are kept and replayed.
+        :param int max_bytes: max total size of the segments, beyond which the
+        oldest segments are deleted.
+        :param int max_age: max number of seconds since the last record of a
+        segment was spooled, after which the segment is deleted.
+        :raises OSError: if the directory can't be created or read.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._segment_bytes = max(min(segment_bytes, max_bytes // MIN_SEGMENTS), 1)
+        if os.path.isdir(directory) is False:
+            os.mkdir(directory)
+        # seq -> size of the segment, in order of age
+        self._segments = {}
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                seq = int(file_name[: -len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            self._segments[seq] = os.path.getsize(self._segment_path(seq))
+        self._next_seq = max(self._segments) + 1 if self._segments else 0
+        # the segment that records are appended to, which is never one of a
+        # previous run because its last record might be incomplete.
+        self._write_seq = None
+        self._write_fp = None
+        # the segment and offset of the oldest record that hasn't been
+        # committed yet.
+        self._read_seq = None
+        self._read_offset = 0
+        self._read_fp = None
+        self.spooled_records = 0
+        self.dropped_bytes = 0
+        if self._segments:
+            LOG.info(
+                "Found %d bytes of spooled points in %s.", self.num_bytes(), directory
+            )
+
+    def num_bytes(self):
+        return sum(self._segments.values())
+
+    def is_empty(self):
+        return not self._segments
+
+    def append(self, data, num_points):
+        """
+        Durably append a record of data to the spool, then delete the oldest
+        segments if the spool has grown beyond its max size.
+        :param bytes data: the data of the record, e.g. line protocol.
+        :raises IOError: if the record couldn't be written.
+        """
+        payload = zlib.compress(data, COMPRESS_LEVEL)
+        header_rest = RECORD_HEADER.pack(0, len(payload), num_points, int(time.time()))[4:]
+        crc = zlib.crc32(header_rest + payload) & 0xFFFFFFFF
+        record = struct.pack("<I", crc) + header_rest + payload
+        if (
+            self._write_fp is not None
+            and self._segments[self._write_seq] + len(record) > self._segment_bytes
+        ):
+            self._close_write_segment()
+        if self._write_fp is None:
+            self._open_write_segment()
+        self._write_fp.write(record)
+        self._write_fp.flush()
+        os.fsync(self._write_fp.fileno())
+        self._segments[self._write_seq] += len(record)
+        self.spooled_records += 1
+        self._trim()
+
+    def peek(self):
+        """
+        :returns: a tuple of the SpoolPosition, data and number of points of
+        the oldest record that hasn't been committed yet, or None if there is
+        none.
+        """
+        self._trim()
+        while self._segments:
+            if self._read_seq is None or self._read_seq not in self._segments:
+                self._start_reading(min(self._segments))
+            record = self._read_record()
+            if record is not None:
+                return record
+            if self._read_seq == self._write_seq:
+                # all of the records that were spooled so far were read
+                return None
+            # the rest of the segment was read or can't be read
+            self._delete_segment(self._read_seq)
+        return None
+
+    def commit(self, position):
+        """
+        Mark the record at position, which was returned by peek, as done, and
+        delete its segment once all of its records are done.
+        """
+        if position.seq != self._read_seq or position.offset != self._read_offset:
+            return
+        self._read_offset = position.end_offset
+        if (
+            self._read_seq != self._write_seq
+            and self._read_offset >= self._segments[self._read_seq]
+        ):
+            self._delete_segment(self._read_seq)
+        elif (
+            self._read_seq == self._write_seq
+            and self._read_offset >= self._segments[self._read_seq]
+        ):
+            # everything that was spooled is done, start over with a new
+            # segment.
+            self._close_write_segment()
+            self._delete_segment(self._read_seq)
+
+    def close(self):
+        self._close_write_segment()
+        self._close_read_segment()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, "%016d%s" % (seq, SEGMENT_SUFFIX))
+
+    def _open_write_segment(self):
+        self._write_seq = self._next_seq
+        self._next_seq += 1
+        self._write_fp = open(self._segment_path(self._write_seq), "ab")
+        self._write_fp.write(SEGMENT_MAGIC)
+        self._segments[self._write_seq] = len(SEGMENT_MAGIC)
+
+    def _close_write_segment(self):
+        if self._write_fp is not None:
+            self._write_fp.close()
+        self._write_fp = None
+        self._write_seq = None
+
+    def _start_reading(self, seq):
+        self._close_read_segment()
+        self._read_seq = seq
+        self._read_offset = len(SEGMENT_MAGIC)
+        try:
+            self._read_fp = open(self._segment_path(seq), "rb")
+            magic = self._read_fp.read(len(SEGMENT_MAGIC))
+        except (IOError, OSError) as exc:
+            LOG.warning("Failed to read spool segment %d: %s", seq, str(exc))
+            magic = None
+        if magic != SEGMENT_MAGIC:
+            # the rest of the segment is skipped
+            LOG.warning("Skipping invalid spool segment %d.", seq)
+            self._read_offset = self._segments[seq]
+
+    def _close_read_segment(self):
+        if self._read_fp is not None:
+            self._read_fp.close()
+        self._read_fp = None
+
+    def _read_record(self):
+        """
+        :returns: the record at the read offset, or None if the rest of the
+        segment was read or can't be read.
+        """
+        segment_size = self._segments[self._read_seq]
+        if self._read_fp is None or self._read_offset >= segment_size:
+            return None
+        self._read_fp.seek(self._read_offset)
+        header = self._read_fp.read(RECORD_HEADER.size)
+        if len(header) == RECORD_HEADER.size:
+            crc, payload_len, num_points, _ = RECORD_HEADER.unpack(header)
+            payload = self._read_fp.read(payload_len)
+            if (
+                len(payload) == payload_len
+                and zlib.crc32(header[4:] + payload) & 0xFFFFFFFF == crc
+            ):
+                end_offset = self._read_offset + RECORD_HEADER.size + payload_len
+                position = SpoolPosition(self._read_seq, self._read_offset, end_offset)
+                return position, zlib.decompress(payload), num_points
+        LOG.warning(
+            "Skipping %d bytes of incomplete or corrupt records of spool segment %d.",
+            segment_size - self._read_offset,
+            self._read_seq,
+        )
+        self._read_offset = segment_size
+        return None
+
+    def _delete_segment(self, seq):
+        if seq == self._read_seq:
+            self._close_read_segment()
+            self._read_seq = None
+        if seq == self._write_seq:
+            self._close_write_segment()
+        del self._segments[seq]
+        try:
+            os.remove(self._segment_path(seq))
+        except OSError as exc:
+            LOG.warning("Failed to delete spool segment %d: %s", seq, str(exc))
+
+    def _trim(self):
+        """
+        Delete the oldest segments while the spool is larger than max_bytes,
+        and the segments whose last record is older than max_age.
+        """
+        num_bytes = self.num_bytes()
+        while num_bytes > self.max_bytes and len(self._segments) > 1:
+            seq = min(self._segments)
+            if seq == self._write_seq:
+                break
+            LOG.warning(
+                "Spool is larger than %d bytes, dropping %d bytes of spooled "
+                "points.",
+                self.max_bytes,
+                self._segments[seq],
+            )
+            num_bytes -= self._segments[seq]
+            self.dropped_bytes += self._segments[seq]
+            self._delete_segment(seq)
+        min_time = time.time() - self.max_age
+        for seq in sorted(self._segments):
+            try:
+                if os.path.getmtime(self._segment_path(seq)) >= min_time:
+                    break
+            except OSError:
+                pass
+            LOG.warning(
+                "Dropping %d bytes of points that were spooled more than %d "
+                "seconds ago.",
+                self._segments[seq],
+                self.max_age,
+            )
+            self.dropped_bytes += self._segments[seq]
+            self._delete_segment(seq)
@@ -0,0 +1,373 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import gevent
+import requests.exceptions
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+import influxdb_plugin
+from influxdb_plugin import LineBuffer, StatsProcessorState
+from isi_stats_client import StatRecord
+from isi_write_spool import WriteSpool
+
+
+class EncodeStatTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_state = influxdb_plugin.g_state
+        influxdb_plugin.g_state = StatsProcessorState()
+
+    def tearDown(self):
+        influxdb_plugin.g_state = self.saved_state
+
+    def encode(self, *stats):
+        line_buffer = LineBuffer()
+        for stat in stats:
+            influxdb_plugin._encode_stat(line_buffer, "cluster1", stat)
+        lines, measurements = line_buffer.take()
+        self.assertEqual(len(lines.splitlines()), len(measurements))
+        return lines
+
+    def test_single_values(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.cpu.idle.avg", 1, 100, 12.5, None),
+                StatRecord("node.cpu.idle.avg", 2, 100, 13.25, None),
+                StatRecord("node.cpu.idle.avg", 1, 110, 14.0, None),
+            ),
+            b"node.cpu.idle.avg,cluster=cluster1,node=1 value=12.5 100\n"
+            b"node.cpu.idle.avg,cluster=cluster1,node=2 value=13.25 100\n"
+            b"node.cpu.idle.avg,cluster=cluster1,node=1 value=14.0 110\n",
+        )
+
+    def test_cluster_stat_has_no_node_tag(self):
+        self.assertEqual(
+            self.encode(StatRecord("cluster.health", 0, 100.7, 1, None)),
+            b"cluster.health,cluster=cluster1 value=1.0 100\n",
+        )
+
+    def test_ints_are_floats(self):
+        self.assertEqual(
+            self.encode(StatRecord("node.ifs.bytes.in", 1, 100, 2 ** 64 - 1, None)),
+            b"node.ifs.bytes.in,cluster=cluster1,node=1 value=1.8446744073709552e+19 100\n",
+        )
+
+    def test_values_that_are_skipped(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.a", 1, 100, float("nan"), None),
+                StatRecord("node.b", 1, 100, float("inf"), None),
+                StatRecord("node.c", 1, 100, None, None),
+                StatRecord("node.d", 1, 100, "", None),
+                StatRecord("node.e", 1, 100, {}, None),
+            ),
+            b"",
+        )
+
+    def test_strings_and_bools(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.a", 1, 100, 'say "hi"\\\n', None),
+                StatRecord("node.b", 1, 100, True, None),
+            ),
+            b'node.a,cluster=cluster1,node=1 value="say \\"hi\\"\\\\\\n" 100\n'
+            b"node.b,cluster=cluster1,node=1 value=true 100\n",
+        )
+
+    def test_escaping(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.a b,c", 1, 100, {"the op": "x=y", "count=": 1}, None)
+            ),
+            b"node.a\\ b\\,c,cluster=cluster1,node=1,the\\ op=x\\=y count\\==1.0 100\n",
+        )
+
+    def test_dict_value(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord(
+                    "node.ifs.heat",
+                    1,
+                    100,
+                    {
+                        "path": "/ifs/data",
+                        "lin": "1:0001",
+                        "event_id": 7,
+                        "ops": 5,
+                        "latency": {"avg": 1.5, "max": 3},
+                        "sizes": [1, 2],
+                    },
+                    None,
+                )
+            ),
+            b"node.ifs.heat,cluster=cluster1,event_id=7,lin=1:0001,node=1,"
+            b"path=/ifs/data latency.avg=1.5,latency.max=3.0,ops=5.0,"
+            b"sizes.value.0=1.0,sizes.value.1=2.0 100\n",
+        )
+
+    def test_list_value_is_a_point_per_item(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord(
+                    "node.protostats.nfs",
+                    1,
+                    100,
+                    [
+                        {"op_name": "read", "op_count": 3},
+                        {"op_name": "write", "op_count": 4},
+                        2.5,
+                    ],
+                    None,
+                )
+            ),
+            b"node.protostats.nfs,cluster=cluster1,node=1,op_name=read op_count=3.0 100\n"
+            b"node.protostats.nfs,cluster=cluster1,node=1,op_name=write op_count=4.0 100\n"
+            b"node.protostats.nfs,cluster=cluster1,node=1 value=2.5 100\n",
+        )
+
+    def test_later_values_are_converted_to_the_type_of_the_first(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.a", 1, 100, 1.5, None),
+                StatRecord("node.a", 1, 110, "2.5", None),
+                StatRecord("node.a", 1, 120, "n/a", None),
+                StatRecord("node.b", 1, 100, "up", None),
+                StatRecord("node.b", 1, 110, 3, None),
+            ),
+            b"node.a,cluster=cluster1,node=1 value=1.5 100\n"
+            b"node.a,cluster=cluster1,node=1 value=2.5 110\n"
+            b'node.b,cluster=cluster1,node=1 value="up" 100\n'
+            b'node.b,cluster=cluster1,node=1 value="3" 110\n',
+        )
+        self.assertEqual(influxdb_plugin.g_state.batch_stats.conflicting_fields, 1)
+
+    def test_field_types_are_per_measurement(self):
+        self.assertEqual(
+            self.encode(
+                StatRecord("node.a", 1, 100, 1.5, None),
+                StatRecord("node.b", 1, 100, "up", None),
+                StatRecord("node.a", 1, 110, "down", None),
+            ),
+            b"node.a,cluster=cluster1,node=1 value=1.5 100\n"
+            b'node.b,cluster=cluster1,node=1 value="up" 100\n',
+        )
+
+
+class BisectTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_state = influxdb_plugin.g_state
+        self.saved_post_points = influxdb_plugin._post_points
+        influxdb_plugin.g_state = StatsProcessorState()
+        influxdb_plugin._post_points = self.post_points
+        self.directory = tempfile.mkdtemp()
+        # the lines of each POST that succeeded
+        self.posts = []
+
+    def tearDown(self):
+        influxdb_plugin.g_state = self.saved_state
+        influxdb_plugin._post_points = self.saved_post_points
+        shutil.rmtree(self.directory)
+
+    def post_points(self, lines):
+        """
+        Reject the lines that have a bad field, like InfluxDB does for a field
+        type conflict.
+        """
+        for line in lines.splitlines():
+            if b"bad=" in line:
+                raise InfluxDBClientError(
+                    '{"error":"partial write: field type conflict: input field '
+                    '\\"bad\\" on measurement \\"%s\\" is type string, already '
+                    'exists as type float dropped=1"}' % line.split(b",")[0].decode(),
+                    400,
+                )
+        self.posts.append(lines)
+        return len(lines)
+
+    def write(self, lines):
+        measurements = [line.split(b",")[0].decode() for line in lines.splitlines()]
+        return influxdb_plugin._write_points(lines, measurements)
+
+    def test_batch_without_rejected_points_is_not_bisected(self):
+        lines = b"node.a,cluster=c good=1.0 100\nnode.b,cluster=c good=2.0 100\n"
+        self.assertEqual(self.write(lines), 2)
+        self.assertEqual(self.posts, [lines])
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.batches_written, 1)
+        self.assertEqual(batch_stats.bisected_batches, 0)
+
+    def test_rejected_points_are_quarantined(self):
+        quarantine_file = os.path.join(self.directory, "quarantine.txt")
+        influxdb_plugin.g_state.quarantine_file = quarantine_file
+        lines = [b"node.m%d,cluster=c good=%d.0 100\n" % (index, index) for index in range(7)]
+        lines[2] = b'node.m2,cluster=c bad="x" 100\n'
+        lines[5] = b'node.m5,cluster=c bad="y" 100\n'
+        self.assertEqual(self.write(b"".join(lines)), 5)
+        written_lines = sorted(
+            line for post in self.posts for line in post.splitlines(True)
+        )
+        self.assertEqual(written_lines, sorted(lines[:2] + lines[3:5] + lines[6:]))
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.bisected_batches, 1)
+        self.assertEqual(batch_stats.quarantined_points, 2)
+        self.assertEqual(batch_stats.points_written, 5)
+        self.assertEqual(batch_stats.batches_written, 0)
+        self.assertEqual(batch_stats.failed_batches, 1)
+        with open(quarantine_file, "rb") as quarantine_fp:
+            quarantined_lines = [
+                line
+                for line in quarantine_fp.read().splitlines(True)
+                if not line.startswith(b"#")
+            ]
+        self.assertEqual(sorted(quarantined_lines), [lines[2], lines[5]])
+        # the type of the conflicting field is registered
+        self.assertEqual(
+            influxdb_plugin.g_state.field_types["node.m2"], {"bad": "float"}
+        )
+
+    def test_batch_rejected_for_the_same_reason_is_quarantined_as_a_whole(self):
+        num_posts = [0]
+
+        def post_points(lines):
+            num_posts[0] += 1
+            raise InfluxDBClientError(
+                '{"error":"partial write: points beyond retention policy '
+                'dropped=%d"}' % len(lines.splitlines()),
+                400,
+            )
+
+        influxdb_plugin._post_points = post_points
+        lines = b"".join(
+            b"node.m%d,cluster=c good=1.0 100\n" % index for index in range(5000)
+        )
+        self.assertEqual(self.write(lines), 0)
+        # the batch and its two halves
+        self.assertEqual(num_posts[0], 3)
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.quarantined_points, 5000)
+        self.assertEqual(batch_stats.failed_batches, 1)
+
+    def test_bisection_requests_are_limited(self):
+        num_posts = [0]
+
+        def post_points(lines):
+            num_posts[0] += 1
+            return self.post_points(lines)
+
+        influxdb_plugin._post_points = post_points
+        # each rejected point has a different error
+        lines = [b'node.m%d,cluster=c bad="x" 100\n' % index for index in range(1000)]
+        self.assertEqual(self.write(b"".join(lines)), 0)
+        self.assertLessEqual(num_posts[0], influxdb_plugin.MAX_BISECT_REQUESTS + 1)
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.quarantined_points, 1000)
+
+    def test_other_client_errors_are_not_bisected(self):
+        def post_points(lines):
+            raise InfluxDBClientError("database not found", 404)
+
+        influxdb_plugin._post_points = post_points
+        self.assertEqual(self.write(b"node.a,cluster=c good=1.0 100\n"), 0)
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.bisected_batches, 0)
+        self.assertEqual(batch_stats.failed_batches, 1)
+
+    def test_batches_that_failed_to_be_written_are_spooled(self):
+        spool = influxdb_plugin.g_state.spool = WriteSpool(self.directory)
+        lines = b"node.a,cluster=c good=1.0 100\n"
+        for exc in (
+            requests.exceptions.ReadTimeout("read timed out"),
+            requests.exceptions.ConnectionError("connection refused"),
+            InfluxDBServerError("timeout"),
+        ):
+
+            def post_points(lines):
+                raise exc
+
+            influxdb_plugin._post_points = post_points
+            self.assertEqual(self.write(lines), 0)
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.spooled_batches, 3)
+        self.assertEqual(batch_stats.failed_batches, 3)
+        for _ in range(3):
+            position, data, num_points = spool.peek()
+            self.assertEqual((data, num_points), (lines, 1))
+            spool.commit(position)
+        self.assertTrue(spool.is_empty())
+        spool.close()
+
+    def test_half_of_a_bisected_batch_that_timed_out_is_spooled(self):
+        spool = influxdb_plugin.g_state.spool = WriteSpool(self.directory)
+        lines = [
+            b"node.a,cluster=c good=1.0 100\n",
+            b'node.b,cluster=c bad="x" 100\n',
+            b"node.c,cluster=c slow=1.0 100\n",
+            b"node.d,cluster=c slow=2.0 100\n",
+        ]
+
+        def post_points(lines):
+            if b"slow=" in lines and b"bad=" not in lines:
+                raise requests.exceptions.ReadTimeout("read timed out")
+            return self.post_points(lines)
+
+        influxdb_plugin._post_points = post_points
+        self.assertEqual(self.write(b"".join(lines)), 1)
+        batch_stats = influxdb_plugin.g_state.batch_stats
+        self.assertEqual(batch_stats.bisected_batches, 1)
+        self.assertEqual(batch_stats.quarantined_points, 1)
+        self.assertEqual(batch_stats.spooled_batches, 1)
+        self.assertEqual(batch_stats.failed_batches, 1)
+        _, data, num_points = spool.peek()
+        self.assertEqual((data, num_points), (b"".join(lines[2:]), 2))
+        spool.close()
+
+
+class StopTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_state = influxdb_plugin.g_state
+        self.saved_post_points = influxdb_plugin._post_points
+        self.saved_stop_timeout = influxdb_plugin.STOP_TIMEOUT
+        influxdb_plugin.g_state = StatsProcessorState()
+        influxdb_plugin.STOP_TIMEOUT = 0.05
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        influxdb_plugin.g_state = self.saved_state
+        influxdb_plugin._post_points = self.saved_post_points
+        influxdb_plugin.STOP_TIMEOUT = self.saved_stop_timeout
+        shutil.rmtree(self.directory)
+
+    def test_unwritten_batches_are_spooled(self):
+        def post_points(lines):
+            # InfluxDB doesn't respond
+            gevent.sleep(60)
+
+        influxdb_plugin._post_points = post_points
+        g_state = influxdb_plugin.g_state
+        g_state.max_parallel_writes = 2
+        g_state.spool = WriteSpool(self.directory)
+        lines = [b"node.m%d,cluster=c value=1.0 100\n" % index for index in range(3)]
+        for line in lines:
+            g_state.open_batch.append(line, line.split(b",")[0].decode())
+            influxdb_plugin._seal_batch(influxdb_plugin.SEALED_BY_POINTS)
+        # the writers take the first two batches
+        gevent.sleep(0)
+        self.assertEqual(g_state.write_queue.qsize(), 1)
+        influxdb_plugin.stop()
+        self.assertEqual(g_state.batch_stats.spooled_batches, 3)
+        spool = WriteSpool(self.directory)
+        spooled_lines = []
+        record = spool.peek()
+        while record is not None:
+            position, data, num_points = record
+            self.assertEqual(num_points, 1)
+            spooled_lines.append(data)
+            spool.commit(position)
+            record = spool.peek()
+        spool.close()
+        self.assertEqual(spooled_lines, lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+from __future__ import division
+import math
+import unittest
+
+from isi_equation import EquationError, compile_equation
+
+
+class CompileEquationTest(unittest.TestCase):
+    def test_stat_names_are_the_arguments_in_order_of_first_use(self):
+        equation = compile_equation(
+            "(cluster.node.ifs.ops.in.sum + cluster.node.ifs.ops.out.sum)"
+            " * cluster.node.ifs.ops.in.sum"
+        )
+        self.assertEqual(
+            equation.input_names,
+            ["cluster.node.ifs.ops.in.sum", "cluster.node.ifs.ops.out.sum"],
+        )
+        self.assertEqual(equation(2, 3), 10)
+
+    def test_stat_names_with_fields(self):
+        equation = compile_equation(
+            "cluster.protostats.nfs.total:op_count"
+            " + cluster.protostats.smb2.total:op_count"
+        )
+        self.assertEqual(
+            equation.input_names,
+            [
+                "cluster.protostats.nfs.total:op_count",
+                "cluster.protostats.smb2.total:op_count",
+            ],
+        )
+        self.assertEqual(equation(1, 2), 3)
+
+    def test_true_division(self):
+        self.assertEqual(compile_equation("node.a / node.b")(1, 2), 0.5)
+
+    def test_caret_is_power(self):
+        self.assertEqual(compile_equation("node.a ^ 2")(3), 9)
+
+    def test_functions_and_constants(self):
+        equation = compile_equation("sqrt(node.a) + max(node.b, 1) * pi")
+        self.assertAlmostEqual(equation(4, 0), 2 + math.pi)
+
+    def test_function_name_without_call_is_a_stat_name(self):
+        equation = compile_equation("min + 1")
+        self.assertEqual(equation.input_names, ["min"])
+        self.assertEqual(equation(1), 2)
+
+    def test_constant_expression(self):
+        equation = compile_equation("2 * 3")
+        self.assertEqual(equation.input_names, [])
+        self.assertEqual(equation(), 6)
+        self.assertEqual(equation.evaluate_vector([(), ()]), [6, 6])
+
+    def test_evaluate_vector(self):
+        equation = compile_equation("node.a - node.b")
+        self.assertEqual(equation.evaluate_vector([(3, 1), (5, 5), (0, 2)]), [2, 0, -2])
+
+    def test_division_by_zero_raises(self):
+        equation = compile_equation("node.a / node.b")
+        self.assertRaises(ZeroDivisionError, equation, 1, 0)
+
+    def test_empty_equation(self):
+        self.assertRaises(EquationError, compile_equation, "  ")
+
+    def test_syntax_error_column(self):
+        with self.assertRaises(EquationError) as context:
+            compile_equation("node.a + * node.b")
+        self.assertEqual(context.exception.column, 9)
+
+    def test_incomplete_expression(self):
+        with self.assertRaises(EquationError) as context:
+            compile_equation("(node.a + node.b")
+        self.assertIn("Syntax error", str(context.exception))
+
+    def test_unsupported_operators(self):
+        for expression in ("node.a << 2", "node.a & node.b", "~node.a", "node.a < 2"):
+            self.assertRaises(EquationError, compile_equation, expression)
+
+    def test_unsupported_calls(self):
+        for expression in (
+            "open(node.a)",
+            "sqrt()",
+            "sqrt(x=node.a)",
+            "sqrt(*node.a)",
+        ):
+            self.assertRaises(EquationError, compile_equation, expression)
+
+    def test_unsupported_syntax(self):
+        for expression in (
+            "node.a if node.b else 1",
+            "[node.a]",
+            "lambda: 1",
+            "'x'",
+        ):
+            self.assertRaises(EquationError, compile_equation, expression)
+
+    def test_dotted_names_are_stat_names_not_attributes(self):
+        equation = compile_equation("node.a.__class__ + True")
+        self.assertEqual(equation.input_names, ["node.a.__class__", "True"])
+        self.assertEqual(equation(1, 2), 3)
+
+    def test_invalid_stat_name_column(self):
+        with self.assertRaises(EquationError) as context:
+            compile_equation("node.a + node..b")
+        self.assertEqual(context.exception.column, 9)
+
+    def test_no_builtins(self):
+        self.assertRaises(EquationError, compile_equation, "__import__(node.a)")
+
+
+if __name__ == "__main__":
+    unittest.main()
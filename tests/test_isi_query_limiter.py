@@ -0,0 +1,159 @@
+import unittest
+
+import gevent
+import gevent.event
+
+from isi_query_limiter import (
+    DECREASE_FACTOR,
+    INITIAL_CLUSTER_QUERIES,
+    MIN_CLUSTER_QUERIES,
+    QueryLimiter,
+)
+
+
+class ClusterQueryLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = QueryLimiter(
+            max_queries=20, max_cluster_queries=4, latency_target=10.0
+        )
+        self.cluster_limit = self.limiter.cluster_limit("cluster1")
+
+    def test_limit_is_per_cluster(self):
+        self.assertIs(self.limiter.cluster_limit("cluster1"), self.cluster_limit)
+        self.assertIsNot(self.limiter.cluster_limit("cluster2"), self.cluster_limit)
+        self.assertEqual(self.cluster_limit.limit, INITIAL_CLUSTER_QUERIES)
+
+    def test_additive_increase_up_to_max_cluster_queries(self):
+        self.cluster_limit._update(100.0, 101.0, False)
+        self.assertEqual(self.cluster_limit.limit, INITIAL_CLUSTER_QUERIES + 0.5)
+        for index in range(100):
+            self.cluster_limit._update(100.0 + index, 101.0 + index, False)
+        self.assertEqual(self.cluster_limit.limit, 4.0)
+
+    def test_multiplicative_decrease_on_error(self):
+        self.cluster_limit.limit = 4.0
+        self.cluster_limit._update(100.0, 101.0, True)
+        self.assertEqual(self.cluster_limit.limit, 4.0 * DECREASE_FACTOR)
+        self.assertGreater(self.cluster_limit.error_rate, 0.0)
+
+    def test_slow_request_is_a_decrease(self):
+        self.cluster_limit.limit = 4.0
+        self.cluster_limit._update(100.0, 111.0, False)
+        self.assertEqual(self.cluster_limit.limit, 4.0 * DECREASE_FACTOR)
+        self.assertEqual(self.cluster_limit.latency, 11.0)
+
+    def test_one_decrease_per_congestion_event(self):
+        self.cluster_limit.limit = 4.0
+        # the requests that were in flight when the first one failed
+        self.cluster_limit._update(100.0, 102.0, True)
+        self.cluster_limit._update(101.0, 103.0, True)
+        self.assertEqual(self.cluster_limit.limit, 4.0 * DECREASE_FACTOR)
+        # a request that started after the decrease
+        self.cluster_limit._update(104.0, 105.0, True)
+        self.assertEqual(self.cluster_limit.limit, 4.0 * DECREASE_FACTOR ** 2)
+
+    def test_limit_never_goes_below_the_min(self):
+        for index in range(10):
+            self.cluster_limit._update(100.0 + index, 100.5 + index, True)
+        self.assertEqual(self.cluster_limit.limit, MIN_CLUSTER_QUERIES)
+
+    def test_call_releases_on_error(self):
+        def fail():
+            raise IOError("connection reset")
+
+        self.assertRaises(IOError, self.cluster_limit.call, fail)
+        self.assertEqual(self.cluster_limit.in_flight, 0)
+        self.assertEqual(self.limiter.in_flight, 0)
+        self.assertEqual(self.cluster_limit.limit, MIN_CLUSTER_QUERIES)
+        self.assertEqual(self.cluster_limit.call(lambda: 5), 5)
+
+    def test_invalid_limits(self):
+        self.assertRaises(ValueError, QueryLimiter, 0, 4, 10.0)
+        self.assertRaises(ValueError, QueryLimiter, 20, 0, 10.0)
+        self.assertRaises(ValueError, QueryLimiter, 20, 4, 0)
+
+
+class QueryLimiterTest(unittest.TestCase):
+    def run_queries(self, limiter, cluster_names):
+        """
+        Run a query of each of the clusters concurrently.
+        :returns: a dict of cluster name -> max number of its queries that
+        were in flight at the same time, and the max number of all queries
+        that were in flight at the same time.
+        """
+        in_flight = {cluster_name: 0 for cluster_name in cluster_names}
+        max_in_flight = {cluster_name: 0 for cluster_name in cluster_names}
+        max_total = [0]
+
+        def query(cluster_name):
+            in_flight[cluster_name] += 1
+            max_in_flight[cluster_name] = max(
+                max_in_flight[cluster_name], in_flight[cluster_name]
+            )
+            max_total[0] = max(max_total[0], sum(in_flight.values()))
+            gevent.sleep(0.001)
+            in_flight[cluster_name] -= 1
+
+        gevent.joinall(
+            [
+                gevent.spawn(
+                    limiter.cluster_limit(cluster_name).call, query, cluster_name
+                )
+                for cluster_name in cluster_names
+            ],
+            raise_error=True,
+        )
+        return max_in_flight, max_total[0]
+
+    def test_cluster_limit(self):
+        limiter = QueryLimiter(max_queries=20, max_cluster_queries=2, latency_target=10.0)
+        max_in_flight, _ = self.run_queries(limiter, ["cluster1", "cluster2"] * 10)
+        self.assertEqual(max_in_flight, {"cluster1": 2, "cluster2": 2})
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_limit_increases_while_queries_succeed(self):
+        limiter = QueryLimiter(max_queries=20, max_cluster_queries=4, latency_target=10.0)
+        max_in_flight, _ = self.run_queries(limiter, ["cluster1"] * 20)
+        self.assertEqual(max_in_flight["cluster1"], 4)
+        self.assertEqual(limiter.cluster_limit("cluster1").limit, 4.0)
+
+    def test_global_limit(self):
+        limiter = QueryLimiter(max_queries=3, max_cluster_queries=4, latency_target=10.0)
+        _, max_total = self.run_queries(
+            limiter, ["cluster1", "cluster2", "cluster3", "cluster4"] * 3
+        )
+        self.assertEqual(max_total, 3)
+        self.assertEqual(limiter.get_stats()["queued"], 0)
+
+    def test_cluster_at_its_limit_does_not_hold_up_other_clusters(self):
+        limiter = QueryLimiter(max_queries=20, max_cluster_queries=4, latency_target=10.0)
+        slow_cluster_limit = limiter.cluster_limit("slow")
+        release = gevent.event.Event()
+        slow_queries = [
+            gevent.spawn(slow_cluster_limit.call, release.wait) for _ in range(3)
+        ]
+        gevent.sleep(0)
+        self.assertEqual(slow_cluster_limit.queued, 1)
+        self.assertEqual(limiter.cluster_limit("fast").call(lambda: "done"), "done")
+        release.set()
+        gevent.joinall(slow_queries, raise_error=True)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_killed_waiter_gives_up_its_place(self):
+        limiter = QueryLimiter(max_queries=1, max_cluster_queries=4, latency_target=10.0)
+        release = gevent.event.Event()
+        cluster_limit = limiter.cluster_limit("cluster1")
+        running = gevent.spawn(cluster_limit.call, release.wait)
+        waiting = gevent.spawn(cluster_limit.call, lambda: None)
+        gevent.sleep(0)
+        self.assertEqual(limiter.get_stats()["queued"], 1)
+        waiting.kill()
+        self.assertEqual(limiter.get_stats()["queued"], 0)
+        release.set()
+        running.join()
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(cluster_limit.call(lambda: 1), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from isi_stat_decoder import StatValueDecoder
+
+
+class StatValueDecoderTest(unittest.TestCase):
+    def assertDecodes(self, key, values):
+        """
+        Decode each of the values in order with the same decoder and check
+        that each one is decoded to the same value and type as literal_eval
+        would.
+        """
+        decoder = StatValueDecoder()
+        for value, expected_value in values:
+            decoded_value = decoder.decode(key, value)
+            self.assertEqual(decoded_value, expected_value)
+            self.assertIs(type(decoded_value), type(expected_value))
+
+    def test_ints(self):
+        self.assertDecodes(
+            "node.ifs.bytes.in",
+            [("1", 1), ("-20", -20), ("12345678901234567890", 12345678901234567890)],
+        )
+
+    def test_floats(self):
+        self.assertDecodes(
+            "node.cpu.idle.avg", [("1.5", 1.5), ("2e3", 2000.0), ("-0.25", -0.25)]
+        )
+
+    def test_shape_changes(self):
+        self.assertDecodes(
+            "node.x",
+            [
+                ("1", 1),
+                ("1.5", 1.5),
+                ("2", 2),
+                ("True", True),
+                ("None", None),
+                ("up", "up"),
+                ("3", 3),
+            ],
+        )
+
+    def test_strings(self):
+        self.assertDecodes(
+            "node.health",
+            [("healthy", "healthy"), ("1st", "1st"), ("'quoted'", "quoted"), ("", "")],
+        )
+
+    def test_json_compatible_values(self):
+        self.assertDecodes(
+            "node.protostats.nfs",
+            [
+                (
+                    "[{'op': 'read', 'op_count': 3, 'time_avg': 1.5}]",
+                    [{"op": "read", "op_count": 3, "time_avg": 1.5}],
+                ),
+                (
+                    "[{'op': 'write', 'op_count': 4, 'time_avg': 0.5}]",
+                    [{"op": "write", "op_count": 4, "time_avg": 0.5}],
+                ),
+                ("[]", []),
+            ],
+        )
+
+    def test_values_that_are_not_json_compatible(self):
+        self.assertDecodes(
+            "node.x",
+            [
+                ("{'a': 1}", {"a": 1}),
+                ("{'a': True}", {"a": True}),
+                ("{'a': None, 'b': (1, 2)}", {"a": None, "b": (1, 2)}),
+                ('{"it\'s": 1}', {"it's": 1}),
+                ("{'a\\\\b': 1}", {"a\\b": 1}),
+                ("{1: 'a'}", {1: "a"}),
+                ("{'a': 2}", {"a": 2}),
+            ],
+        )
+
+    def test_tuples_are_lists(self):
+        self.assertDecodes("node.x", [("(1, 2)", [1, 2]), ("(3, 4)", [3, 4])])
+
+    def test_values_that_are_not_strings_are_unchanged(self):
+        value = {"a": 1}
+        self.assertIs(StatValueDecoder().decode("node.x", value), value)
+        self.assertDecodes("node.x", [(1, 1), (None, None)])
+
+    def test_shapes_are_per_key(self):
+        decoder = StatValueDecoder()
+        self.assertEqual(decoder.decode("node.a", "1"), 1)
+        self.assertEqual(decoder.decode("node.b", "x"), "x")
+        self.assertEqual(decoder.decode("node.a", "2"), 2)
+        self.assertEqual(decoder.decode("node.b", "3"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from isi_data_insights_daemon import (
+    DEFAULT_OVERRUN_POLICY,
+    ClusterConfig,
+    ClusterSchedule,
+    IsiDataInsightsDaemon,
+    StatsConfig,
+)
+from isi_stats_metadata_cache import StatMetadata, StatsMetadataCache
+
+
+class FakeMetadataQuery(object):
+    """
+    Query function of the stats metadata that returns the metadata of the
+    stats in self.metadata and records the stats it was queried for.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.queries = []
+
+    def __call__(self, cluster, stat_names):
+        self.queries.append(sorted(stat_names))
+        return [self.metadata.get(stat_name) for stat_name in stat_names]
+
+
+class StatsMetadataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = StatsMetadataCache(
+            os.path.join(self.directory, "metadata.json"), ttl=60
+        )
+        self.cluster = ClusterConfig("10.0.0.1", "cluster1", 8.0, None, None)
+        self.query = FakeMetadataQuery(
+            {
+                "node.cpu.idle.avg": StatMetadata("node.cpu.idle.avg", 30, None),
+                "node.ifs.bytes.in": StatMetadata("node.ifs.bytes.in", 5, [10]),
+            }
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age_entries(self, seconds):
+        for cluster_entries in self.cache._entries.values():
+            for stat_name, (stat_metadata, update_time) in cluster_entries.items():
+                cluster_entries[stat_name] = (stat_metadata, update_time - seconds)
+
+    def test_next_revalidation_time_of_the_used_entries(self):
+        self.assertIsNone(self.cache.next_revalidation_time())
+        before = time.time()
+        self.cache.get_stats_metadata(
+            self.cluster, ["node.cpu.idle.avg", "node.unknown"], self.query
+        )
+        next_time = self.cache.next_revalidation_time()
+        self.assertGreaterEqual(next_time, before + 60)
+        self.assertLessEqual(next_time, time.time() + 60)
+
+    def test_fresh_entries_are_not_revalidated(self):
+        self.cache.get_stats_metadata(self.cluster, ["node.cpu.idle.avg"], self.query)
+        self.assertEqual(self.cache.revalidate(self.query), [])
+        self.assertEqual(len(self.query.queries), 1)
+
+    def test_expired_entries_are_revalidated(self):
+        self.cache.get_stats_metadata(
+            self.cluster, ["node.cpu.idle.avg", "node.ifs.bytes.in"], self.query
+        )
+        self.age_entries(120)
+        self.assertEqual(self.cache.revalidate(self.query), [])
+        self.assertEqual(
+            self.query.queries[-1], ["node.cpu.idle.avg", "node.ifs.bytes.in"]
+        )
+        # the revalidated entries expire one ttl after the revalidation
+        self.assertGreater(self.cache.next_revalidation_time(), time.time() + 30)
+
+    def test_changed_metadata_is_returned(self):
+        self.cache.get_stats_metadata(self.cluster, ["node.ifs.bytes.in"], self.query)
+        self.age_entries(120)
+        self.query.metadata["node.ifs.bytes.in"] = StatMetadata(
+            "node.ifs.bytes.in", 5, [30]
+        )
+        self.assertEqual(self.cache.revalidate(self.query), [self.cluster])
+        self.assertEqual(
+            self.cache.get_stats_metadata(
+                self.cluster, ["node.ifs.bytes.in"], self.query
+            )[0].policy_intervals,
+            [30],
+        )
+        self.assertEqual(len(self.query.queries), 2)
+
+    def test_failed_revalidation_is_retried(self):
+        self.cache.get_stats_metadata(self.cluster, ["node.cpu.idle.avg"], self.query)
+        self.age_entries(120)
+
+        def fail(cluster, stat_names):
+            raise IOError("connection refused")
+
+        self.assertEqual(self.cache.revalidate(fail), [])
+        self.assertLess(self.cache.next_revalidation_time(), time.time())
+        self.cache.revalidate(self.query)
+        self.assertGreater(self.cache.next_revalidation_time(), time.time())
+
+
+class ReconfigureClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.daemon = IsiDataInsightsDaemon(pidfile="/tmp/test_isi_data_insights_d.pid")
+        self.cluster = ClusterConfig("10.0.0.1", "cluster1", 8.0, None, None)
+        self.started = []
+        self.daemon._start_cluster_loops = lambda debug: self.started.append(debug)
+        self.add_stats(30, ["node.cpu.idle.avg"])
+        self.schedule = ClusterSchedule(self.cluster, [30], DEFAULT_OVERRUN_POLICY)
+        self.daemon._cluster_schedules.append(self.schedule)
+
+    def add_stats(self, update_interval, stats):
+        stats_config = StatsConfig([self.cluster], stats, update_interval)
+        self.daemon.add_stats(stats_config)
+
+    def reconfigure(self, reconfigure_func):
+        self.daemon._reconfigure_cluster_func = reconfigure_func
+        self.daemon._reconfigure_cluster(self.cluster, False)
+
+    def test_changed_update_interval_replaces_the_update_loop(self):
+        self.reconfigure(lambda cluster: self.add_stats(60, ["node.cpu.idle.avg"]))
+        self.assertEqual(list(self.daemon._stat_sets[self.cluster]), [60])
+        self.assertTrue(self.schedule.cancelled)
+        self.assertEqual(self.daemon._cluster_schedules, [])
+        self.assertEqual(self.started, [False])
+
+    def test_unchanged_update_interval_keeps_the_update_loop(self):
+        old_stat_sets = self.daemon._stat_sets[self.cluster]
+        self.reconfigure(lambda cluster: self.add_stats(30, ["node.cpu.idle.avg"]))
+        self.assertIs(self.daemon._stat_sets[self.cluster], old_stat_sets)
+        self.assertFalse(self.schedule.cancelled)
+        self.assertEqual(self.started, [])
+
+    def test_failed_reconfiguration_keeps_the_update_loop(self):
+        old_stat_sets = self.daemon._stat_sets[self.cluster]
+
+        def fail(cluster):
+            self.add_stats(60, ["node.cpu.idle.avg"])
+            raise RuntimeError("invalid stat group")
+
+        self.reconfigure(fail)
+        self.assertIs(self.daemon._stat_sets[self.cluster], old_stat_sets)
+        self.assertFalse(self.schedule.cancelled)
+        self.assertEqual(self.started, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+from __future__ import division
+import unittest
+
+from isi_data_insights_daemon import DerivedStatGraph, DerivedStatInput
+from isi_stats_client import StatRecord
+from isi_windowed_stats import (
+    RateStatComputer,
+    RingBuffer,
+    build_windowed_stat_computer,
+    parse_windowed_stat,
+)
+
+
+def run_pass(graph, history, stats):
+    """
+    Process one pass of stats of a cluster.
+    :returns: a dict of (key, devid) -> value or error of the derived stats.
+    """
+    context = graph.begin_process("cluster", history)
+    for stat in stats:
+        context.select_stat(stat)
+    derived_stats = {}
+    for computer, state in context.computer_states():
+        for derived_stat in computer.compute_derived_stats(state):
+            derived_stats[(derived_stat.key, derived_stat.devid)] = (
+                derived_stat.value
+                if derived_stat.error is None
+                else derived_stat.error
+            )
+    return derived_stats
+
+
+class RateStatComputerTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = DerivedStatGraph(
+            [RateStatComputer(DerivedStatInput("node.ifs.bytes.in"), "rate")]
+        )
+        self.history = {}
+
+    def rates(self, timestamp, values):
+        return run_pass(
+            self.graph,
+            self.history,
+            [
+                StatRecord("node.ifs.bytes.in", devid, timestamp, value, None)
+                for devid, value in values.items()
+            ],
+        )
+
+    def test_rate_of_each_node(self):
+        self.assertEqual(self.rates(100, {1: 1000, 2: 0}), {})
+        self.assertEqual(
+            self.rates(130, {1: 4000, 2: 300}),
+            {("rate", 1): 100.0, ("rate", 2): 10.0},
+        )
+        self.assertEqual(
+            self.rates(160, {1: 4000, 2: 900}),
+            {("rate", 1): 0.0, ("rate", 2): 20.0},
+        )
+
+    def test_no_rate_if_the_stat_was_not_updated(self):
+        self.rates(100, {1: 1000})
+        self.assertEqual(self.rates(100, {1: 1000}), {})
+        self.assertEqual(self.rates(130, {1: 1300}), {("rate", 1): 10.0})
+
+    def test_counter_reset_rebaselines(self):
+        self.rates(100, {1: 1000})
+        self.rates(130, {1: 1300})
+        self.assertEqual(self.rates(160, {1: 50}), {})
+        self.assertEqual(self.rates(190, {1: 350}), {("rate", 1): 10.0})
+
+    def test_long_gap_rebaselines(self):
+        self.rates(100, {1: 1000})
+        self.rates(130, {1: 1300})
+        # more than 5 times the previous interval of 30 seconds
+        self.assertEqual(self.rates(400, {1: 4000}), {})
+        # the interval after the gap is the new baseline, even though it is
+        # much shorter than the gap.
+        self.assertEqual(self.rates(430, {1: 4300}), {("rate", 1): 10.0})
+
+    def test_gap_within_the_limit_is_a_rate(self):
+        self.rates(100, {1: 1000})
+        self.rates(130, {1: 1300})
+        self.assertEqual(self.rates(280, {1: 2800}), {("rate", 1): 10.0})
+
+    def test_invalid_value_is_an_error(self):
+        derived_stats = self.rates(100, {1: "n/a"})
+        self.assertIn("Invalid value", derived_stats[("rate", 1)])
+
+    def test_history_is_per_cluster(self):
+        other_history = {}
+        self.rates(100, {1: 1000})
+        self.assertEqual(
+            run_pass(
+                self.graph,
+                other_history,
+                [StatRecord("node.ifs.bytes.in", 1, 130, 1300, None)],
+            ),
+            {},
+        )
+        self.assertEqual(self.rates(130, {1: 1300}), {("rate", 1): 10.0})
+
+    def test_rate_of_a_field(self):
+        graph = DerivedStatGraph(
+            [
+                RateStatComputer(
+                    DerivedStatInput("node.protostats.nfs", ("op_count",)), "rate"
+                )
+            ]
+        )
+        history = {}
+        run_pass(
+            graph, history, [StatRecord("node.protostats.nfs", 1, 100, [{"op_count": 10}], None)]
+        )
+        self.assertEqual(
+            run_pass(
+                graph,
+                history,
+                [StatRecord("node.protostats.nfs", 1, 110, [{"op_count": 60}], None)],
+            ),
+            {("rate", 1): 5.0},
+        )
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_values_of_a_partial_buffer(self):
+        ring_buffer = RingBuffer(3)
+        self.assertEqual(list(ring_buffer.values()), [])
+        ring_buffer.push(1.0, 100)
+        ring_buffer.push(2.0, 110)
+        self.assertEqual(sorted(ring_buffer.values()), [1.0, 2.0])
+        self.assertEqual(ring_buffer.last_time, 110)
+
+    def test_oldest_values_are_overwritten(self):
+        ring_buffer = RingBuffer(3)
+        for index in range(5):
+            ring_buffer.push(float(index), index)
+        self.assertEqual(ring_buffer.count, 3)
+        self.assertEqual(sorted(ring_buffer.values()), [2.0, 3.0, 4.0])
+
+
+class ParseWindowedStatTest(unittest.TestCase):
+    def test_window_operations(self):
+        self.assertEqual(
+            parse_windowed_stat("moving_avg(node.cpu.idle.avg,10)"),
+            ("moving_avg", "node.cpu.idle.avg", 10, "node.cpu.idle.avg.moving_avg_10"),
+        )
+        self.assertEqual(
+            parse_windowed_stat("window_p95(node.protostats.nfs:time_avg, 60)"),
+            (
+                "window_p95",
+                "node.protostats.nfs:time_avg",
+                60,
+                "node.protostats.nfs.time_avg.window_p95_60",
+            ),
+        )
+
+    def test_ewma(self):
+        self.assertEqual(
+            parse_windowed_stat("ewma(node.cpu.idle.avg,0.25)"),
+            ("ewma", "node.cpu.idle.avg", 0.25, "node.cpu.idle.avg.ewma_0_25"),
+        )
+
+    def test_rate(self):
+        self.assertEqual(
+            parse_windowed_stat("rate(node.ifs.bytes.in)"),
+            ("rate", "node.ifs.bytes.in", None, "node.ifs.bytes.in.rate"),
+        )
+
+    def test_invalid_windowed_stats(self):
+        for stat_cfg in (
+            "moving_avg node.cpu.idle.avg",
+            "moving_avg(node.cpu.idle.avg)",
+            "moving_avg(node.cpu.idle.avg,0)",
+            "moving_avg(node.cpu.idle.avg,10001)",
+            "moving_avg(node.cpu.idle.avg,ten)",
+            "window_p101(node.cpu.idle.avg,10)",
+            "ewma(node.cpu.idle.avg,0)",
+            "ewma(node.cpu.idle.avg,1.5)",
+            "rate(node.ifs.bytes.in,10)",
+            "moving_sum(node.cpu.idle.avg,10)",
+        ):
+            self.assertRaises(RuntimeError, parse_windowed_stat, stat_cfg)
+
+
+class WindowedStatComputerTest(unittest.TestCase):
+    def values(self, stat_cfg, values):
+        """
+        :returns: the values of the windowed stat of stat_cfg on node 1, one
+        per pass, for the values of the input stat, one per pass.
+        """
+        op_name, in_stat_name, param, out_stat_name = parse_windowed_stat(stat_cfg)
+        graph = DerivedStatGraph(
+            [
+                build_windowed_stat_computer(
+                    op_name, DerivedStatInput(in_stat_name), param, out_stat_name
+                )
+            ]
+        )
+        history = {}
+        return [
+            run_pass(
+                graph, history, [StatRecord(in_stat_name, 1, timestamp, value, None)]
+            ).get((out_stat_name, 1))
+            for timestamp, value in enumerate(values)
+        ]
+
+    def test_moving_avg(self):
+        self.assertEqual(
+            self.values("moving_avg(node.x,3)", [3, 6, 9, 12]), [3.0, 4.5, 6.0, 9.0]
+        )
+
+    def test_window_min_and_max(self):
+        values = [5, 1, 4, 8, 2]
+        self.assertEqual(
+            self.values("window_min(node.x,2)", values), [5.0, 1.0, 1.0, 4.0, 2.0]
+        )
+        self.assertEqual(
+            self.values("window_max(node.x,2)", values), [5.0, 5.0, 4.0, 8.0, 8.0]
+        )
+
+    def test_window_percentile(self):
+        self.assertEqual(
+            self.values("window_p50(node.x,4)", [1, 3, 2, 10]), [1.0, 2.0, 2.0, 2.5]
+        )
+
+    def test_ewma(self):
+        self.assertEqual(
+            self.values("ewma(node.x,0.5)", [4, 8, 0]), [4.0, 6.0, 3.0]
+        )
+
+    def test_value_is_added_once_per_update(self):
+        op_name, in_stat_name, param, out_stat_name = parse_windowed_stat(
+            "moving_avg(node.x,3)"
+        )
+        graph = DerivedStatGraph(
+            [
+                build_windowed_stat_computer(
+                    op_name, DerivedStatInput(in_stat_name), param, out_stat_name
+                )
+            ]
+        )
+        history = {}
+        for timestamp, value in ((100, 2), (100, 2), (100, 2), (110, 8)):
+            derived_stats = run_pass(
+                graph, history, [StatRecord("node.x", 1, timestamp, value, None)]
+            )
+        self.assertEqual(derived_stats, {(out_stat_name, 1): 5.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
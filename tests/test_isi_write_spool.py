@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from isi_write_spool import RECORD_HEADER, SEGMENT_MAGIC, SEGMENT_SUFFIX, WriteSpool
+
+
+class WriteSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            spool.close()
+        shutil.rmtree(self.directory)
+
+    def open_spool(self, **kwargs):
+        spool = WriteSpool(self.directory, **kwargs)
+        self.spools.append(spool)
+        return spool
+
+    def segment_files(self):
+        return sorted(
+            file_name
+            for file_name in os.listdir(self.directory)
+            if file_name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def segment_path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def replay(self, spool):
+        """
+        Peek and commit all of the records of the spool.
+        :returns: a list of the data and number of points of the records.
+        """
+        records = []
+        record = spool.peek()
+        while record is not None:
+            position, data, num_points = record
+            records.append((data, num_points))
+            spool.commit(position)
+            record = spool.peek()
+        return records
+
+    def test_records_are_replayed_oldest_first(self):
+        spool = self.open_spool()
+        self.assertTrue(spool.is_empty())
+        self.assertIsNone(spool.peek())
+        spool.append(b"a value=1i 1", 1)
+        spool.append(b"b value=2i 2\nb value=3i 3", 2)
+        self.assertFalse(spool.is_empty())
+        self.assertEqual(spool.spooled_records, 2)
+        self.assertEqual(
+            self.replay(spool),
+            [(b"a value=1i 1", 1), (b"b value=2i 2\nb value=3i 3", 2)],
+        )
+        self.assertTrue(spool.is_empty())
+        self.assertEqual(self.segment_files(), [])
+
+    def test_record_is_peeked_until_committed(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        spool.append(b"b value=2i 2", 1)
+        _, data, _ = spool.peek()
+        self.assertEqual(data, b"a value=1i 1")
+        _, data, _ = spool.peek()
+        self.assertEqual(data, b"a value=1i 1")
+
+    def test_records_appended_while_replaying(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        position, _, _ = spool.peek()
+        spool.append(b"b value=2i 2", 1)
+        spool.commit(position)
+        spool.append(b"c value=3i 3", 1)
+        self.assertEqual(
+            self.replay(spool), [(b"b value=2i 2", 1), (b"c value=3i 3", 1)]
+        )
+
+    def test_segments_are_deleted_once_committed(self):
+        spool = self.open_spool(segment_bytes=128)
+        for index in range(6):
+            spool.append(b"a value=%di %d" % (index, index), 1)
+        num_segments = len(self.segment_files())
+        self.assertGreater(num_segments, 1)
+        position, _, _ = spool.peek()
+        spool.commit(position)
+        # the first segment still has records that weren't committed
+        self.assertEqual(len(self.segment_files()), num_segments)
+        self.assertEqual(len(self.replay(spool)), 5)
+        self.assertEqual(self.segment_files(), [])
+        self.assertEqual(spool.num_bytes(), 0)
+
+    def test_spool_of_a_previous_run_is_replayed(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        spool.append(b"b value=2i 2", 1)
+        spool.close()
+        spool = self.open_spool()
+        self.assertFalse(spool.is_empty())
+        spool.append(b"c value=3i 3", 1)
+        self.assertEqual(
+            self.replay(spool),
+            [(b"a value=1i 1", 1), (b"b value=2i 2", 1), (b"c value=3i 3", 1)],
+        )
+        self.assertEqual(self.segment_files(), [])
+
+    def test_corrupt_record_skips_the_rest_of_the_segment(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        spool.append(b"b value=2i 2", 1)
+        spool.append(b"c value=3i 3", 1)
+        spool.close()
+        (file_name,) = self.segment_files()
+        with open(self.segment_path(file_name), "rb") as segment_fp:
+            segment = bytearray(segment_fp.read())
+        # flip a bit of the payload of the second record
+        second_offset = len(SEGMENT_MAGIC) + (len(segment) - len(SEGMENT_MAGIC)) // 3
+        segment[second_offset + RECORD_HEADER.size] ^= 1
+        with open(self.segment_path(file_name), "wb") as segment_fp:
+            segment_fp.write(segment)
+        spool = self.open_spool()
+        self.assertEqual(self.replay(spool), [(b"a value=1i 1", 1)])
+        self.assertTrue(spool.is_empty())
+        self.assertEqual(self.segment_files(), [])
+
+    def test_truncated_record_is_skipped(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        spool.append(b"b value=2i 2", 1)
+        spool.close()
+        (file_name,) = self.segment_files()
+        path = self.segment_path(file_name)
+        with open(path, "r+b") as segment_fp:
+            segment_fp.truncate(os.path.getsize(path) - 3)
+        spool = self.open_spool()
+        self.assertEqual(self.replay(spool), [(b"a value=1i 1", 1)])
+        self.assertTrue(spool.is_empty())
+
+    def test_segment_with_invalid_magic_is_skipped(self):
+        with open(self.segment_path("%016d%s" % (0, SEGMENT_SUFFIX)), "wb") as segment_fp:
+            segment_fp.write(b"NOTASPOOLSEGMENT")
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        self.assertEqual(self.replay(spool), [(b"a value=1i 1", 1)])
+        self.assertEqual(self.segment_files(), [])
+
+    def test_other_files_are_ignored(self):
+        with open(self.segment_path("notes.txt"), "wb") as other_fp:
+            other_fp.write(b"not a segment")
+        with open(self.segment_path("x" + SEGMENT_SUFFIX), "wb") as other_fp:
+            other_fp.write(b"not a segment")
+        spool = self.open_spool()
+        self.assertTrue(spool.is_empty())
+
+    def test_oldest_segments_are_dropped_beyond_max_bytes(self):
+        spool = self.open_spool(max_bytes=256, segment_bytes=64)
+        for index in range(20):
+            spool.append(b"a value=%di %d" % (index, index), 1)
+        self.assertGreater(spool.dropped_bytes, 0)
+        self.assertLessEqual(spool.num_bytes(), 256)
+        self.assertEqual(
+            spool.num_bytes(),
+            sum(
+                os.path.getsize(self.segment_path(file_name))
+                for file_name in self.segment_files()
+            ),
+        )
+        records = self.replay(spool)
+        self.assertLess(len(records), 20)
+        # the newest records are kept, in order
+        self.assertEqual(records[-1], (b"a value=19i 19", 1))
+        indexes = [int(data.split(b" ")[-1]) for data, _ in records]
+        self.assertEqual(indexes, list(range(20 - len(records), 20)))
+
+    def test_segments_older_than_max_age_are_dropped(self):
+        spool = self.open_spool()
+        spool.append(b"a value=1i 1", 1)
+        spool.close()
+        (file_name,) = self.segment_files()
+        num_bytes = os.path.getsize(self.segment_path(file_name))
+        old_time = time.time() - 120
+        os.utime(self.segment_path(file_name), (old_time, old_time))
+        spool = self.open_spool(max_age=60)
+        spool.append(b"b value=2i 2", 1)
+        self.assertEqual(spool.dropped_bytes, num_bytes)
+        self.assertEqual(self.replay(spool), [(b"b value=2i 2", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()